@@ -0,0 +1,7 @@
+{% macro backfill_partition_filter(column_name, data_type='timestamp', default='true') %}
+    {%- if var('backfill_start_date', none) is not none -%}
+        {{ column_name }} >= {{ data_type }}('{{ var("backfill_start_date") }}')
+        and {{ column_name }} < {{ data_type }}('{{ var("backfill_end_date") }}')
+    {%- else -%} {{ default }}
+    {%- endif -%}
+{% endmacro %}
@@ -2,9 +2,16 @@
     config(
         materialized = 'incremental',
         incremental_strategy = 'insert_overwrite',
+        on_schema_change = 'sync_all_columns',
         partition_by = {'data_type': 'timestamp', 'field': 'created_at', 'granularity': 'day'}
     )
 }}
 
 select *
 from {{ ref('stg_public_datasets__bitcoin_blocks') }}
+
+{% if is_incremental() %}
+
+    where {{ backfill_partition_filter('created_at') }}
+
+{% endif %}
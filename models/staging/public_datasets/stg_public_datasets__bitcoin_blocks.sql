@@ -2,6 +2,7 @@
     config(
         materialized = 'incremental',
         incremental_strategy = 'insert_overwrite',
+        on_schema_change = 'sync_all_columns',
         partition_by = {'data_type': 'date', 'field': 'timestamp_date', 'granularity': 'day'}
     )
 }}
@@ -17,7 +18,12 @@ where
 
     {% if is_incremental() %}
 
-        and timestamp >= timestamp(date_sub(current_date(), interval 1 day))
+        and {{
+            backfill_partition_filter(
+                'timestamp',
+                default='timestamp >= timestamp(date_sub(current_date(), interval 1 day))'
+            )
+        }}
 
     {% endif %}
 
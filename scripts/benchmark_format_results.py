@@ -0,0 +1,135 @@
+import argparse
+import logging
+import random
+import time
+from typing import Callable, List
+
+import duckdb
+import pyarrow as pa
+from mart_monitor_commenter import format_results
+from utils import set_logging_options
+
+
+def format_results_per_metric(results: list) -> list:
+    """
+    The previous implementation of `format_results`, two `CASE` blocks and a correlated subquery per metric.
+
+    The CICD values are cast to VARCHAR, recent versions of DuckDB no longer do this implicitly.
+    """
+    arrow_table = pa.Table.from_pylist(results)  # noqa: F841, used by DuckDB
+    metric_names = [x for x in results[0].keys() if x != "table_name"]
+
+    metrics_base = " ".join(
+        [
+            f"""
+            CASE
+                WHEN table_name = 'cicd' THEN NULL
+                ELSE ROUND(((CAST({metric} AS NUMERIC) / (SELECT {metric} FROM arrow_table WHERE table_name = 'cicd')) - 1) * 100, 1)
+            END AS diff_{metric}_pct,
+            """
+            for metric in metric_names
+        ]
+    )
+    metrics_calc = " ".join(
+        [
+            f"""
+        CASE
+            WHEN table_name == 'cicd' THEN
+                CASE
+                    WHEN {metric} % 1 == 0 THEN CAST({metric} AS VARCHAR)
+                    ELSE CAST(CAST({metric} AS NUMERIC) AS VARCHAR)
+                END
+            ELSE
+                CASE
+                    WHEN ABS(diff_{metric}_pct) <= 0.5 THEN '🟢'
+                    WHEN ABS(diff_{metric}_pct) < 1 THEN '🟡'
+                    ELSE '🔴'
+                END
+                || ' '
+                || ROUND(CAST({metric} AS NUMERIC), 0)
+                || ' ('
+                || ROUND(diff_{metric}_pct, 2)
+                || '%)'
+        END AS diff_{metric}_pct,"""
+            for metric in metric_names
+        ]
+    )
+    query = f"""
+    WITH base AS (
+        SELECT
+            *,
+            {metrics_base}
+        FROM arrow_table
+    )
+
+    SELECT
+        table_name,
+        {metrics_calc}
+    FROM base
+    ORDER BY
+        CASE
+            WHEN table_name = 'cicd' THEN 1
+            WHEN table_name = 'stg' THEN 2
+            WHEN table_name = 'prd' THEN 3
+        END
+    """
+    con = duckdb.connect(database=":memory:")
+    cursor = con.execute(query)
+    data = {
+        x[0]: list(values)
+        for x, values in zip(cursor.description, zip(*cursor.fetchall()))
+    }
+    metrics_col = ["metrics"] + metric_names
+    for index, (k, v) in enumerate(data.items()):
+        v.insert(0, metrics_col[index])
+
+    return data
+
+
+def build_results(num_metrics: int) -> List[dict]:
+    """Results of a monitor with `num_metrics` metrics in cicd, stg and prd"""
+
+    random.seed(42)
+    cicd = {f"metric_{i}": random.randint(1, 10**6) for i in range(num_metrics)}
+    return [{"table_name": "cicd", **cicd}] + [
+        {
+            "table_name": env,
+            **{k: int(v * random.uniform(0.98, 1.02)) for k, v in cicd.items()},
+        }
+        for env in ["stg", "prd"]
+    ]
+
+
+def time_function(func: Callable, results: list, iterations: int) -> float:
+    """Return the average duration of `func` in milliseconds"""
+
+    start_time = time.monotonic()
+    for _ in range(iterations):
+        func(results)
+    return (time.monotonic() - start_time) / iterations * 1000
+
+
+def main() -> None:
+    set_logging_options()
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark `format_results` against the previous per metric implementation."
+    )
+    parser.add_argument(
+        "--iterations", help="Number of runs per measurement.", type=int, default=5
+    )
+    args = parser.parse_args()
+
+    for num_metrics in [10, 50, 200, 500]:
+        results = build_results(num_metrics)
+        per_metric_ms = time_function(
+            format_results_per_metric, results, args.iterations
+        )
+        vectorized_ms = time_function(format_results, results, args.iterations)
+        logging.info(
+            f"{num_metrics} metrics: per metric {per_metric_ms:.1f} ms, vectorized {vectorized_ms:.1f} ms ({per_metric_ms / vectorized_ms:.1f}x)..."
+        )
+
+
+if __name__ == "__main__":
+    main()
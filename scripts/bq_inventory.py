@@ -0,0 +1,362 @@
+import datetime
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Set, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.api_core.exceptions import GoogleAPICallError
+from google.cloud import bigquery
+
+# One row per dataset, table and routine. `name` is null for datasets, `last_modified_time` is the creation time of
+# tables as INFORMATION_SCHEMA.TABLES does not contain a last modified time.
+INVENTORY_SCHEMA = pa.schema(
+    [
+        ("resource_type", pa.string()),
+        ("dataset_id", pa.string()),
+        ("name", pa.string()),
+        ("is_dbt", pa.bool_()),
+        ("last_modified_time", pa.timestamp("us", tz="UTC")),
+    ]
+)
+
+
+class PlannedDeletion(NamedTuple):
+    """
+    A resource to delete, `resource_type` is "dataset" or "table" and `reason` is one of "cicd", "orphaned" or
+    "empty".
+    """
+
+    resource_type: str
+    resource_id: str
+    reason: str
+
+
+def take_inventory(
+    client: bigquery.Client,
+    location: str = "US",
+    previous: Optional[pa.Table] = None,
+) -> pa.Table:
+    """
+    Return the datasets, tables and routines of a project, see `INVENTORY_SCHEMA`.
+
+    The inventory is read from the region's `INFORMATION_SCHEMA`, if this fails it is listed with the BigQuery API
+    instead. A dataset's last modified time does not change when a table is created or dropped, so tables and
+    routines are only read again for datasets whose last modified time, number of tables and routines or latest
+    table creation/routine modification time differ from `previous`. The rows of other datasets are copied from
+    `previous`. When listed with the BigQuery API the contents of every dataset are read.
+    """
+
+    information_schema = (
+        f"`{client.project}.region-{location.lower()}.INFORMATION_SCHEMA"
+    )
+    try:
+        datasets = {
+            row["schema_name"]: row["last_modified_time"]
+            for row in client.query(
+                f"SELECT schema_name, last_modified_time FROM {information_schema}.SCHEMATA`"
+            ).result()
+        }
+        contents_versions = _query_contents_versions(client, information_schema)
+        use_information_schema = True
+    except GoogleAPICallError as e:
+        logging.info(f"{e=}, listing datasets instead...")
+        datasets = {
+            x.dataset_id: client.get_dataset(x.reference).modified
+            for x in client.list_datasets()
+        }
+        contents_versions = None
+        use_information_schema = False
+
+    previous_rows = previous.to_pylist() if previous is not None else []
+    previous_datasets = {
+        x["dataset_id"]: x["last_modified_time"]
+        for x in previous_rows
+        if x["resource_type"] == "dataset"
+    }
+    previous_contents_versions = _get_contents_versions(previous_rows)
+    datasets_to_inspect = sorted(
+        x
+        for x, v in datasets.items()
+        if previous_datasets.get(x) != v
+        or contents_versions is None
+        or contents_versions.get(x, (0, None))
+        != previous_contents_versions.get(x, (0, None))
+    )
+    inspected_datasets = set(datasets_to_inspect)
+    logging.info(
+        f"Inspecting {len(datasets_to_inspect)} of {len(datasets)} datasets modified since the previous inventory..."
+    )
+
+    rows: List[dict] = [
+        {
+            "resource_type": "dataset",
+            "dataset_id": k,
+            "name": None,
+            "is_dbt": False,
+            "last_modified_time": v,
+        }
+        for k, v in sorted(datasets.items())
+    ]
+    rows.extend(
+        x
+        for x in previous_rows
+        if x["resource_type"] != "dataset"
+        and x["dataset_id"] in datasets
+        and x["dataset_id"] not in inspected_datasets
+    )
+    if datasets_to_inspect:
+        if use_information_schema:
+            rows.extend(
+                _query_dataset_contents(client, information_schema, datasets_to_inspect)
+            )
+        else:
+            rows.extend(_list_dataset_contents(client, datasets_to_inspect))
+
+    return pa.Table.from_pylist(rows, schema=INVENTORY_SCHEMA)
+
+
+def _get_contents_versions(
+    rows: Iterable[dict],
+) -> Dict[str, Tuple[int, Optional[datetime.datetime]]]:
+    """Return the number of tables and routines per dataset of an inventory and their latest `last_modified_time`"""
+
+    last_modified_times: Dict[str, list] = {}
+    for x in rows:
+        if x["resource_type"] != "dataset":
+            last_modified_times.setdefault(x["dataset_id"], []).append(
+                x["last_modified_time"]
+            )
+
+    return {
+        k: (len(v), max((x for x in v if x is not None), default=None))
+        for k, v in last_modified_times.items()
+    }
+
+
+def _query_contents_versions(
+    client: bigquery.Client, information_schema: str
+) -> Dict[str, Tuple[int, Optional[datetime.datetime]]]:
+    """`_get_contents_versions` of every dataset, read from INFORMATION_SCHEMA"""
+
+    query = f"""
+        SELECT dataset_id, COUNT(*) AS num_resources, MAX(last_modified_time) AS last_modified_time
+        FROM (
+            SELECT table_schema AS dataset_id, creation_time AS last_modified_time
+            FROM {information_schema}.TABLES`
+            UNION ALL
+            SELECT routine_schema AS dataset_id, last_altered AS last_modified_time
+            FROM {information_schema}.ROUTINES`
+        )
+        GROUP BY dataset_id
+    """
+
+    return {
+        row["dataset_id"]: (row["num_resources"], row["last_modified_time"])
+        for row in client.query(query).result()
+    }
+
+
+def _query_dataset_contents(
+    client: bigquery.Client, information_schema: str, datasets: List[str]
+) -> List[dict]:
+    query = f"""
+        SELECT
+            "table" AS resource_type,
+            tables.table_schema AS dataset_id,
+            tables.table_name AS name,
+            labels.table_name IS NOT NULL AS is_dbt,
+            tables.creation_time AS last_modified_time
+        FROM {information_schema}.TABLES` AS tables
+        LEFT JOIN (
+            SELECT table_schema, table_name
+            FROM {information_schema}.TABLE_OPTIONS`
+            WHERE
+                option_name = "labels"
+                AND option_value LIKE '%STRUCT("created_by", "dbt")%'
+        ) AS labels
+            ON tables.table_schema = labels.table_schema
+            AND tables.table_name = labels.table_name
+        WHERE tables.table_schema IN UNNEST(@datasets)
+        UNION ALL
+        SELECT
+            "routine" AS resource_type,
+            routine_schema AS dataset_id,
+            routine_name AS name,
+            FALSE AS is_dbt,
+            last_altered AS last_modified_time
+        FROM {information_schema}.ROUTINES`
+        WHERE routine_schema IN UNNEST(@datasets)
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("datasets", "STRING", datasets)]
+    )
+
+    return [
+        dict(row.items()) for row in client.query(query, job_config=job_config).result()
+    ]
+
+
+def _list_dataset_contents(client: bigquery.Client, datasets: List[str]) -> List[dict]:
+    rows = []
+    for dataset_id in datasets:
+        dataset = f"{client.project}.{dataset_id}"
+        rows.extend(
+            {
+                "resource_type": "table",
+                "dataset_id": dataset_id,
+                "name": x.table_id,
+                "is_dbt": (x.labels or {}).get("created_by") == "dbt",
+                "last_modified_time": x.created,
+            }
+            for x in client.list_tables(dataset)
+        )
+        rows.extend(
+            {
+                "resource_type": "routine",
+                "dataset_id": dataset_id,
+                "name": x.routine_id,
+                "is_dbt": False,
+                "last_modified_time": x.modified,
+            }
+            for x in client.list_routines(dataset)
+        )
+
+    return rows
+
+
+def diff_inventories(
+    previous: Optional[pa.Table], current: pa.Table
+) -> Dict[str, List[str]]:
+    """Return the datasets that were added, removed or modified between two inventories"""
+
+    def datasets(inventory: Optional[pa.Table]) -> Dict[str, datetime.datetime]:
+        if inventory is None:
+            return {}
+        return {
+            x["dataset_id"]: x["last_modified_time"]
+            for x in inventory.to_pylist()
+            if x["resource_type"] == "dataset"
+        }
+
+    previous_datasets = datasets(previous)
+    current_datasets = datasets(current)
+
+    return {
+        "added": sorted(current_datasets.keys() - previous_datasets.keys()),
+        "removed": sorted(previous_datasets.keys() - current_datasets.keys()),
+        "modified": sorted(
+            x
+            for x in current_datasets.keys() & previous_datasets.keys()
+            if current_datasets[x] != previous_datasets[x]
+        ),
+    }
+
+
+def get_manifest_tables(manifest: Mapping) -> Set[Tuple[str, str]]:
+    """
+    Return the dataset and table name of every model in a manifest.json, from each node's `schema` and `alias` so
+    versioned models and models with the same name in different packages are all included.
+    """
+
+    return {
+        (v["schema"], v["alias"])
+        for v in manifest["nodes"].values()
+        if v["resource_type"] == "model"
+    }
+
+
+def plan_cleanup(
+    inventory: pa.Table,
+    dataset_pattern: str,
+    manifest_tables: Set[Tuple[str, str]],
+) -> List[PlannedDeletion]:
+    """
+    Compute every deletion of a cleanup from an inventory.
+
+    - "cicd": datasets that start with `dataset_pattern`.
+    - "orphaned": tables with the label `created_by: dbt` that are not in `manifest_tables` (dataset and table name).
+    - "empty": datasets that contain no tables or routines once orphaned tables are deleted.
+    """
+
+    rows = inventory.to_pylist()
+    datasets = sorted(x["dataset_id"] for x in rows if x["resource_type"] == "dataset")
+    cicd_datasets = {x for x in datasets if x.startswith(dataset_pattern)}
+
+    orphaned_tables = {
+        (x["dataset_id"], x["name"])
+        for x in rows
+        if x["resource_type"] == "table"
+        and x["is_dbt"]
+        and x["dataset_id"] not in cicd_datasets
+        and (x["dataset_id"], x["name"]) not in manifest_tables
+    }
+
+    non_empty_datasets = {
+        x["dataset_id"]
+        for x in rows
+        if x["resource_type"] != "dataset"
+        and (x["dataset_id"], x["name"]) not in orphaned_tables
+    }
+    empty_datasets = [
+        x for x in datasets if x not in cicd_datasets and x not in non_empty_datasets
+    ]
+
+    return (
+        [PlannedDeletion("dataset", x, "cicd") for x in sorted(cicd_datasets)]
+        + [
+            PlannedDeletion("table", f"{x}.{y}", "orphaned")
+            for x, y in sorted(orphaned_tables)
+        ]
+        + [PlannedDeletion("dataset", x, "empty") for x in empty_datasets]
+    )
+
+
+def prune_inventory(
+    inventory: pa.Table, deleted: Iterable[PlannedDeletion]
+) -> pa.Table:
+    """Remove deleted datasets, and all their contents, and deleted tables from an inventory"""
+
+    deleted_datasets = {x.resource_id for x in deleted if x.resource_type == "dataset"}
+    deleted_tables = {x.resource_id for x in deleted if x.resource_type == "table"}
+
+    return pa.Table.from_pylist(
+        [
+            x
+            for x in inventory.to_pylist()
+            if x["dataset_id"] not in deleted_datasets
+            and not (
+                x["resource_type"] == "table"
+                and f"{x['dataset_id']}.{x['name']}" in deleted_tables
+            )
+        ],
+        schema=INVENTORY_SCHEMA,
+    )
+
+
+def load_inventory(path: str) -> Optional[pa.Table]:
+    """Return the inventory stored at `path`, `None` if there is none"""
+
+    try:
+        return pq.read_table(path, schema=INVENTORY_SCHEMA)
+    except (FileNotFoundError, pa.ArrowInvalid) as e:
+        logging.info(f"{e=}")
+        return None
+
+
+def save_inventory(inventory: pa.Table, path: str) -> None:
+    """Store an inventory as a Parquet file"""
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(path).with_suffix(".tmp")
+    pq.write_table(inventory, tmp_path)
+    tmp_path.replace(path)
+
+
+def summarise_plan(plan: List[PlannedDeletion]) -> Mapping[str, int]:
+    """Return the number of planned deletions per reason"""
+
+    return {
+        reason: len([x for x in plan if x.reason == reason])
+        for reason in ["cicd", "orphaned", "empty"]
+    }
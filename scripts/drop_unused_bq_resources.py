@@ -1,99 +1,202 @@
 import argparse
-import json
 import logging
-from pathlib import Path
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, NamedTuple, Optional
 
+from bq_inventory import (
+    PlannedDeletion,
+    diff_inventories,
+    get_manifest_tables,
+    load_inventory,
+    plan_cleanup,
+    prune_inventory,
+    save_inventory,
+    summarise_plan,
+    take_inventory,
+)
+from google.api_core.exceptions import Forbidden, TooManyRequests
+from google.cloud import bigquery
+from manifest_loader import load_manifest
 from utils import download_manifest_json, get_gcp_auth_clients, set_logging_options
 
+# Reasons BigQuery returns with a 403 when a rate limit or quota is exceeded
+QUOTA_ERROR_REASONS = {"rateLimitExceeded", "quotaExceeded"}
 
-def drop_cicd_datasets(environment: str, dataset_pattern: str) -> None:
-    """DROP datasets that that start with a specified pattern."""
 
-    # Determine relevant datasets/schemas
-    client = get_gcp_auth_clients(environment)["bigquery"]
-    query = f"""
-        SELECT
-            schema_name
-        FROM `{client.project}.INFORMATION_SCHEMA.SCHEMATA`
-        WHERE
-            schema_name LIKE "{dataset_pattern}%"
+class DeletionOutcome(NamedTuple):
+    """The result of deleting a single resource, `status` is one of "deleted", "planned" or "failed"."""
+
+    resource: str
+    status: str
+    duration: float
+    attempts: int = 0
+    error: Optional[str] = None
+
+
+class AdaptiveBackoff:
     """
-    query_job = client.query(query)
-    filtered_datasets = [row.schema_name for row in query_job]
-    logging.info(f"Found {len(filtered_datasets)} matching datasets.")
-
-    # Delete datasets
-    for dataset in filtered_datasets:
-        logging.info(f"Deleting {client.project}.{dataset}...")
-        client.delete_dataset(
-            f"{client.project}.{dataset}", delete_contents=True, not_found_ok=True
-        )
+    Delay shared by all workers deleting resources in a project.
 
+    Every quota error doubles the delay (up to `max_delay`) that each worker waits before its next request, every
+    successful request halves it again. Workers therefore slow down together when BigQuery starts rejecting
+    requests and speed back up once it accepts them.
+    """
 
-def drop_empty_datasets(environment: str) -> None:
-    """DROP datasets that are empty."""
+    def __init__(self, initial_delay: float = 1.0, max_delay: float = 64.0) -> None:
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self._lock = threading.Lock()
 
-    client = get_gcp_auth_clients(environment)["bigquery"]
-    for dataset_id in list(client.list_datasets()):
-        if (
-            len(list(client.list_routines(dataset_id))) == 0
-            and len(list(client.list_tables(dataset_id))) == 0
-        ):
-            logging.info(
-                f"DROPping dataset {dataset_id.dataset_id} as it contains no routines or tables..."
-            )
-            client.delete_dataset(dataset_id, delete_contents=True, not_found_ok=True)
+    def wait(self) -> None:
+        with self._lock:
+            delay = self.delay
+        if delay > 0:
+            time.sleep(delay)
 
+    def on_quota_error(self) -> None:
+        with self._lock:
+            self.delay = min(max(self.delay * 2, self.initial_delay), self.max_delay)
+            logging.info(f"Quota error, backing off for {self.delay:.1f} seconds...")
 
-def drop_orphaned_dbt_tables(environment: str) -> None:
-    """DROP all tables that contain the "dbt" labek but are not in the manifest.json."""
+    def on_success(self) -> None:
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay >= self.initial_delay else 0.0
 
-    client = get_gcp_auth_clients(environment)["bigquery"]
-    download_manifest_json(
-        env=environment,
-        destination_file_name="./.state/manifest.json",
-        version="latest",
+
+def is_quota_error(e: Exception) -> bool:
+    """Return whether an error is caused by a BigQuery rate limit or quota"""
+
+    if isinstance(e, TooManyRequests):
+        return True
+
+    return isinstance(e, Forbidden) and any(
+        x.get("reason") in QUOTA_ERROR_REASONS for x in (e.errors or [])
     )
 
-    with Path("./.state/manifest.json").open() as f:
-        manifest_json = json.load(f)
-
-    latest_dbt_tables = [
-        f"{v['schema']}.{v['name']}"
-        for k, v in manifest_json["nodes"].items()
-        if v["resource_type"] == "model"
-    ]
-    logging.info(f"Found {len(latest_dbt_tables)} tables in latest manifest.json...")
-
-    logging.info("Searching for tables with tag 'created_by' == 'dbt'...")
-    bq_tables_with_dbt_label: List[str] = []
-    client = get_gcp_auth_clients(environment)["bigquery"]
-    for dataset_id in list(client.list_datasets()):
-        for table_id in client.list_tables(dataset_id):
-            table = client.get_table(table_id)
-            if table.labels:
-                bq_tables_with_dbt_label.extend(
-                    table_id
-                    for label, value in table.labels.items()
-                    if label == "created_by" and value == "dbt"
+
+def delete_resources(
+    resources: List[str],
+    delete: Callable[[str], None],
+    dry_run: bool = False,
+    max_workers: int = 8,
+    tries: int = 6,
+    backoff: Optional[AdaptiveBackoff] = None,
+) -> List[DeletionOutcome]:
+    """
+    Delete resources concurrently and return an outcome per resource, in the order of `resources`.
+
+    Quota errors are retried up to `tries` times with `backoff`, other errors fail only that resource. If `dry_run`
+    is set nothing is deleted and every resource is "planned".
+
+    Args:
+        resources (List[str]): IDs of the resources to delete.
+        delete (Callable[[str], None]): Deletes a resource, called with its ID.
+        dry_run (bool): Plan the deletions without deleting anything.
+        max_workers (int): Maximum number of deletions that run at once.
+        tries (int): Maximum number of attempts per resource.
+        backoff (AdaptiveBackoff, optional): Delay shared by all workers, defaults to a new `AdaptiveBackoff`.
+    """
+
+    if dry_run:
+        for resource in resources:
+            logging.info(f"Would DROP {resource}...")
+        return [DeletionOutcome(x, "planned", 0.0) for x in resources]
+
+    backoff = backoff or AdaptiveBackoff()
+
+    def delete_with_backoff(resource: str) -> DeletionOutcome:
+        start_time = time.monotonic()
+        for attempt in range(1, tries + 1):
+            backoff.wait()
+            try:
+                logging.info(f"DROPping {resource}...")
+                delete(resource)
+                backoff.on_success()
+                return DeletionOutcome(
+                    resource, "deleted", time.monotonic() - start_time, attempt
+                )
+            except (
+                Exception
+            ) as e:  # A failed deletion should never stop other deletions
+                if is_quota_error(e) and attempt < tries:
+                    backoff.on_quota_error()
+                    continue
+                logging.info(f"Failed to DROP {resource}: {e=}")
+                return DeletionOutcome(
+                    resource,
+                    "failed",
+                    time.monotonic() - start_time,
+                    attempt,
+                    f"{type(e).__name__}: {e}",
                 )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(delete_with_backoff, resources))
+
+
+def log_deletion_summary(outcomes: List[DeletionOutcome]) -> None:
+    """Log the timing of every deletion followed by the number of resources per status and the failures"""
+
+    for outcome in sorted(outcomes, key=lambda x: x.duration, reverse=True):
+        logging.info(
+            f"{outcome.resource}: {outcome.status} in {outcome.duration:.2f} seconds ({outcome.attempts} attempts)..."
+        )
+
+    summary = {
+        status: len([x for x in outcomes if x.status == status])
+        for status in ["deleted", "planned", "failed"]
+    }
     logging.info(
-        f"Found {len(bq_tables_with_dbt_label)} tables with tag 'created_by' == 'dbt'..."
+        f"Deletion outcomes: {summary}, {sum(x.duration for x in outcomes):.2f} seconds in total"
     )
+    for outcome in outcomes:
+        if outcome.status == "failed":
+            logging.info(f"{outcome.resource}: {outcome.error}")
 
-    orphaned_dbt_tables = [
-        x
-        for x in bq_tables_with_dbt_label
-        if f"{x.dataset_id}.{x.table_id}" not in latest_dbt_tables
-    ]
-    logging.info(f"Found {len(orphaned_dbt_tables)} orphaned tables...")
-
-    for i in orphaned_dbt_tables:
-        logging.info(f"DROPping table {i.project}.{i.dataset_id}.{i.table_id}...")
-        client.delete_table(
-            f"{i.project}.{i.dataset_id}.{i.table_id}", not_found_ok=True
-        )
+
+def apply_cleanup_plan(
+    client: bigquery.Client,
+    plan: List[PlannedDeletion],
+    dry_run: bool = False,
+    max_workers: int = 8,
+) -> List[DeletionOutcome]:
+    """
+    Delete the resources in a plan from `plan_cleanup`, see `delete_resources`.
+
+    Tables are deleted before datasets so datasets that only contained orphaned tables are empty when they are
+    deleted. Only CICD datasets are deleted with their contents, deleting an "empty" dataset fails if it is no
+    longer empty.
+    """
+
+    outcomes = delete_resources(
+        [
+            f"{client.project}.{x.resource_id}"
+            for x in plan
+            if x.resource_type == "table"
+        ],
+        delete=lambda table_id: client.delete_table(table_id, not_found_ok=True),
+        dry_run=dry_run,
+        max_workers=max_workers,
+    )
+
+    delete_contents = {
+        f"{client.project}.{x.resource_id}": x.reason == "cicd"
+        for x in plan
+        if x.resource_type == "dataset"
+    }
+    outcomes += delete_resources(
+        list(delete_contents),
+        delete=lambda dataset_id: client.delete_dataset(
+            dataset_id, delete_contents=delete_contents[dataset_id], not_found_ok=True
+        ),
+        dry_run=dry_run,
+        max_workers=max_workers,
+    )
+
+    return outcomes
 
 
 def main() -> None:
@@ -105,6 +208,26 @@ def main() -> None:
         "--dataset_pattern", help="Pattern of datasets to DROP.", required=True
     )
     parser.add_argument("--environment", help="The environment to use.", required=True)
+    parser.add_argument(
+        "--dry-run",
+        help="Log what would be DROPped without DROPping anything.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--location",
+        help="BigQuery region of the datasets.",
+        default="US",
+    )
+    parser.add_argument(
+        "--inventory_path",
+        help="Path of the inventory of the previous run, defaults to ./.state/bq_inventory_<environment>.parquet.",
+    )
+    parser.add_argument(
+        "--max_workers",
+        help="Maximum number of datasets or tables that are DROPped at once.",
+        default=8,
+        type=int,
+    )
     args = parser.parse_args()
 
     assert args.environment in [
@@ -112,11 +235,48 @@ def main() -> None:
         "stg",
     ], "Only prd and stg are valid inputs to `environment`."
 
-    drop_cicd_datasets(
-        environment=args.environment, dataset_pattern=args.dataset_pattern
+    client = get_gcp_auth_clients(args.environment)["bigquery"]
+    download_manifest_json(
+        env=args.environment,
+        destination_file_name="./.state/manifest.json",
+        version="latest",
+    )
+    manifest_tables = get_manifest_tables(load_manifest("./.state/manifest.json"))
+    logging.info(f"Found {len(manifest_tables)} tables in latest manifest.json...")
+
+    # Inventory, only datasets modified since the previous inventory are inspected
+    inventory_path = (
+        args.inventory_path or f"./.state/bq_inventory_{args.environment}.parquet"
     )
-    drop_orphaned_dbt_tables(environment=args.environment)
-    drop_empty_datasets(environment=args.environment)
+    previous_inventory = load_inventory(inventory_path)
+    inventory = take_inventory(
+        client, location=args.location, previous=previous_inventory
+    )
+    logging.info(f"{diff_inventories(previous_inventory, inventory)=}")
+
+    # Plan and apply
+    plan = plan_cleanup(
+        inventory, dataset_pattern=args.dataset_pattern, manifest_tables=manifest_tables
+    )
+    logging.info(f"Planned deletions: {summarise_plan(plan)}")
+    outcomes = apply_cleanup_plan(
+        client, plan, dry_run=args.dry_run, max_workers=args.max_workers
+    )
+    log_deletion_summary(outcomes)
+
+    if not args.dry_run:
+        deleted = {x.resource for x in outcomes if x.status == "deleted"}
+        save_inventory(
+            prune_inventory(
+                inventory,
+                [x for x in plan if f"{client.project}.{x.resource_id}" in deleted],
+            ),
+            inventory_path,
+        )
+
+    # Failed deletions do not stop the cleanup but should fail the job
+    failed = [x.resource for x in outcomes if x.status == "failed"]
+    assert not failed, f"Failed to DROP {len(failed)} resources: {failed}"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,243 @@
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import tracemalloc
+from array import array
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Mapping, Set, Tuple
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, it is only used to speed up parsing
+    orjson = None
+
+from utils import set_logging_options
+
+_manifest_cache: Dict[str, Tuple[Tuple[int, int], dict, "ManifestIndex"]] = {}
+_manifest_cache_lock = threading.Lock()
+
+
+class ManifestIndex:
+    """
+    Compact lookups over a parsed manifest.json.
+
+    - `relations`: model name to its database, schema, alias, relation name and `partition_by` config.
+    - `tags`: tag to the unique IDs of nodes with that tag.
+    - `resource_types`: resource type to unique IDs.
+    - Parent/child adjacency stored as offset and index arrays over `unique_ids` (CSR format), use `parents`,
+      `children` and `descendants` to query these.
+    """
+
+    def __init__(self, manifest: Mapping) -> None:
+        nodes = {
+            **manifest.get("nodes", {}),
+            **manifest.get("sources", {}),
+            **manifest.get("exposures", {}),
+            **manifest.get("metrics", {}),
+            **manifest.get("semantic_models", {}),
+            **manifest.get("saved_queries", {}),
+            **manifest.get("unit_tests", {}),
+        }
+
+        self.relations: Dict[str, Mapping[str, Any]] = {}
+        self.tags: Dict[str, List[str]] = {}
+        self.resource_types: Dict[str, List[str]] = {}
+        for unique_id, node in nodes.items():
+            self.resource_types.setdefault(node["resource_type"], []).append(unique_id)
+            for tag in node.get("tags", []):
+                self.tags.setdefault(tag, []).append(unique_id)
+            if node["resource_type"] == "model":
+                self.relations[node["name"]] = {
+                    "database": node["database"],
+                    "schema": node["schema"],
+                    "alias": node["alias"],
+                    "relation_name": node["relation_name"],
+                    "partition_by": node.get("config", {}).get("partition_by"),
+                }
+
+        self.unique_ids = list(
+            dict.fromkeys(list(nodes) + list(manifest.get("child_map", {})))
+        )
+        self.positions = {x: i for i, x in enumerate(self.unique_ids)}
+        self._child_offsets, self._child_indices = self._build_adjacency(
+            manifest.get("child_map", {})
+        )
+        self._parent_offsets, self._parent_indices = self._build_adjacency(
+            manifest.get("parent_map", {})
+        )
+
+    def _build_adjacency(
+        self, adjacency_map: Mapping[str, List[str]]
+    ) -> Tuple[array, array]:
+        offsets = array("l", [0])
+        indices = array("l")
+        for unique_id in self.unique_ids:
+            indices.extend(
+                self.positions[x]
+                for x in adjacency_map.get(unique_id, [])
+                if x in self.positions
+            )
+            offsets.append(len(indices))
+        return offsets, indices
+
+    def children(self, unique_id: str) -> List[str]:
+        """Return the direct children of a node"""
+
+        position = self.positions[unique_id]
+        return [
+            self.unique_ids[x]
+            for x in self._child_indices[
+                self._child_offsets[position] : self._child_offsets[position + 1]
+            ]
+        ]
+
+    def descendants(self, unique_ids: Iterable[str]) -> Set[str]:
+        """Return the nodes and all their descendants, i.e. the `+` graph operator"""
+
+        seen = bytearray(len(self.unique_ids))
+        stack = [self.positions[x] for x in unique_ids if x in self.positions]
+        for position in stack:
+            seen[position] = 1
+        while stack:
+            position = stack.pop()
+            for child in self._child_indices[
+                self._child_offsets[position] : self._child_offsets[position + 1]
+            ]:
+                if not seen[child]:
+                    seen[child] = 1
+                    stack.append(child)
+
+        return {self.unique_ids[i] for i, x in enumerate(seen) if x}
+
+    def parents(self, unique_id: str) -> List[str]:
+        """Return the direct parents of a node"""
+
+        position = self.positions[unique_id]
+        return [
+            self.unique_ids[x]
+            for x in self._parent_indices[
+                self._parent_offsets[position] : self._parent_offsets[position + 1]
+            ]
+        ]
+
+
+def get_manifest_index(path: str = "./target/manifest.json") -> ManifestIndex:
+    """Return the index of a manifest.json file, see `load_manifest` for how this is cached"""
+
+    return _load_and_index(path)[1]
+
+
+def load_manifest(path: str = "./target/manifest.json") -> dict:
+    """
+    Load a manifest.json file.
+
+    The parsed manifest (and its index) is cached until the file's modification time or size changes, so every
+    caller in a process shares one copy. The returned dictionary must not be modified.
+    """
+
+    return _load_and_index(path)[0]
+
+
+def _load_and_index(path: str) -> Tuple[dict, ManifestIndex]:
+    resolved_path = str(Path(path).resolve())
+    stat = Path(resolved_path).stat()
+    version = (stat.st_mtime_ns, stat.st_size)
+
+    with _manifest_cache_lock:
+        cached = _manifest_cache.get(resolved_path)
+        if cached is None or cached[0] != version:
+            start_time = time.monotonic()
+            with Path(resolved_path).open("rb") as f:
+                if orjson is not None:
+                    manifest = orjson.loads(f.read())
+                else:
+                    manifest = json.load(f)
+            index = ManifestIndex(manifest)
+            logging.debug(
+                f"Loaded and indexed {path} in {time.monotonic() - start_time:.2f} seconds..."
+            )
+            cached = (version, manifest, index)
+            _manifest_cache[resolved_path] = cached
+
+    return cached[1], cached[2]
+
+
+def build_synthetic_manifest(num_nodes: int) -> dict:
+    """Build a manifest.json-like dictionary with `num_nodes` models, each with up to 3 parents"""
+
+    random.seed(42)
+    unique_ids = [f"model.beyond_basics.model_{i}" for i in range(num_nodes)]
+    parent_map: Dict[str, List[str]] = {
+        x: random.sample(unique_ids[:i], min(i, 3)) for i, x in enumerate(unique_ids)
+    }
+    child_map: Dict[str, List[str]] = {x: [] for x in unique_ids}
+    for unique_id, parents in parent_map.items():
+        for parent in parents:
+            child_map[parent].append(unique_id)
+
+    return {
+        "nodes": {
+            x: {
+                "unique_id": x,
+                "name": x.split(".")[-1],
+                "resource_type": "model",
+                "database": "beyond-basics-prd",
+                "schema": f"marts_{i % 20}",
+                "alias": x.split(".")[-1],
+                "relation_name": f"`beyond-basics-prd`.`marts_{i % 20}`.`{x.split('.')[-1]}`",
+                "tags": [f"tag_{i % 10}"],
+                "raw_code": "select 1" * 50,
+                "depends_on": {"macros": [], "nodes": parent_map[x]},
+            }
+            for i, x in enumerate(unique_ids)
+        },
+        "parent_map": parent_map,
+        "child_map": child_map,
+    }
+
+
+def main() -> None:
+    set_logging_options()
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark loading and indexing a synthetic manifest.json."
+    )
+    parser.add_argument(
+        "--num_nodes", help="Number of nodes in the manifest.", type=int, default=10000
+    )
+    args = parser.parse_args()
+
+    path = Path(f"./.state/synthetic_manifest_{args.num_nodes}.json")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("w") as f:
+        json.dump(build_synthetic_manifest(args.num_nodes), f)
+    logging.info(f"Wrote {path} ({path.stat().st_size / 1024**2:.1f} MB)...")
+
+    tracemalloc.start()
+    start_time = time.monotonic()
+    index = get_manifest_index(str(path))
+    load_time = time.monotonic() - start_time
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    logging.info(
+        f"Loaded and indexed {args.num_nodes} nodes in {load_time:.2f} seconds, peak memory {peak_memory / 1024**2:.1f} MB..."
+    )
+
+    start_time = time.monotonic()
+    get_manifest_index(str(path))
+    logging.info(
+        f"Cached lookup took {(time.monotonic() - start_time) * 1000:.2f} ms..."
+    )
+
+    start_time = time.monotonic()
+    descendants = index.descendants([index.unique_ids[0]])
+    logging.info(
+        f"Found {len(descendants)} descendants of {index.unique_ids[0]} in {(time.monotonic() - start_time) * 1000:.2f} ms..."
+    )
+
+
+if __name__ == "__main__":
+    main()
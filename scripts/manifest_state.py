@@ -0,0 +1,288 @@
+import logging
+from typing import Iterable, List, Mapping, Optional, Set
+
+from manifest_loader import ManifestIndex, get_manifest_index, load_manifest
+
+# Config keys that dbt does not compare for `state:modified.configs`, schema/database/alias are compared separately
+# as part of `state:modified.relation`
+NODE_CONFIG_EXCLUDED_KEYS = {"alias", "database", "group", "schema", "tags"}
+
+# For tests dbt only compares the config keys that change how a test is evaluated
+TEST_CONFIG_COMPARED_KEYS = {
+    "error_if",
+    "fail_calc",
+    "limit",
+    "severity",
+    "store_failures",
+    "store_failures_as",
+    "warn_if",
+    "where",
+}
+
+# Keys of manifest.json that contain nodes that can be selected by dbt
+SELECTABLE_MANIFEST_KEYS = [
+    "nodes",
+    "sources",
+    "exposures",
+    "metrics",
+    "semantic_models",
+    "saved_queries",
+    "unit_tests",
+]
+
+
+class ManifestStateComparison:
+    """
+    Compare two manifest.json files the same way dbt's `state:modified` selector does, without parsing the project.
+
+    Nodes are modified when they are new or when their body, config, persisted descriptions, relation, contract
+    or upstream macros differ from the previous manifest. `state:modified+` uses the `ManifestIndex` of the current
+    manifest.
+
+    Args:
+        previous_manifest (dict): The manifest passed to dbt via `--state`.
+        current_manifest (dict): The manifest of the project being compared.
+        current_index (ManifestIndex, optional): Index of `current_manifest`, built if not provided.
+    """
+
+    def __init__(
+        self,
+        previous_manifest: dict,
+        current_manifest: dict,
+        current_index: Optional[ManifestIndex] = None,
+    ) -> None:
+        self.previous_manifest = previous_manifest
+        self.current_manifest = current_manifest
+        self.previous_nodes = {
+            k: v
+            for key in SELECTABLE_MANIFEST_KEYS
+            for k, v in previous_manifest.get(key, {}).items()
+        }
+        self.current_nodes = {
+            k: v
+            for key in SELECTABLE_MANIFEST_KEYS
+            for k, v in current_manifest.get(key, {}).items()
+        }
+        self.index = current_index or ManifestIndex(current_manifest)
+
+        self._modified: Optional[Set[str]] = None
+        self._modified_macros: Optional[Set[str]] = None
+
+    def downstream(self, unique_ids: Iterable[str]) -> Set[str]:
+        """Return the nodes and all their descendants, i.e. the `+` graph operator"""
+
+        return self.index.descendants(unique_ids) & self.current_nodes.keys()
+
+    def modified(self) -> Set[str]:
+        """Return the unique IDs of all nodes selected by `state:modified`"""
+
+        if self._modified is None:
+            self._modified = {
+                unique_id
+                for unique_id, node in self.current_nodes.items()
+                if not _same_contents(node, self.previous_nodes.get(unique_id))
+                or self._macros_modified(node)
+            }
+            logging.debug(f"{len(self._modified)} nodes are modified...")
+
+        return self._modified
+
+    def select(
+        self,
+        downstream: bool = False,
+        exclude_modified: bool = False,
+        resource_types: Optional[Iterable[str]] = None,
+        package_name: Optional[str] = None,
+    ) -> List[str]:
+        """
+        Return sorted unique IDs, equivalent to `dbt ls --select state:modified[+] [--exclude state:modified]`
+
+        Args:
+            downstream (bool): Select `state:modified+` instead of `state:modified`.
+            exclude_modified (bool): Exclude the directly modified nodes, i.e. `--exclude state:modified`.
+            resource_types (Iterable[str], optional): Equivalent to `--resource-type`.
+            package_name (str, optional): Equivalent to intersecting with `package:<package_name>`.
+        """
+
+        selected = self.downstream(self.modified()) if downstream else self.modified()
+        if exclude_modified:
+            selected = selected - self.modified()
+        if resource_types is not None:
+            selected = {
+                x
+                for x in selected
+                if self.current_nodes[x]["resource_type"] in set(resource_types)
+            }
+        if package_name is not None:
+            selected = {
+                x
+                for x in selected
+                if self.current_nodes[x]["package_name"] == package_name
+            }
+
+        return sorted(selected)
+
+    def _macros_modified(self, node: Mapping) -> bool:
+        """Whether any macro the node depends on, directly or via other macros, is modified"""
+
+        if self._modified_macros is None:
+            previous_macros = self.previous_manifest["macros"]
+            current_macros = self.current_manifest["macros"]
+            self._modified_macros = {
+                k
+                for k, v in current_macros.items()
+                if k not in previous_macros
+                or v["macro_sql"] != previous_macros[k]["macro_sql"]
+            } | {k for k in previous_macros if k not in current_macros}
+
+        if not self._modified_macros:
+            return False
+
+        visited: Set[str] = set()
+        stack = list(node.get("depends_on", {}).get("macros", []))
+        while stack:
+            macro_id = stack.pop()
+            if macro_id in visited:
+                continue
+            visited.add(macro_id)
+            if macro_id in self._modified_macros:
+                return True
+            macro = self.current_manifest["macros"].get(macro_id)
+            if macro is not None:
+                stack.extend(macro["depends_on"]["macros"])
+
+        return False
+
+
+def load_manifest_state_comparison(
+    previous_manifest_path: str, current_manifest_path: str
+) -> ManifestStateComparison:
+    """Load two manifest.json files and return their comparison"""
+
+    return ManifestStateComparison(
+        load_manifest(previous_manifest_path),
+        load_manifest(current_manifest_path),
+        current_index=get_manifest_index(current_manifest_path),
+    )
+
+
+def _same_config(node: Mapping, previous_node: Mapping) -> bool:
+    current_config = node.get("unrendered_config", {})
+    previous_config = previous_node.get("unrendered_config", {})
+
+    if node["resource_type"] == "test":
+        keys = TEST_CONFIG_COMPARED_KEYS
+    elif node["resource_type"] in {"exposure", "source"}:
+        keys = set(current_config) | set(previous_config)
+    else:
+        keys = (set(current_config) | set(previous_config)) - NODE_CONFIG_EXCLUDED_KEYS
+
+    return all(
+        (key in current_config) == (key in previous_config)
+        and current_config.get(key) == previous_config.get(key)
+        for key in keys
+    )
+
+
+def _same_contract(node: Mapping, previous_node: Mapping) -> bool:
+    contract = node.get("contract", {})
+    previous_contract = previous_node.get("contract", {})
+
+    if not contract.get("enforced") and not previous_contract.get("enforced"):
+        return True
+
+    return bool(contract.get("enforced")) == bool(
+        previous_contract.get("enforced")
+    ) and contract.get("checksum") == previous_contract.get("checksum")
+
+
+def _same_contents(node: Mapping, previous_node: Optional[Mapping]) -> bool:
+    """Mirrors the `same_contents` methods of dbt's node classes"""
+
+    resource_type = node["resource_type"]
+
+    if resource_type == "exposure":
+        # New exposures are not "modified" in dbt
+        return previous_node is None or (
+            node["fqn"] == previous_node["fqn"]
+            and node["type"] == previous_node["type"]
+            and node["owner"] == previous_node["owner"]
+            and node.get("maturity") == previous_node.get("maturity")
+            and node.get("url") == previous_node.get("url")
+            and node.get("description") == previous_node.get("description")
+            and node.get("label") == previous_node.get("label")
+            and set(node["depends_on"]["nodes"])
+            == set(previous_node["depends_on"]["nodes"])
+            and _same_config(node, previous_node)
+        )
+    elif resource_type == "source":
+        # New sources are not "modified" in dbt
+        return previous_node is None or (
+            all(
+                node.get(key) == previous_node.get(key)
+                for key in [
+                    "database",
+                    "schema",
+                    "identifier",
+                    "fqn",
+                    "quoting",
+                    "freshness",
+                    "loaded_at_field",
+                    "external",
+                ]
+            )
+            and _same_config(node, previous_node)
+        )
+    elif resource_type == "unit_test":
+        return previous_node is not None and node.get("checksum") == previous_node.get(
+            "checksum"
+        )
+    elif resource_type in {"metric", "semantic_model", "saved_query"}:
+        # Not used in this project, compare the full definitions rather than dbt's field by field comparison
+        return previous_node is None or {
+            k: v for k, v in node.items() if k != "created_at"
+        } == {k: v for k, v in previous_node.items() if k != "created_at"}
+
+    if previous_node is None:
+        return False
+
+    if resource_type == "seed":
+        same_body = node["checksum"] == previous_node["checksum"]
+    else:
+        same_body = node.get("raw_code") == previous_node.get("raw_code")
+
+    persist_docs = node["config"].get("persist_docs") or {}
+    same_persisted_description = (
+        not persist_docs.get("relation")
+        or node.get("description") == previous_node.get("description")
+    ) and (
+        not persist_docs.get("columns")
+        or {k: v.get("description") for k, v in node.get("columns", {}).items()}
+        == {
+            k: v.get("description") for k, v in previous_node.get("columns", {}).items()
+        }
+    )
+
+    same_database_representation = all(
+        node.get("unrendered_config", {}).get(key)
+        == previous_node.get("unrendered_config", {}).get(key)
+        for key in ["database", "schema", "alias"]
+    )
+
+    same_contents = (
+        same_body
+        and _same_config(node, previous_node)
+        and same_persisted_description
+        and node["fqn"] == previous_node["fqn"]
+        and same_database_representation
+    )
+    if resource_type == "model":
+        same_contents = (
+            same_contents
+            and _same_contract(node, previous_node)
+            and node.get("latest_version") == previous_node.get("latest_version")
+            and node.get("access") == previous_node.get("access")
+            and node.get("deprecation_date") == previous_node.get("deprecation_date")
+        )
+
+    return same_contents
@@ -1,25 +1,40 @@
 import argparse
+import concurrent.futures
+import datetime
 import json
 import logging
 import os
-from multiprocessing.pool import ThreadPool
-from pathlib import Path
-from typing import List, Mapping
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Mapping, Optional, Set, Tuple, Union
 
 import duckdb
 import pyarrow as pa
+import pyarrow.compute as pc
 import pytablewriter
 import yaml
-from google.api_core.exceptions import BadRequest, NotFound
+from google.api_core.exceptions import BadRequest, GoogleAPICallError, NotFound
+from google.cloud import bigquery
 from jinja2 import Template
-from retry import retry
+from manifest_loader import get_manifest_index, load_manifest
+from manifest_state import ManifestStateComparison
+from monitor_baselines import (
+    NON_DETERMINISTIC_FUNCTIONS,
+    MonitorBaselineCache,
+    PartitionAggregateStore,
+    get_table_partitions,
+)
+from monitor_generator import generate_monitors
+from monitor_history import MonitorHistoryStore
+from monitor_scheduler import MonitorCancelledError, run_monitors
 from utils import (
+    GitHubPRCommentIndex,
     ManifestInitRunError,
-    delete_github_pr_bot_comments,
     download_manifest_json,
+    get_dbt_manifest_json,
     get_gcp_auth_clients,
-    run_dbt_command,
-    send_github_pr_comment,
     set_logging_options,
 )
 
@@ -43,21 +58,71 @@ def parse_command_line_args() -> tuple:
         required=True,
         type=str,
     )
+    parser.add_argument(
+        "--monitor_execution_mode",
+        help="Run all monitors as one BigQuery job per environment (batched) or one job per monitor and environment (per_monitor)",
+        choices=["batched", "per_monitor"],
+        default="batched",
+        type=str,
+    )
+    parser.add_argument(
+        "--monitor_concurrency",
+        help="Maximum number of monitors that run at once",
+        default=8,
+        type=int,
+    )
+    parser.add_argument(
+        "--monitor_concurrency_per_project",
+        help="Maximum number of monitors that query a GCP project at once",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--monitor_timeout",
+        help="Deadline in seconds for each monitor, monitors that exceed this are cancelled",
+        default=600,
+        type=int,
+    )
+    parser.add_argument(
+        "--monitor_baseline_max_age",
+        help="Reuse stg and prd results from the monitor history that are less than this many hours old, 0 to always query",
+        default=0,
+        type=int,
+    )
     args = parser.parse_args()
 
     dbt_dataset = args.dbt_dataset
     pull_request_id = args.pull_request_id
     target_branch = args.target_branch
+    monitor_execution_mode = args.monitor_execution_mode
+    monitor_concurrency = args.monitor_concurrency
+    monitor_concurrency_per_project = args.monitor_concurrency_per_project
+    monitor_timeout = args.monitor_timeout
+    monitor_baseline_max_age = args.monitor_baseline_max_age
 
     logging.info(f"{dbt_dataset=}")
     logging.info(f"{pull_request_id=}")
     logging.info(f"{target_branch=}")
-
-    return (dbt_dataset, pull_request_id, target_branch)
+    logging.info(f"{monitor_execution_mode=}")
+    logging.info(f"{monitor_concurrency=}")
+    logging.info(f"{monitor_concurrency_per_project=}")
+    logging.info(f"{monitor_timeout=}")
+    logging.info(f"{monitor_baseline_max_age=}")
+
+    return (
+        dbt_dataset,
+        pull_request_id,
+        target_branch,
+        monitor_execution_mode,
+        monitor_concurrency,
+        monitor_concurrency_per_project,
+        monitor_timeout,
+        monitor_baseline_max_age,
+    )
 
 
 def compare_manifests_and_comment_impacted_models(
-    env: str, manifest_file_name: str, pull_request_id: int
+    env: str, manifest_file_name: str, pr_comments: GitHubPRCommentIndex
 ) -> None:
     """Download the latest manifest for the env, compare to current manifest.json, add a comment to the PR with impacted models"""
 
@@ -65,32 +130,24 @@ def compare_manifests_and_comment_impacted_models(
         env=env, destination_file_name=manifest_file_name, version="latest"
     )
 
-    directly_impacted_models = sorted(
-        run_dbt_command(
-            f"dbt --quiet ls --select state:modified --state ./.state --resource-type model --target {env}"
-        )
+    manifest_json = get_dbt_manifest_json(target=env)
+    comparison = ManifestStateComparison(
+        load_manifest(manifest_file_name), manifest_json
     )
+
+    directly_impacted_models = comparison.select(resource_types=["model"])
     logging.info(f"{directly_impacted_models=}")
     direct_md = "\n".join([f'| {x.split(".")[-1]} |' for x in directly_impacted_models])
 
-    indirectly_impacted_models = sorted(
-        run_dbt_command(
-            f"dbt --quiet ls --select state:modified+ --exclude state:modified --state ./.state --resource-type model --target {env}"
-        )
+    indirectly_impacted_models = comparison.select(
+        downstream=True, exclude_modified=True, resource_types=["model"]
     )
     logging.info(f"{indirectly_impacted_models=}")
     indirect_md = "\n".join(
         [f'| {x.split(".")[-1]} |' for x in indirectly_impacted_models]
     )
 
-    with Path("./target/manifest.json").open() as f:
-        manifest_json = json.load(f)
-
-    impacted_exposures = sorted(
-        run_dbt_command(
-            f"dbt --quiet ls --select state:modified+ --state ./.state --resource-type exposure --target {env}"
-        )
-    )
+    impacted_exposures = comparison.select(downstream=True, resource_types=["exposure"])
     logging.info(f"{impacted_exposures=}")
     emoji_map = {
         "analysis": "🕵",
@@ -102,7 +159,7 @@ def compare_manifests_and_comment_impacted_models(
 
     exposures_md_raw = []
     for exposure in impacted_exposures:
-        exposure_metadata = manifest_json["exposures"][exposure.replace(":", ".")]
+        exposure_metadata = manifest_json["exposures"][exposure]
         exposures_md_raw.append(
             f"{emoji_map[exposure_metadata['type']]} {exposure_metadata['type'].upper()}|{exposure_metadata['label']}|{exposure_metadata['owner']['name']}|"
         )
@@ -129,164 +186,1258 @@ Impacted exposures:
 | - | - | - |
 {exposures_md}"""
     logging.debug(f"{impacted_markdown=}")
-    delete_github_pr_bot_comments(
-        pull_request_id=pull_request_id,
-        env=env,
-        identifier_text="Outputs from `manifest.json` comparison:",
-    )
+    identifier_text = "Outputs from `manifest.json` comparison:"
     if len(directly_impacted_models) > 0 or len(indirectly_impacted_models) > 0:
-        send_github_pr_comment(pull_request_id, impacted_markdown)
+        pr_comments.upsert(identifier_text, impacted_markdown)
+    else:
+        pr_comments.delete(identifier_text)
+
+
+MONITOR_BATCH_SCRIPT_TEMPLATE = """DECLARE monitor_results ARRAY<STRUCT<monitor_index INT64, result STRING, error STRING>> DEFAULT [];
+{% for query in queries %}
+BEGIN
+  SET monitor_results = ARRAY_CONCAT(monitor_results, ARRAY(
+    SELECT AS STRUCT {{ loop.index0 }} AS monitor_index, TO_JSON_STRING(t) AS result, CAST(NULL AS STRING) AS error
+    FROM (
+{{ query }}
+    ) AS t
+  ));
+EXCEPTION WHEN ERROR THEN
+  SET monitor_results = ARRAY_CONCAT(monitor_results, [STRUCT({{ loop.index0 }} AS monitor_index, CAST(NULL AS STRING) AS result, @@error.message AS error)]);
+END;
+{% endfor %}
+SELECT monitor_index, result, error FROM UNNEST(monitor_results);
+"""
+
+# Monitors query each environment with a service account, CICD datasets are in the stg project
+# Compares every metric to its CICD value, the percentage difference is used to format the data for a GitHub comment
+FORMAT_RESULTS_QUERY = """
+WITH compared AS (
+    SELECT
+        long_table.table_name,
+        long_table.metric_index,
+        long_table.value,
+        long_table.tolerance,
+        ROUND(((long_table.value / cicd.value) - 1) * 100, 1) AS diff_pct
+    FROM long_table
+    LEFT JOIN long_table AS cicd
+        ON long_table.metric_index = cicd.metric_index
+        AND cicd.table_name = 'cicd'
+),
+
+formatted AS (
+    SELECT
+        table_name,
+        metric_index,
+        CASE
+            WHEN table_name = 'cicd' THEN
+                CASE
+                    WHEN value % 1 = 0 THEN CAST(ROUND(value, 0) AS VARCHAR)
+                    ELSE CAST(ROUND(value, 3) AS VARCHAR)
+                END
+            ELSE
+                CASE
+                    WHEN ABS(diff_pct) <= 0.5 + tolerance THEN '🟢'
+                    WHEN ABS(diff_pct) < 1 + tolerance THEN '🟡'
+                    ELSE '🔴'
+                END
+                || ' '
+                || ROUND(value, 0)
+                || ' ('
+                || ROUND(diff_pct, 2)
+                || '%)'
+        END AS cell,
+        CASE
+            WHEN table_name = 'cicd' THEN 1
+            WHEN table_name = 'stg' THEN 2
+            WHEN table_name = 'prd' THEN 3
+        END AS table_order
+    FROM compared
+)
 
+SELECT
+    metric_index,
+    LIST(table_name ORDER BY table_order) AS table_names,
+    LIST(cell ORDER BY table_order) AS cells
+FROM formatted
+GROUP BY metric_index
+ORDER BY metric_index
+"""
+# Metrics are compared as decimals, this holds every INT64 and NUMERIC value exactly
+FORMAT_RESULTS_VALUE_TYPE = pa.decimal128(38, 9)
+MONITOR_ENVS = ["cicd", "stg", "prd"]
+# Keys a monitor in mart_monitor_queries.yml can have in addition to monitor_name, model_name and query
+MONITOR_OPTIONAL_KEYS = [
+    "max_bytes_processed",
+    "partition_lookback_days",
+    "approximate",
+]
+MONITOR_SERVICE_ACCOUNTS = {"cicd": "stg", "stg": "stg", "prd": "prd"}
+
+# Approximate monitors widen the green/yellow thresholds of approximate metrics by these percentages. HLL_COUNT.INIT
+# (precision 15) has a relative error of ~0.57%, the difference of two sketches is within ~1.6% 95% of the time.
+# APPROX_QUANTILES has a bounded rank error, not value error, so a fixed tolerance is used.
+APPROXIMATE_METRIC_TOLERANCES = {"hll_count": 1.6, "approx_quantiles": 1.0}
+HLL_SKETCH_SUFFIX = "__hll_sketch"
+
+# Metrics that are a single one of these aggregates can be summed across partitions, e.g. not `count(distinct ...)`,
+# `min(...)`, `avg(...)` or ratios such as `sum(a) / count(*)`
+ADDITIVE_AGGREGATES = re.compile(
+    r"(count\s*\(\s*\*\s*\)|(count|countif|sum)\s*\((?!\s*distinct\b))", re.IGNORECASE
+)
+
+# Reused by all monitors, each call to `format_results` uses its own cursor
+_duckdb_connection = duckdb.connect(database=":memory:")
 
-@retry(tries=3, delay=5)
-def fetch_results_from_bigquery(
-    query_template: str, cicd_dataset: str, model_name: str
-) -> list:
-    """Run query across all environments in BigQuery and return results"""
 
-    # Fetch dataset from manifest.json
-    with open(f"./target/manifest.json") as f:
-        manifest_json = json.load(f)
+def build_monitor_batch_script(queries: List[str]) -> str:
+    """
+    Combine rendered monitor queries into one BigQuery script.
 
-    for k, v in manifest_json["nodes"].items():
-        if k.split(".")[-1] == model_name:
-            dataset_id = v["schema"]
+    Each query runs in its own `BEGIN...EXCEPTION` block so an invalid query (e.g. a column that does not exist yet
+    in prd) only returns an error for that monitor. Rows are returned as JSON strings as monitors have different
+    columns.
+    """
 
-    results = []
-    dataset_matrix = {
-        "cicd": cicd_dataset,
-        "other_envs": dataset_id,
+    return Template(MONITOR_BATCH_SCRIPT_TEMPLATE).render(queries=queries)
+
+
+def build_approximate_monitor_query(
+    query_template: str, keep_sketches: bool = False
+) -> Tuple[str, Dict[str, float]]:
+    """
+    Rewrite the exact distinct counts of a monitor query as HyperLogLog++ sketches.
+
+    Every `count(distinct <expr>) as <alias>` becomes `hll_count.extract(hll_count.init(<expr>)) as <alias>`. If
+    `keep_sketches` is set the sketch is also returned as `<alias>__hll_sketch`, these can be merged across
+    partitions with `hll_count.merge` without scanning the partitions again. Metrics that already use
+    `approx_quantiles` are left as is.
+
+    Returns the rewritten query and the tolerance (in percent) of each approximate metric.
+    """
+
+    count_distinct = re.compile(r"count\s*\(\s*distinct\s+", re.IGNORECASE)
+    alias = re.compile(r"\s+as\s+(\w+)", re.IGNORECASE)
+
+    parts = []
+    tolerances: Dict[str, float] = {}
+    position = 0
+    while (match := count_distinct.search(query_template, position)) is not None:
+        # Find the closing parenthesis of count(, the expression can contain parentheses itself
+        end = _closing_parenthesis(query_template, match.end())
+        expression = query_template[match.end() : end - 1].strip()
+
+        alias_match = alias.match(query_template, end)
+        assert (
+            alias_match is not None
+        ), f"`count(distinct {expression})` must have an alias to be approximated."
+        tolerances[alias_match.group(1)] = APPROXIMATE_METRIC_TOLERANCES["hll_count"]
+
+        parts.append(query_template[position : match.start()])
+        parts.append(f"hll_count.extract(hll_count.init({expression}))")
+        parts.append(alias_match.group(0))
+        if keep_sketches:
+            parts.append(
+                f", hll_count.init({expression}) as {alias_match.group(1)}{HLL_SKETCH_SUFFIX}"
+            )
+        position = alias_match.end()
+    parts.append(query_template[position:])
+
+    for x in re.findall(
+        r"approx_quantiles\s*\(.*?\)\s*\[\s*offset\s*\(\s*\d+\s*\)\s*\]\s+as\s+(\w+)",
+        query_template,
+        re.IGNORECASE | re.DOTALL,
+    ):
+        tolerances[x] = APPROXIMATE_METRIC_TOLERANCES["approx_quantiles"]
+
+    return "".join(parts), tolerances
+
+
+def apply_approximate_mode(
+    monitors: List[Mapping],
+) -> Tuple[List[Mapping], Dict[str, Dict[str, float]]]:
+    """
+    Rewrite the queries of monitors with `approximate: true`, see `build_approximate_monitor_query`.
+
+    Partitioned monitors keep their sketches so partitions are rolled up with `hll_count.merge`. Returns the
+    monitors and the tolerance of each approximate metric per monitor name.
+    """
+
+    approximate_monitors = []
+    metric_tolerances = {}
+    for monitor in monitors:
+        if monitor.get("approximate"):
+            query, metric_tolerances[monitor["monitor_name"]] = (
+                build_approximate_monitor_query(
+                    monitor["query"],
+                    keep_sketches="partition_lookback_days" in monitor,
+                )
+            )
+            monitor = {**monitor, "query": query}
+            logging.info(
+                f"{monitor['monitor_name']}: Approximating {list(metric_tolerances[monitor['monitor_name']].keys())}..."
+            )
+        approximate_monitors.append(monitor)
+
+    return approximate_monitors, metric_tolerances
+
+
+def apply_partition_roll_up_check(monitors: List[Mapping]) -> List[Mapping]:
+    """
+    Run partitioned monitors whose partitions cannot be rolled up (see `get_additive_metrics`) on the full table.
+
+    Every metric of a partitioned monitor must be additive or be approximated with a HLL sketch, otherwise
+    `partition_lookback_days` is removed from the monitor.
+    """
+
+    checked_monitors = []
+    for monitor in monitors:
+        if "partition_lookback_days" in monitor:
+            metrics = parse_monitor_metrics(monitor["query"])
+            additive_metrics = get_additive_metrics(monitor["query"])
+            non_additive_metrics = [
+                x
+                for x in metrics
+                if x != "table_name"
+                and not x.endswith(HLL_SKETCH_SUFFIX)
+                and x not in additive_metrics
+                and f"{x}{HLL_SKETCH_SUFFIX}" not in metrics
+            ]
+            if non_additive_metrics:
+                logging.info(
+                    f"{monitor['monitor_name']}: {non_additive_metrics} cannot be rolled up across partitions, querying the full table instead..."
+                )
+                monitor = {
+                    k: v for k, v in monitor.items() if k != "partition_lookback_days"
+                }
+        checked_monitors.append(monitor)
+
+    return checked_monitors
+
+
+def decode_monitor_row(result: str) -> dict:
+    """Decode a row returned by `build_monitor_batch_script`, BigQuery encodes large numbers as strings in JSON"""
+
+    row = json.loads(result)
+    for k, v in row.items():
+        if k != "table_name" and isinstance(v, str):
+            try:
+                row[k] = int(v)
+            except ValueError:
+                try:
+                    row[k] = float(v)
+                except ValueError:
+                    pass
+
+    return row
+
+
+def apply_byte_budgets(
+    monitors: List[Mapping],
+    estimates: Mapping[str, Mapping[str, int]],
+    max_bytes_per_monitor: Optional[int] = None,
+    max_bytes_per_run: Optional[int] = None,
+) -> Tuple[List[Mapping], Dict[str, str]]:
+    """
+    Split monitors into those within their byte budgets and those that are skipped.
+
+    A monitor's estimate is the sum over all environments. Its budget is the monitor's `max_bytes_processed` or,
+    if not set, `max_bytes_per_monitor`. Monitors are added to the run in the order of mart_monitor_queries.yml
+    until `max_bytes_per_run` is reached.
+
+    Returns the monitors to run and, for skipped monitors, the reason they were skipped.
+    """
+
+    monitors_to_run = []
+    skipped_monitors: Dict[str, str] = {}
+    run_bytes = 0
+    for monitor in monitors:
+        monitor_bytes = sum(estimates[monitor["monitor_name"]].values())
+        budget = monitor.get("max_bytes_processed", max_bytes_per_monitor)
+        if budget is not None and monitor_bytes > budget:
+            skipped_monitors[monitor["monitor_name"]] = (
+                f"estimated {format_bytes(monitor_bytes)} exceeds the monitor budget of {format_bytes(budget)}"
+            )
+        elif (
+            max_bytes_per_run is not None
+            and run_bytes + monitor_bytes > max_bytes_per_run
+        ):
+            skipped_monitors[monitor["monitor_name"]] = (
+                f"estimated {format_bytes(monitor_bytes)} would exceed the run budget of {format_bytes(max_bytes_per_run)}"
+            )
+        else:
+            monitors_to_run.append(monitor)
+            run_bytes += monitor_bytes
+
+    logging.info(f"Estimated bytes processed for this run: {format_bytes(run_bytes)}")
+    for monitor_name, reason in skipped_monitors.items():
+        logging.info(f"{monitor_name}: Skipped, {reason}...")
+
+    return monitors_to_run, skipped_monitors
+
+
+def dry_run_query(client: bigquery.Client, query: str) -> int:
+    """Return the bytes a query would process, invalid queries are reported when the monitor runs"""
+
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    try:
+        return client.query(query, job_config=job_config).total_bytes_processed or 0
+    except (BadRequest, NotFound) as e:
+        logging.info(f"{type(e)=}")
+        return 0
+
+
+def estimate_monitor_bytes(
+    monitors: List[Mapping[str, str]],
+    cicd_dataset: str,
+    baseline_cache: Optional[MonitorBaselineCache] = None,
+    history: Optional[MonitorHistoryStore] = None,
+    max_baseline_age: Optional[datetime.timedelta] = None,
+) -> Dict[str, Dict[str, int]]:
+    """
+    Dry run every monitor in every environment and return the bytes processed per monitor name and environment.
+
+    Only the queries that will run are estimated: partitioned monitors are dry run on the partitions in their
+    `partition_lookback_days` (as in `fetch_partitioned_results_from_bigquery`) and stg and prd baselines that are
+    read from `baseline_cache` or `history` (see `fetch_results_from_bigquery`) are estimated as 0 bytes.
+    """
+
+    estimates: Dict[str, Dict[str, int]] = {}
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = {}
+        for env in MONITOR_ENVS:
+            client = get_gcp_auth_clients(MONITOR_SERVICE_ACCOUNTS[env])["bigquery"]
+            for monitor in monitors:
+                table_id = get_monitor_table_id(
+                    env=env,
+                    project=client.project,
+                    cicd_dataset=cicd_dataset,
+                    model_name=monitor["model_name"],
+                )
+                partition_by = (
+                    get_manifest_index("./target/manifest.json")
+                    .relations[monitor["model_name"]]
+                    .get("partition_by")
+                    if "partition_lookback_days" in monitor
+                    else None
+                )
+                if partition_by is not None:
+                    query = build_partitioned_monitor_query(
+                        query_template=monitor["query"],
+                        env=env,
+                        table_id=table_id,
+                        partition_by=partition_by,
+                        partition_ids=get_lookback_partition_ids(
+                            monitor["partition_lookback_days"]
+                        ),
+                    )
+                else:
+                    query = render_monitor_query(
+                        query_template=monitor["query"],
+                        env=env,
+                        project=client.project,
+                        cicd_dataset=cicd_dataset,
+                        model_name=monitor["model_name"],
+                    )
+                    if env != "cicd" and has_cached_baseline(
+                        env=env,
+                        query=query,
+                        query_template=monitor["query"],
+                        table_id=table_id,
+                        baseline_cache=baseline_cache,
+                        history=history,
+                        max_baseline_age=max_baseline_age,
+                    ):
+                        logging.info(
+                            f"{monitor['monitor_name']}: Not estimating {env}, the baseline is cached..."
+                        )
+                        estimates.setdefault(monitor["monitor_name"], {})[env] = 0
+                        continue
+
+                futures[(monitor["monitor_name"], env)] = executor.submit(
+                    dry_run_query, client, query
+                )
+
+    for (monitor_name, env), future in futures.items():
+        estimates.setdefault(monitor_name, {})[env] = future.result()
+    # Keep the environments in the order of MONITOR_ENVS
+    estimates = {
+        monitor_name: {env: env_bytes[env] for env in MONITOR_ENVS}
+        for monitor_name, env_bytes in estimates.items()
     }
-    service_account_matrix = {"cicd": "stg", "stg": "stg", "prd": "prd"}
-    for env in ["cicd", "stg", "prd"]:
-        if env == "cicd":
-            dataset = dataset_matrix["cicd"]
+    logging.debug(f"{estimates=}")
+
+    return estimates
+
+
+def has_cached_baseline(
+    env: str,
+    query: str,
+    query_template: str,
+    table_id: str,
+    baseline_cache: Optional[MonitorBaselineCache] = None,
+    history: Optional[MonitorHistoryStore] = None,
+    max_baseline_age: Optional[datetime.timedelta] = None,
+) -> bool:
+    """Return whether the stg or prd results of a rendered monitor query will be read from the cache or history"""
+
+    if baseline_cache is not None:
+        key = baseline_cache.key(
+            env=MONITOR_SERVICE_ACCOUNTS[env], query=query, table_id=table_id
+        )
+        if key is not None and baseline_cache.get(key) is not None:
+            return True
+
+    return (
+        history is not None
+        and bool(max_baseline_age)
+        and history.get_baseline(query_template, env, max_baseline_age) is not None
+    )
+
+
+def fetch_batched_results_from_bigquery(
+    monitors: List[Mapping[str, str]],
+    cicd_dataset: str,
+    baseline_cache: Optional[MonitorBaselineCache] = None,
+    history: Optional[MonitorHistoryStore] = None,
+    max_baseline_age: Optional[datetime.timedelta] = None,
+) -> Tuple[Dict[str, list], Dict[str, str]]:
+    """
+    Run all monitors as one BigQuery job per environment, the jobs for all environments run concurrently.
+
+    Returns the results per monitor name and, for monitors whose query failed on the CICD dataset, the error.
+    Errors in stg or prd only drop that monitor's row for that environment, same as `fetch_results_from_bigquery`.
+    If the script itself is invalid (e.g. a syntax error in one monitor) the monitors for that environment are run
+    individually. Monitors with a cached stg or prd baseline in `baseline_cache`, or with a result in `history`
+    recorded less than `max_baseline_age` ago, are left out of that environment's script. Queried results are
+    appended to `history`.
+    """
+
+    results: Dict[str, list] = {monitor["monitor_name"]: [] for monitor in monitors}
+    cached_results: Dict[str, Dict[int, list]] = {env: {} for env in MONITOR_ENVS}
+    cache_keys: Dict[str, Dict[int, str]] = {env: {} for env in MONITOR_ENVS}
+    env_queries: Dict[str, Dict[int, str]] = {}
+    env_scripts = {}
+    for env in MONITOR_ENVS:
+        client = get_gcp_auth_clients(MONITOR_SERVICE_ACCOUNTS[env])["bigquery"]
+        env_queries[env] = {}
+        for index, monitor in enumerate(monitors):
+            query = render_monitor_query(
+                query_template=monitor["query"],
+                env=env,
+                project=client.project,
+                cicd_dataset=cicd_dataset,
+                model_name=monitor["model_name"],
+            )
+            if env != "cicd" and baseline_cache is not None:
+                key = baseline_cache.key(
+                    env=MONITOR_SERVICE_ACCOUNTS[env],
+                    query=query,
+                    table_id=get_monitor_table_id(
+                        env=env,
+                        project=client.project,
+                        cicd_dataset=cicd_dataset,
+                        model_name=monitor["model_name"],
+                    ),
+                )
+                if key is not None:
+                    cache_keys[env][index] = key
+                    cached_rows = baseline_cache.get(key)
+                    if cached_rows is not None:
+                        cached_results[env][index] = cached_rows
+                        continue
+            if env != "cicd" and history is not None and max_baseline_age:
+                history_rows = history.get_baseline(
+                    monitor["query"], env, max_baseline_age
+                )
+                if history_rows is not None:
+                    cached_results[env][index] = history_rows
+                    continue
+            env_queries[env][index] = query
+
+        logging.info(
+            f"{len(cached_results[env])} monitors have a cached baseline for {env}..."
+        )
+        if env_queries[env]:
+            env_scripts[env] = (
+                client,
+                build_monitor_batch_script(list(env_queries[env].values())),
+            )
+            logging.info(
+                f"Running {len(env_queries[env])} monitors as one job on {client.project} for {env}..."
+            )
+            logging.debug(f"{env_scripts[env][1]=}")
+
+    env_rows = run_queries_concurrently(env_scripts)
+    cicd_errors: Dict[str, str] = {}
+    for env in MONITOR_ENVS:
+        # Map the position of a query in the script to the monitor's index
+        script_indexes = list(env_queries[env])
+        rows = env_rows.get(env, [])
+        if isinstance(rows, Exception):
+            logging.info(f"{type(rows)=}, running monitors individually for {env}...")
+            client = env_scripts[env][0]
+            rows = []
+            for script_index, query in enumerate(env_queries[env].values()):
+                try:
+                    rows.extend(
+                        {
+                            "monitor_index": script_index,
+                            "result": json.dumps(row, default=str),
+                            "error": None,
+                        }
+                        for row in run_query(client=client, query=query, env=env)
+                    )
+                except (BadRequest, NotFound) as e:
+                    rows.append(
+                        {
+                            "monitor_index": script_index,
+                            "result": None,
+                            "error": str(e),
+                        }
+                    )
+
+        env_results: Dict[int, list] = {}
+        for row in rows:
+            index = script_indexes[row["monitor_index"]]
+            monitor_name = monitors[index]["monitor_name"]
+            if row["error"] is not None:
+                logging.info(f"{monitor_name}: query failed on {env}, {row['error']=}")
+                if env == "cicd":
+                    cicd_errors[monitor_name] = row["error"]
+            else:
+                env_results.setdefault(index, []).append(
+                    decode_monitor_row(row["result"])
+                )
+
+        for index, monitor_rows in env_results.items():
+            if index in cache_keys[env]:
+                baseline_cache.set(cache_keys[env][index], monitor_rows)
+            if history is not None:
+                history.append(
+                    monitors[index]["query"],
+                    monitors[index]["model_name"],
+                    monitor_rows,
+                )
+        env_results.update(cached_results[env])
+        for index in sorted(env_results):
+            results[monitors[index]["monitor_name"]].extend(env_results[index])
+
+    logging.debug(f"{results=}")
+    return results, cicd_errors
+
+
+def fetch_partitioned_results_from_bigquery(
+    monitor: Mapping,
+    cicd_dataset: str,
+    partition_store: Optional[PartitionAggregateStore] = None,
+    partitions_provider: Callable[
+        [str, str], Mapping[str, datetime.datetime]
+    ] = get_table_partitions,
+    cancelled: Optional[threading.Event] = None,
+) -> Tuple[list, Dict[str, list]]:
+    """
+    Run a monitor per partition of a partitioned mart and roll the partitions up.
+
+    The partitions are the days from `partition_lookback_days` ago until today, each partition is queried with the
+    monitor's query on only that partition. stg and prd partitions are read from `partition_store` unless the
+    partition's `last_modified_time` (from `partitions_provider`, INFORMATION_SCHEMA.PARTITIONS by default) has
+    changed since they were stored. CICD partitions are always queried, as are the oldest and newest partitions of
+    queries that use `current_date()` etc.
+
+    Returns the rolled up results, in the same format as `fetch_results_from_bigquery`, and the results per
+    partition ID. HLL sketches of approximate monitors are stored with the partitions and merged in BigQuery to roll
+    up their distinct counts.
+    """
+
+    partition_by = get_manifest_index("./target/manifest.json").relations[
+        monitor["model_name"]
+    ]["partition_by"]
+    assert (
+        partition_by is not None
+        and partition_by.get("granularity", "day") == "day"
+        and partition_by.get("data_type", "date") in ["date", "datetime", "timestamp"]
+    ), f"{monitor['monitor_name']}: `partition_lookback_days` requires {monitor['model_name']} to be partitioned by day on a date, datetime or timestamp column."
+
+    partition_ids = get_lookback_partition_ids(monitor["partition_lookback_days"])
+    additive_metrics = get_additive_metrics(monitor["query"])
+
+    # Filters on e.g. `current_timestamp()` change the results of the oldest and newest partitions without the
+    # partitions being modified, these are always queried (stored results are also keyed on today's date)
+    always_queried_partitions = (
+        {partition_ids[0], partition_ids[-1]}
+        if NON_DETERMINISTIC_FUNCTIONS.search(monitor["query"])
+        else set()
+    )
+
+    env_queries = {}
+    env_partitions: Dict[str, Dict[str, dict]] = {}
+    env_stale_partitions: Dict[str, List[str]] = {}
+    env_table_ids = {}
+    env_clients = {}
+    for env in MONITOR_ENVS:
+        client = get_gcp_auth_clients(MONITOR_SERVICE_ACCOUNTS[env])["bigquery"]
+        env_clients[env] = client
+        env_table_ids[env] = get_monitor_table_id(
+            env=env,
+            project=client.project,
+            cicd_dataset=cicd_dataset,
+            model_name=monitor["model_name"],
+        )
+
+        if env != "cicd" and partition_store is not None:
+            try:
+                last_modified_times = partitions_provider(
+                    MONITOR_SERVICE_ACCOUNTS[env], env_table_ids[env]
+                )
+            except (
+                Exception
+            ) as e:  # Not using stored partitions should never fail the monitor
+                logging.info(f"{e=}")
+                last_modified_times = None
+            stored_partitions = partition_store.get(
+                env, env_table_ids[env], monitor["query"]
+            )
         else:
-            dataset = dataset_matrix["other_envs"]
+            last_modified_times = None
+            stored_partitions = {}
+
+        env_partitions[env] = {}
+        env_stale_partitions[env] = []
+        for partition_id in partition_ids:
+            stored_partition = stored_partitions.get(partition_id)
+            if (
+                last_modified_times is not None
+                and partition_id not in always_queried_partitions
+                and stored_partition is not None
+                and stored_partition["last_modified_time"]
+                == last_modified_times.get(partition_id)
+            ):
+                env_partitions[env][partition_id] = stored_partition
+            else:
+                env_partitions[env][partition_id] = {
+                    "last_modified_time": (last_modified_times or {}).get(partition_id),
+                    "rows": [],
+                }
+                env_stale_partitions[env].append(partition_id)
+
+        logging.info(
+            f"{monitor['monitor_name']}: Querying {len(env_stale_partitions[env])} of {len(partition_ids)} partitions for {env}..."
+        )
+        if env_stale_partitions[env]:
+            env_queries[env] = (
+                client,
+                build_partitioned_monitor_query(
+                    query_template=monitor["query"],
+                    env=env,
+                    table_id=env_table_ids[env],
+                    partition_by=partition_by,
+                    partition_ids=env_stale_partitions[env],
+                ),
+            )
 
-        client = get_gcp_auth_clients(service_account_matrix[env])["bigquery"]
+    env_rows = run_queries_concurrently(env_queries, cancelled)
 
-        query = Template(query_template).render(
-            env=env, table_name=f"{client.project}.{dataset}.{model_name}"
+    results = []
+    partition_results: Dict[str, list] = {x: [] for x in partition_ids}
+    for env in MONITOR_ENVS:
+        rows = env_rows.get(env, [])
+        if isinstance(rows, Exception):
+            logging.info(f"{type(rows)=}")
+
+            assert (
+                env != "cicd"
+            ), f"Mart monitor for {monitor['model_name']} failed on CICD dataset, likely due to an invalid query."
+            continue
+
+        for row in rows:
+            partition_id = row.pop("partition_id")
+            env_partitions[env][partition_id]["rows"].append(row)
+        if env != "cicd" and partition_store is not None:
+            partition_store.set(
+                env, env_table_ids[env], monitor["query"], env_partitions[env]
+            )
+
+        for partition_id, partition in env_partitions[env].items():
+            partition_results[partition_id].extend(
+                [
+                    {k: v for k, v in x.items() if not k.endswith(HLL_SKETCH_SUFFIX)}
+                    for x in partition["rows"]
+                ]
+            )
+        results.extend(
+            roll_up_partitions(
+                [row for x in env_partitions[env].values() for row in x["rows"]],
+                additive_metrics=additive_metrics,
+                merge_sketches=lambda sketches: merge_hll_sketches(
+                    env_clients[env], sketches
+                ),
+            )
         )
-        logging.info(f"Running query on {dataset} dataset on {client.project}...")
-        logging.debug(f"{query=}")
 
-        # If we change column names or add new models we need to tolerate these not being comparable across environments
-        # If this happens, the comment will only include data from where the updated column/name is present
-        try:
-            query_job = client.query(query)
-            for row in query_job:
-                i = dict(row.items())
-                results.append(i)
-        except (BadRequest, NotFound) as e:
-            logging.info(f"{type(e)=}")
+    logging.debug(f"{results=}")
+    return results, partition_results
+
+
+def fetch_results_from_bigquery(
+    query_template: str,
+    cicd_dataset: str,
+    model_name: str,
+    cancelled: Optional[threading.Event] = None,
+    baseline_cache: Optional[MonitorBaselineCache] = None,
+    history: Optional[MonitorHistoryStore] = None,
+    max_baseline_age: Optional[datetime.timedelta] = None,
+) -> list:
+    """
+    Run query across all environments in BigQuery concurrently and return results.
+
+    If `baseline_cache` is provided, stg and prd results are read from the cache when the queried table has not
+    been modified since the results were cached. Otherwise stg and prd results in `history` recorded less than
+    `max_baseline_age` ago are used. Queried results are appended to `history`.
+    """
+
+    env_queries = {}
+    env_rows: Dict[str, Union[list, GoogleAPICallError]] = {}
+    cache_keys: Dict[str, Optional[str]] = {}
+    for env in MONITOR_ENVS:
+        client = get_gcp_auth_clients(MONITOR_SERVICE_ACCOUNTS[env])["bigquery"]
+
+        query = render_monitor_query(
+            query_template=query_template,
+            env=env,
+            project=client.project,
+            cicd_dataset=cicd_dataset,
+            model_name=model_name,
+        )
+        logging.debug(f"{query=}")
+        if env != "cicd" and baseline_cache is not None:
+            cache_keys[env] = baseline_cache.key(
+                env=MONITOR_SERVICE_ACCOUNTS[env],
+                query=query,
+                table_id=get_monitor_table_id(
+                    env=env,
+                    project=client.project,
+                    cicd_dataset=cicd_dataset,
+                    model_name=model_name,
+                ),
+            )
+            if cache_keys[env] is not None:
+                cached_rows = baseline_cache.get(cache_keys[env])
+                if cached_rows is not None:
+                    logging.info(f"{model_name}: Using cached baseline for {env}...")
+                    env_rows[env] = cached_rows
+                    continue
+        if env != "cicd" and history is not None and max_baseline_age:
+            history_rows = history.get_baseline(query_template, env, max_baseline_age)
+            if history_rows is not None:
+                logging.info(f"{model_name}: Using baseline from history for {env}...")
+                env_rows[env] = history_rows
+                continue
+
+        logging.info(f"Running query on {client.project} for {env}...")
+        env_queries[env] = (client, query)
+
+    env_rows.update(run_queries_concurrently(env_queries, cancelled))
+
+    # If we change column names or add new models we need to tolerate these not being comparable across environments
+    # If this happens, the comment will only include data from where the updated column/name is present
+    results = []
+    for env in MONITOR_ENVS:
+        rows = env_rows[env]
+        if isinstance(rows, Exception):
+            logging.info(f"{type(rows)=}")
 
             assert (
                 env != "cicd"
             ), f"Mart monitor for {model_name} failed on CICD dataset, likely due to an invalid query."
+        else:
+            results.extend(rows)
+            if env in env_queries and cache_keys.get(env) is not None:
+                baseline_cache.set(cache_keys[env], rows)
+            if env in env_queries and history is not None:
+                history.append(query_template, model_name, rows)
 
-        logging.debug(f"{results=}")
+    logging.debug(f"{results=}")
     return results
 
 
-def format_results(results: list) -> list:
-    """Use local DuckDB engine to format the results for GitHub comment"""
+def _closing_parenthesis(text: str, start: int) -> int:
+    """Return the position after the parenthesis that closes the one opened just before `start`"""
+
+    depth = 1
+    end = start
+    while depth > 0:
+        assert end < len(text), "Unbalanced parentheses in query."
+        depth += {"(": 1, ")": -1}.get(text[end], 0)
+        end += 1
+    return end
+
+
+def get_additive_metrics(query_template: str) -> Set[str]:
+    """
+    Return the metrics of a monitor query that can be summed across partitions, i.e. metrics that are a single
+    `count(*)`, `count(<expr>)`, `countif(<expr>)` or `sum(<expr>)`, see `parse_monitor_metrics`.
+    """
+
+    additive_metrics = set()
+    for alias, expression in parse_monitor_metrics(query_template).items():
+        match = ADDITIVE_AGGREGATES.match(expression)
+        if match is not None and _closing_parenthesis(
+            expression, expression.index("(", match.start()) + 1
+        ) == len(expression):
+            additive_metrics.add(alias)
+
+    return additive_metrics
+
+
+def get_monitor_table_id(
+    env: str, project: str, cicd_dataset: str, model_name: str
+) -> str:
+    """Return the table a monitor queries, the dataset of stg and prd is fetched from manifest.json"""
+
+    if env == "cicd":
+        dataset = cicd_dataset
+    else:
+        dataset = get_manifest_index("./target/manifest.json").relations[model_name][
+            "schema"
+        ]
+
+    return f"{project}.{dataset}.{model_name}"
+
+
+def get_lookback_partition_ids(partition_lookback_days: int) -> List[str]:
+    """Return the IDs of the day partitions from `partition_lookback_days` ago until today, oldest first"""
+
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    return [
+        (today - datetime.timedelta(days=x)).strftime("%Y%m%d")
+        for x in range(partition_lookback_days, -1, -1)
+    ]
+
+
+def build_partitioned_monitor_query(
+    query_template: str,
+    env: str,
+    table_id: str,
+    partition_by: Mapping[str, str],
+    partition_ids: List[str],
+) -> str:
+    """
+    Render a monitor query once per day partition and combine these with `UNION ALL`.
+
+    `table_name` is rendered as a subquery that filters on the partition column, so BigQuery only scans that
+    partition. Each row contains the `partition_id` it was computed from.
+    """
+
+    data_type = partition_by.get("data_type", "date")
+    queries = []
+    for partition_id in partition_ids:
+        partition_start = (
+            f"{data_type}('{partition_id[:4]}-{partition_id[4:6]}-{partition_id[6:]}')"
+        )
+        partition_table = (
+            f"(select * from `{table_id}` where {partition_by['field']} >= {partition_start} "
+            f"and {partition_by['field']} < {data_type}_add({partition_start}, interval 1 day))"
+        )
+        queries.append(
+            f"select '{partition_id}' as partition_id, t.* from (\n"
+            + Template(query_template).render(env=env, table_name=partition_table)
+            + "\n) as t"
+        )
+
+    return "\nunion all\n".join(queries)
+
+
+def format_bytes(num_bytes: float) -> str:
+    """Format a number of bytes for a GitHub comment, e.g. 1.5 GiB"""
+
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if num_bytes < 1024 or unit == "TiB":
+            break
+        num_bytes /= 1024
+
+    return f"{num_bytes:.1f} {unit}" if unit != "B" else f"{num_bytes:.0f} B"
+
+
+def format_results(
+    results: list, tolerances: Optional[Mapping[str, float]] = None
+) -> list:
+    """
+    Use local DuckDB engine to format the results for GitHub comment.
+
+    The results are unpivoted to one row per environment and metric, each metric is joined to its CICD value once
+    and classified in a single query, so the query does not grow with the number of metrics. The thresholds of
+    metrics in `tolerances` (e.g. approximate metrics, see `build_approximate_monitor_query`) are widened by their
+    tolerance in percent.
+    """
     arrow_table = pa.Table.from_pylist(results)
-    metric_names = [x for x in results[0].keys() if x != "table_name"]
+    metric_names = [x for x in arrow_table.column_names if x != "table_name"]
     logging.debug(f"{metric_names=}")
+    tolerances = tolerances or {}
+
+    # Unpivot to (table_name, metric_index, value), nulls are kept
+    num_rows = arrow_table.num_rows
+    long_table = pa.table(
+        {
+            "table_name": pa.concat_arrays(
+                [arrow_table["table_name"].combine_chunks()] * len(metric_names)
+            ),
+            "metric_index": pa.array(
+                [i for i in range(len(metric_names)) for _ in range(num_rows)],
+                type=pa.int32(),
+            ),
+            "value": pa.concat_arrays(
+                [_to_decimal(arrow_table[x]).combine_chunks() for x in metric_names]
+            ),
+            "tolerance": pa.array(
+                [tolerances.get(x, 0.0) for x in metric_names for _ in range(num_rows)],
+                type=pa.float64(),
+            ),
+        }
+    )
+
+    cursor = _duckdb_connection.cursor()
+    try:
+        cursor.register("long_table", long_table)
+        formatted = cursor.execute(FORMAT_RESULTS_QUERY).fetchall()
+    finally:
+        cursor.close()
+
+    # One row per metric, with a column for each environment
+    data = {"table_name": ["metrics"] + formatted[0][1]}
+    for metric_index, _, cells in formatted:
+        data[f"diff_{metric_names[metric_index]}_pct"] = [
+            metric_names[metric_index]
+        ] + cells
+
+    logging.debug(f"{data=}")
+
+    return data
+
 
-    # Calculate the percentage difference for each metric across the environments
-    metrics_base = " ".join(
+def _to_decimal(column: pa.ChunkedArray) -> pa.ChunkedArray:
+    """Cast a metric to `FORMAT_RESULTS_VALUE_TYPE`, e.g. BIGNUMERIC values are rounded to 9 decimal places"""
+
+    if pa.types.is_decimal(column.type) and column.type.scale > 9:
+        column = pc.round(column, 9)
+    return pc.cast(column, FORMAT_RESULTS_VALUE_TYPE)
+
+
+def merge_hll_sketches(
+    client: bigquery.Client, sketches: Mapping[str, List[bytes]]
+) -> Dict[str, Optional[int]]:
+    """
+    Merge HLL sketches per metric with `hll_count.merge` and return the distinct count of each metric.
+
+    The sketches are passed as query parameters so no table is scanned and no bytes are billed.
+    """
+
+    if not sketches:
+        return {}
+
+    metrics = list(sketches.keys())
+    query = "\nunion all\n".join(
         [
-            f"""
-            CASE
-                WHEN table_name = 'cicd' THEN NULL
-                ELSE ROUND(((CAST({metric} AS NUMERIC) / (SELECT {metric} FROM arrow_table WHERE table_name = 'cicd')) - 1) * 100, 1)
-            END AS diff_{metric}_pct,
-            """
-            for metric in metric_names
+            f"select {i} as metric_index, hll_count.merge(sketch) as value from unnest(@sketches_{i}) as sketch"
+            for i in range(len(metrics))
         ]
     )
-
-    # Use the percentage difference to format the data for a GitHub comment
-    metrics_calc = " ".join(
-        [
-            f"""
-        CASE
-            WHEN table_name == 'cicd' THEN
-                CASE
-                    WHEN {metric} % 1 == 0 THEN {metric}
-                    ELSE CAST({metric} AS NUMERIC)
-                END
-            ELSE
-                CASE
-                    WHEN ABS(diff_{metric}_pct) <= 0.5 THEN '🟢'
-                    WHEN ABS(diff_{metric}_pct) < 1 THEN '🟡'
-                    ELSE '🔴'
-                END
-                || ' '
-                || ROUND(CAST({metric} AS NUMERIC), 0)
-                || ' ('
-                || ROUND(diff_{metric}_pct, 2)
-                || '%)'
-        END AS diff_{metric}_pct,"""
-            for metric in metric_names
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ArrayQueryParameter(f"sketches_{i}", "BYTES", sketches[x])
+            for i, x in enumerate(metrics)
         ]
     )
-    query = f"""
-    WITH base AS (
-        SELECT
-            *,
-            {metrics_base}
-        FROM arrow_table
+
+    return {
+        metrics[row["metric_index"]]: row["value"]
+        for row in client.query(query, job_config=job_config).result()
+    }
+
+
+def roll_up_partitions(
+    rows: List[dict],
+    additive_metrics: Set[str],
+    merge_sketches: Optional[
+        Callable[[Mapping[str, List[bytes]]], Mapping[str, Optional[int]]]
+    ] = None,
+) -> List[dict]:
+    """
+    Roll the per partition rows of an environment up into a single row.
+
+    Metrics in `additive_metrics` (see `get_additive_metrics`) are summed. Metrics with HLL sketches (see
+    `build_approximate_monitor_query`) are the distinct count of the merged sketches, sketches are not included in
+    the rolled up row. Any other metric, e.g. a minimum or an exact distinct count, cannot be rolled up and raises a
+    `ValueError`, see `apply_partition_roll_up_check`.
+    """
+
+    if not rows:
+        return []
+
+    rolled_up = {"table_name": rows[0]["table_name"]}
+    sketches = {}
+    for k in rows[0].keys():
+        if k.endswith(HLL_SKETCH_SUFFIX):
+            sketches[k[: -len(HLL_SKETCH_SUFFIX)]] = [
+                x[k] for x in rows if x.get(k) is not None
+            ]
+        elif k in additive_metrics:
+            values = [x[k] for x in rows if x.get(k) is not None]
+            rolled_up[k] = sum(values) if values else None
+
+    non_additive_metrics = [
+        k
+        for k in rows[0].keys()
+        if k not in rolled_up
+        and k not in sketches
+        and not k.endswith(HLL_SKETCH_SUFFIX)
+    ]
+    if non_additive_metrics:
+        raise ValueError(
+            f"{non_additive_metrics} are not additive and cannot be rolled up across partitions."
+        )
+    if sketches:
+        if merge_sketches is None:
+            raise ValueError(
+                f"{list(sketches)} require `merge_sketches` to be rolled up."
+            )
+        rolled_up.update(merge_sketches(sketches))
+
+    return [rolled_up]
+
+
+def parse_monitor_metrics(query_template: str) -> Dict[str, str]:
+    """Return the expression of every aliased column (`<expr> as <alias>`) of the outer select of a monitor query"""
+
+    start = re.search(r"\bselect\b", query_template, re.IGNORECASE)
+    assert start is not None, "Monitor query must contain `select`."
+
+    columns = []
+    depth = 0
+    quote = None
+    column_start = start.end()
+    position = column_start
+    while position < len(query_template):
+        char = query_template[position]
+        if quote is not None:
+            quote = None if char == quote else quote
+        elif char in "'\"`":
+            quote = char
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif depth == 0 and char == ",":
+            columns.append(query_template[column_start:position])
+            column_start = position + 1
+        elif depth == 0 and re.match(
+            r"\bfrom\b", query_template[position:], re.IGNORECASE
+        ):
+            break
+        position += 1
+    columns.append(query_template[column_start:position])
+
+    metrics = {}
+    for column in columns:
+        match = re.fullmatch(
+            r"\s*(.+?)\s+as\s+(\w+)\s*", column, re.IGNORECASE | re.DOTALL
+        )
+        if match is not None:
+            metrics[match.group(2)] = match.group(1)
+
+    return metrics
+
+
+def render_monitor_query(
+    query_template: str, env: str, project: str, cicd_dataset: str, model_name: str
+) -> str:
+    """Render a monitor query for an environment"""
+
+    return Template(query_template).render(
+        env=env,
+        table_name=get_monitor_table_id(
+            env=env, project=project, cicd_dataset=cicd_dataset, model_name=model_name
+        ),
     )
 
-    SELECT
-        table_name,
-        {metrics_calc}
-    FROM base
-    ORDER BY
-        CASE
-            WHEN table_name = 'cicd' THEN 1
-            WHEN table_name = 'stg' THEN 2
-            WHEN table_name = 'prd' THEN 3
-        END
+
+def run_queries_concurrently(
+    env_queries: Mapping[str, Tuple[bigquery.Client, str]],
+    cancelled: Optional[threading.Event] = None,
+) -> Dict[str, Union[list, GoogleAPICallError]]:
     """
-    logging.debug(f"{query=}")
-    con = duckdb.connect(database=":memory:")
-    df = con.execute(query).arrow()
+    Run one query per environment, all queries are submitted at once.
 
-    # Format table to a list of rows, add column that details the metric names
-    data = df.to_pydict()
-    metrics_col = ["metrics"] + [x for x in results[0].keys() if x != "table_name"]
-    for index, (k, v) in enumerate(data.items()):
-        v.insert(0, metrics_col[index])
+    Returns the rows per environment or, for queries that are invalid in that environment, the `BadRequest` or
+    `NotFound` error. Other errors are retried per environment by `run_query`.
+    """
 
-    logging.debug(f"{data=}")
+    with ThreadPoolExecutor(max_workers=max(len(env_queries), 1)) as executor:
+        futures = {
+            env: executor.submit(
+                run_query, client=client, query=query, env=env, cancelled=cancelled
+            )
+            for env, (client, query) in env_queries.items()
+        }
 
-    return data
+    results: Dict[str, Union[list, GoogleAPICallError]] = {}
+    for env, future in futures.items():
+        try:
+            results[env] = future.result()
+        except (BadRequest, NotFound) as e:
+            results[env] = e
+
+    return results
+
+
+def run_query(
+    client: bigquery.Client,
+    query: str,
+    env: str,
+    tries: int = 3,
+    delay: int = 5,
+    cancelled: Optional[threading.Event] = None,
+) -> list:
+    """
+    Run a query and return its rows as dictionaries, transient errors are retried but invalid queries are not.
+
+    If `cancelled` is set while the query is running the BigQuery job is cancelled and `MonitorCancelledError`
+    is raised.
+    """
+
+    for attempt in range(1, tries + 1):
+        start_time = time.monotonic()
+        try:
+            query_job = client.query(query)
+            if cancelled is None:
+                query_result = query_job.result()
+            else:
+                while True:
+                    try:
+                        query_result = query_job.result(timeout=1)
+                        break
+                    except concurrent.futures.TimeoutError:
+                        if cancelled.is_set():
+                            query_job.cancel()
+                            raise MonitorCancelledError(
+                                f"{env}: Query cancelled after {time.monotonic() - start_time:.2f} seconds."
+                            )
+            rows = [dict(row.items()) for row in query_result]
+            logging.info(
+                f"{env}: Query completed in {time.monotonic() - start_time:.2f} seconds..."
+            )
+            return rows
+        except (BadRequest, NotFound):
+            logging.info(
+                f"{env}: Query failed in {time.monotonic() - start_time:.2f} seconds..."
+            )
+            raise
+        except MonitorCancelledError:
+            raise
+        except Exception as e:
+            # The scheduler may have released the monitor's slot, a cancelled monitor must not submit more jobs
+            if attempt == tries or (cancelled is not None and cancelled.is_set()):
+                raise
+            logging.info(f"{env}: {e=}, retrying in {delay} seconds...")
+            time.sleep(delay)
+
+    return []
 
 
 def run_monitor(
-    monitor: dict, dbt_dataset: str, pull_request_id: int, target_branch: str
+    monitor: dict,
+    dbt_dataset: str,
+    pr_comments: GitHubPRCommentIndex,
+    results: Optional[list] = None,
+    cancelled: Optional[threading.Event] = None,
+    baseline_cache: Optional[MonitorBaselineCache] = None,
+    estimated_bytes: Optional[Mapping[str, int]] = None,
+    partition_store: Optional[PartitionAggregateStore] = None,
+    metric_tolerances: Optional[Mapping[str, float]] = None,
+    history: Optional[MonitorHistoryStore] = None,
+    max_baseline_age: Optional[datetime.timedelta] = None,
 ) -> None:
-    """Run a monitor and post comments to GitHub PR"""
+    """
+    Run a monitor and post comments to GitHub PR, `results` are fetched from BigQuery if not provided.
+
+    Monitors with `partition_lookback_days` are run per partition, see `fetch_partitioned_results_from_bigquery`,
+    and the comment lists the partitions that differ.
+
+    Nothing is posted if `cancelled` is set, e.g. because the monitor exceeded its deadline. `estimated_bytes` (per
+    environment, from `estimate_monitor_bytes`) is added to the comment. `metric_tolerances` widens the thresholds
+    of approximate metrics, see `apply_approximate_mode`, and of metrics that historically differ from CICD, see
+    `MonitorHistoryStore.metric_tolerances`. Results queried from BigQuery are appended to `history`.
+    """
 
     logging.info(
         f"{monitor['monitor_name']}: Starting process for {monitor['monitor_name']}..."
     )
-    results = fetch_results_from_bigquery(
-        query_template=monitor["query"],
-        cicd_dataset=dbt_dataset,
-        model_name=monitor["model_name"],
-    )
-    data = format_results(results)
+    partition_results = None
+    if "partition_lookback_days" in monitor:
+        results, partition_results = fetch_partitioned_results_from_bigquery(
+            monitor=monitor,
+            cicd_dataset=dbt_dataset,
+            partition_store=partition_store,
+            cancelled=cancelled,
+        )
+    elif results is None:
+        results = fetch_results_from_bigquery(
+            query_template=monitor["query"],
+            cicd_dataset=dbt_dataset,
+            model_name=monitor["model_name"],
+            cancelled=cancelled,
+            baseline_cache=baseline_cache,
+            history=history,
+            max_baseline_age=max_baseline_age,
+        )
+    data = format_results(results, metric_tolerances)
     markdown_table = transform_list_to_markdown(data, monitor["monitor_name"])
-    delete_github_pr_bot_comments(
-        pull_request_id, target_branch, monitor["monitor_name"]
+    if partition_results is not None:
+        markdown_table += "\n\n" + transform_partition_diffs_to_markdown(
+            partition_results, metric_tolerances
+        )
+    if metric_tolerances:
+        markdown_table += "\n\nWidened thresholds: " + ", ".join(
+            [f"{k} (±{v}%)" for k, v in metric_tolerances.items()]
+        )
+    if estimated_bytes is not None:
+        markdown_table += "\n\nEstimated bytes processed: " + ", ".join(
+            [f"{k} {format_bytes(v)}" for k, v in estimated_bytes.items()]
+        )
+    if cancelled is not None and cancelled.is_set():
+        raise MonitorCancelledError(
+            f"{monitor['monitor_name']}: Cancelled before posting results."
+        )
+    pr_comments.upsert(monitor["monitor_name"], markdown_table)
+
+
+def transform_partition_diffs_to_markdown(
+    partition_results: Mapping[str, list],
+    tolerances: Optional[Mapping[str, float]] = None,
+) -> str:
+    """List the partitions and metrics that differ from CICD as a Markdown table"""
+
+    value_matrix = []
+    for partition_id, results in partition_results.items():
+        if not any(x["table_name"] == "cicd" for x in results):
+            continue
+
+        data = format_results(results, tolerances)
+        for k, v in data.items():
+            if k != "table_name" and any(x[:1] in ["🟡", "🔴"] for x in v[2:]):
+                value_matrix.append([partition_id] + v)
+        headers = ["partition_id"] + data["table_name"]
+
+    if not value_matrix:
+        return "All partitions match!!"
+
+    writer = pytablewriter.MarkdownTableWriter(
+        table_name="Partitions that differ",
+        headers=headers,
+        value_matrix=value_matrix,
     )
-    send_github_pr_comment(pull_request_id=pull_request_id, message=markdown_table)
+
+    return writer.__str__()
 
 
 def transform_list_to_markdown(input: list, monitor_name: str) -> str:
@@ -316,6 +1467,25 @@ def transform_list_to_markdown(input: list, monitor_name: str) -> str:
     return markdown_table
 
 
+def fetch_byte_budgets_from_yml() -> Mapping[str, Optional[int]]:
+    """Fetch the default per monitor and per run byte budgets from yaml file, `None` means no budget."""
+    __location__ = os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__))
+    )
+    with open(os.path.join(__location__, "mart_monitor_queries.yml")) as f:
+        query_data = yaml.safe_load(f)
+
+    assert query_data is not None
+
+    budgets = query_data.get("max_bytes_processed") or {}
+    assert set(budgets.keys()) <= {"per_monitor", "per_run"}
+
+    return {
+        "per_monitor": budgets.get("per_monitor"),
+        "per_run": budgets.get("per_run"),
+    }
+
+
 def fetch_query_data_from_yml() -> List[Mapping[str, str]]:
     """Fetch data from yaml file."""
     __location__ = os.path.realpath(
@@ -328,7 +1498,8 @@ def fetch_query_data_from_yml() -> List[Mapping[str, str]]:
 
     data = query_data["query_data"]
     for i in data:
-        assert list(i.keys()) == ["monitor_name", "model_name", "query"]
+        assert list(i.keys())[:3] == ["monitor_name", "model_name", "query"]
+        assert set(list(i.keys())[3:]) <= set(MONITOR_OPTIONAL_KEYS)
 
     return data
 
@@ -336,7 +1507,27 @@ def fetch_query_data_from_yml() -> List[Mapping[str, str]]:
 def main() -> None:
     set_logging_options()
 
-    dbt_dataset, pull_request_id, target_branch = parse_command_line_args()
+    (
+        dbt_dataset,
+        pull_request_id,
+        target_branch,
+        monitor_execution_mode,
+        monitor_concurrency,
+        monitor_concurrency_per_project,
+        monitor_timeout,
+        monitor_baseline_max_age,
+    ) = parse_command_line_args()
+
+    # Marts without a hand-written monitor get a generated monitor, these are generated from the manifest.json of
+    # this PR before it is replaced by the previous manifest.json of the env
+    generated_monitors = []
+    if target_branch == "stg":
+        try:
+            generated_monitors = generate_monitors(monitors=fetch_query_data_from_yml())
+        except (
+            Exception
+        ) as e:  # This script failing should not block the CI pipeline, hence this generic error handling
+            logging.info(f"{e=}")
 
     try:
         download_manifest_json(
@@ -350,20 +1541,115 @@ def main() -> None:
     if (
         "init_run" not in locals()
     ):  # i.e. on inital run no manifest.json to compare with so need to skip
+        # Retrieve the existing comments on the PR once, all monitors update their comment in place
+        try:
+            pr_comments = GitHubPRCommentIndex(pull_request_id)
+        except (
+            Exception
+        ) as e:  # This script failing should not block the CI pipeline, hence this generic error handling
+            logging.info(f"{e=}")
+            return
+
         try:
             if target_branch == "stg":
                 # Monitors only runs for PRs to `stg` branch
-                monitor_yaml = fetch_query_data_from_yml()
-
-                # Run monitors in parallel
-                pool = ThreadPool(8)
-                pool.starmap(
-                    run_monitor,
-                    [
-                        (monitor, dbt_dataset, pull_request_id, target_branch)
-                        for monitor in monitor_yaml
-                    ],
+                monitor_yaml = fetch_query_data_from_yml() + generated_monitors
+                monitor_yaml, metric_tolerances = apply_approximate_mode(monitor_yaml)
+                monitor_yaml = apply_partition_roll_up_check(monitor_yaml)
+
+                baseline_cache = MonitorBaselineCache()
+                partition_store = PartitionAggregateStore()
+                history = MonitorHistoryStore()
+                max_baseline_age = datetime.timedelta(hours=monitor_baseline_max_age)
+
+                # Dry run all monitors, monitors that exceed their byte budget are skipped
+                byte_budgets = fetch_byte_budgets_from_yml()
+                estimates = estimate_monitor_bytes(
+                    monitors=monitor_yaml,
+                    cicd_dataset=dbt_dataset,
+                    baseline_cache=baseline_cache,
+                    history=history,
+                    max_baseline_age=max_baseline_age,
+                )
+                monitor_yaml, skipped_monitors = apply_byte_budgets(
+                    monitors=monitor_yaml,
+                    estimates=estimates,
+                    max_bytes_per_monitor=byte_budgets["per_monitor"],
+                    max_bytes_per_run=byte_budgets["per_run"],
+                )
+                for monitor_name, reason in skipped_monitors.items():
+                    pr_comments.upsert(
+                        monitor_name, f"# {monitor_name}\n\n⏭️ Skipped, {reason}."
+                    )
+
+                # Use the wider of the approximate and historical tolerance of each metric, the history is read
+                # before the results of this run are appended
+                for monitor in monitor_yaml:
+                    tolerances = metric_tolerances.setdefault(
+                        monitor["monitor_name"], {}
+                    )
+                    for k, v in history.metric_tolerances(monitor["query"]).items():
+                        if v > tolerances.get(k, 0.0):
+                            tolerances[k] = v
+                batched_results: Optional[Dict[str, list]] = None
+                cicd_errors: Dict[str, str] = {}
+                if monitor_execution_mode == "batched":
+                    # Monitors with `partition_lookback_days` are run per partition
+                    batched_results, cicd_errors = fetch_batched_results_from_bigquery(
+                        monitors=[
+                            x
+                            for x in monitor_yaml
+                            if "partition_lookback_days" not in x
+                        ],
+                        cicd_dataset=dbt_dataset,
+                        baseline_cache=baseline_cache,
+                        history=history,
+                        max_baseline_age=max_baseline_age,
+                    )
+
+                def run(monitor: dict, cancelled: threading.Event) -> None:
+                    assert (
+                        monitor["monitor_name"] not in cicd_errors
+                    ), f"Mart monitor for {monitor['model_name']} failed on CICD dataset, likely due to an invalid query: {cicd_errors.get(monitor['monitor_name'])}"
+                    run_monitor(
+                        monitor=monitor,
+                        dbt_dataset=dbt_dataset,
+                        pr_comments=pr_comments,
+                        results=(
+                            batched_results.get(monitor["monitor_name"])
+                            if batched_results is not None
+                            else None
+                        ),
+                        cancelled=cancelled,
+                        baseline_cache=baseline_cache,
+                        estimated_bytes=estimates[monitor["monitor_name"]],
+                        partition_store=partition_store,
+                        metric_tolerances=metric_tolerances.get(
+                            monitor["monitor_name"]
+                        ),
+                        history=history,
+                        max_baseline_age=max_baseline_age,
+                    )
+
+                # Run monitors concurrently, each monitor posts its comment as soon as it finishes
+                run_monitors(
+                    monitor_yaml,
+                    run=run,
+                    max_concurrency=monitor_concurrency,
+                    project_concurrency={
+                        x: monitor_concurrency_per_project
+                        for x in MONITOR_SERVICE_ACCOUNTS.values()
+                    },
+                    # In batched mode BigQuery has already been queried, except for partitioned monitors
+                    projects_for=lambda monitor: (
+                        MONITOR_SERVICE_ACCOUNTS.values()
+                        if batched_results is None
+                        or "partition_lookback_days" in monitor
+                        else []
+                    ),
+                    timeout=monitor_timeout,
                 )
+                history.compact()
 
         except (
             Exception
@@ -371,11 +1657,10 @@ def main() -> None:
             logging.info(f"{e=}")
 
         try:
-            _, pull_request_id, target_branch = parse_command_line_args()
             compare_manifests_and_comment_impacted_models(
                 env=target_branch,
                 manifest_file_name="./.state/manifest.json",
-                pull_request_id=pull_request_id,
+                pr_comments=pr_comments,
             )
         except (
             Exception
@@ -0,0 +1,283 @@
+import base64
+import datetime
+import decimal
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, List, Mapping, Optional
+
+from google.api_core.exceptions import NotFound
+from utils import get_gcp_auth_clients
+
+# Queries using these functions return different results each day even if the table has not changed
+NON_DETERMINISTIC_FUNCTIONS = re.compile(
+    r"current_(date|datetime|time|timestamp)", re.IGNORECASE
+)
+
+
+def get_monitor_baseline_cache_dir() -> Path:
+    """Return `MONITOR_BASELINE_CACHE_DIR` (default `~/.cache/beyond-basics/monitor_baselines`)"""
+
+    return Path(
+        os.getenv(
+            "MONITOR_BASELINE_CACHE_DIR",
+            Path.home() / ".cache/beyond-basics/monitor_baselines",
+        )
+    )
+
+
+class MonitorBaselineCache:
+    """
+    Cache of stg and prd monitor results, these tables change at most once a day so only the CICD dataset needs to be
+    queried on every push to a PR.
+
+    Results are keyed by the hash of the rendered query and the `last_modified_time` of the queried table, which is
+    read from the table's metadata (no bytes are billed). Queries that use `current_date()` etc. also include
+    today's date in the key. The cache is stored on local disk in `MONITOR_BASELINE_CACHE_DIR` (default
+    `~/.cache/beyond-basics/monitor_baselines`), persist this directory between CI jobs. Every key changes once its
+    table is modified so old results are never read again, results not read for `max_age` are expired and the least
+    recently used results are evicted once the cache exceeds `max_bytes`.
+
+    Args:
+        cache_dir (str, optional): Directory of the cache, defaults to `MONITOR_BASELINE_CACHE_DIR`.
+        metadata_provider (Callable, optional): Returns the last modified time of a table, called with the
+            service account env and the table ID. Defaults to `get_table_modified_time`.
+        max_age (datetime.timedelta): Expire results that have not been read for this long.
+        max_bytes (int, optional): Size limit of the cache, defaults to `MONITOR_BASELINE_CACHE_MAX_BYTES` or 100 MB.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        metadata_provider: Optional[
+            Callable[[str, str], Optional[datetime.datetime]]
+        ] = None,
+        max_age: datetime.timedelta = datetime.timedelta(days=14),
+        max_bytes: Optional[int] = None,
+    ) -> None:
+        self.cache_dir = Path(cache_dir or get_monitor_baseline_cache_dir())
+        self.metadata_provider = metadata_provider or get_table_modified_time
+        self.max_age = max_age
+        self.max_bytes = max_bytes or int(
+            os.getenv("MONITOR_BASELINE_CACHE_MAX_BYTES", 100 * 1024**2)
+        )
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        """Return the cached results for a key, `None` if not cached"""
+
+        path = self.cache_dir / f"{key}.json"
+        try:
+            with path.open() as f:
+                results = json.load(f, object_hook=_decode_value)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        _touch(path)
+        return results
+
+    def key(self, env: str, query: str, table_id: str) -> Optional[str]:
+        """Return the cache key of a query, `None` if the table's last modified time cannot be determined"""
+
+        try:
+            last_modified_time = self.metadata_provider(env, table_id)
+        except Exception as e:  # Not caching should never fail the monitor
+            logging.info(f"{e=}")
+            last_modified_time = None
+
+        if last_modified_time is None:
+            return None
+
+        key = f"{query}\n{last_modified_time.isoformat()}"
+        if NON_DETERMINISTIC_FUNCTIONS.search(query):
+            key += f"\n{datetime.datetime.now(datetime.timezone.utc).date()}"
+
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def set(self, key: str, results: List[dict]) -> None:
+        """Cache the results of a query"""
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.cache_dir / f"{key}.json"
+        _write_json(path, results)
+
+        prune_cache_dir(
+            self.cache_dir, max_age=self.max_age, max_bytes=self.max_bytes, keep=path
+        )
+
+
+class PartitionAggregateStore:
+    """
+    Per partition results of stg and prd monitors on partitioned tables.
+
+    Each table and rendered query has one file that maps partition IDs to the partition's `last_modified_time`
+    when its results were computed, partitions only need to be recomputed when this changes. Queries that use
+    `current_date()` etc. also include today's date in the key, as in `MonitorBaselineCache`. The store is kept on
+    local disk next to the `MonitorBaselineCache` in `MONITOR_BASELINE_CACHE_DIR`, files not read for `max_age` are
+    removed.
+
+    Args:
+        cache_dir (str, optional): Directory of the store, defaults to `MONITOR_BASELINE_CACHE_DIR`/partitions.
+        max_age (datetime.timedelta): Remove files that have not been read for this long.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        max_age: datetime.timedelta = datetime.timedelta(days=14),
+    ) -> None:
+        self.cache_dir = Path(
+            cache_dir or get_monitor_baseline_cache_dir() / "partitions"
+        )
+        self.max_age = max_age
+
+    def get(self, env: str, table_id: str, query: str) -> Dict[str, dict]:
+        """Return the stored partitions, `{partition_id: {"last_modified_time": ..., "rows": [...]}}`"""
+
+        path = self._path(env, table_id, query)
+        try:
+            with path.open() as f:
+                partitions = json.load(f, object_hook=_decode_value)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+        _touch(path)
+        return partitions
+
+    def set(
+        self, env: str, table_id: str, query: str, partitions: Mapping[str, dict]
+    ) -> None:
+        """Store the partitions, see `get` for the format"""
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self._path(env, table_id, query)
+        _write_json(path, partitions)
+
+        prune_cache_dir(
+            self.cache_dir,
+            max_age=self.max_age,
+            max_bytes=int(os.getenv("MONITOR_BASELINE_CACHE_MAX_BYTES", 100 * 1024**2)),
+            keep=path,
+        )
+
+    def _path(self, env: str, table_id: str, query: str) -> Path:
+        key = f"{env}\n{table_id}\n{query}"
+        if NON_DETERMINISTIC_FUNCTIONS.search(query):
+            key += f"\n{datetime.datetime.now(datetime.timezone.utc).date()}"
+
+        return self.cache_dir / f"{hashlib.sha256(key.encode()).hexdigest()}.json"
+
+
+def get_table_modified_time(env: str, table_id: str) -> Optional[datetime.datetime]:
+    """Return the last modified time of a BigQuery table, `None` if it does not exist"""
+
+    try:
+        return get_gcp_auth_clients(env)["bigquery"].get_table(table_id).modified
+    except NotFound:
+        return None
+
+
+def get_table_partitions(env: str, table_id: str) -> Dict[str, datetime.datetime]:
+    """Return the last modified time of every partition of a BigQuery table, read from INFORMATION_SCHEMA.PARTITIONS"""
+
+    project, dataset, table = table_id.split(".")
+    query = f"""
+    select partition_id, last_modified_time
+    from `{project}.{dataset}.INFORMATION_SCHEMA.PARTITIONS`
+    where table_name = '{table}'
+    """
+    try:
+        rows = get_gcp_auth_clients(env)["bigquery"].query(query).result()
+    except NotFound:
+        return {}
+
+    return {row["partition_id"]: row["last_modified_time"] for row in rows}
+
+
+def prune_cache_dir(
+    cache_dir: Path,
+    max_age: datetime.timedelta,
+    max_bytes: int,
+    keep: Optional[Path] = None,
+) -> None:
+    """
+    Delete the files of a cache directory (not its subdirectories) that were last used more than `max_age` ago, then
+    the least recently used files until the directory is at most `max_bytes`.
+
+    Args:
+        keep (Path, optional): A file that is never deleted, e.g. the file that was just written.
+    """
+
+    oldest_mtime = (datetime.datetime.now(datetime.timezone.utc) - max_age).timestamp()
+    # Other monitors or processes can delete files at the same time, files that no longer exist are skipped
+    cached_files = []
+    for f in cache_dir.iterdir():
+        if f.suffix == ".json" and f.is_file():
+            try:
+                cached_files.append((f, f.stat()))
+            except FileNotFoundError:
+                continue
+    cached_files.sort(key=lambda x: x[1].st_mtime, reverse=True)
+
+    total_bytes = 0
+    for f, stat in cached_files:
+        if f != keep and (
+            stat.st_mtime < oldest_mtime or total_bytes + stat.st_size > max_bytes
+        ):
+            logging.debug(f"Evicting {f} from cache...")
+            f.unlink(missing_ok=True)
+        else:
+            total_bytes += stat.st_size
+
+
+def _touch(path: Path) -> None:
+    """Mark a file as used for `prune_cache_dir`, without recreating it if it was pruned since it was read"""
+
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _write_json(path: Path, value) -> None:
+    """Write a JSON file atomically, the temporary file is unique so concurrent writers do not overwrite it"""
+
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, prefix=f"{path.stem}.", suffix=".tmp", delete=False
+    ) as f:
+        try:
+            json.dump(value, f, default=_encode_value)
+        except Exception:
+            Path(f.name).unlink(missing_ok=True)
+            raise
+    Path(f.name).replace(path)
+
+
+def _decode_value(value: dict):
+    if "__decimal__" in value:
+        return decimal.Decimal(value["__decimal__"])
+    elif "__datetime__" in value:
+        return datetime.datetime.fromisoformat(value["__datetime__"])
+    elif "__date__" in value:
+        return datetime.date.fromisoformat(value["__date__"])
+    elif "__bytes__" in value:
+        return base64.b64decode(value["__bytes__"])
+
+    return value
+
+
+def _encode_value(value) -> dict:
+    # BigQuery returns NUMERIC as Decimal, keep these types so cached rows match rows returned by BigQuery
+    if isinstance(value, decimal.Decimal):
+        return {"__decimal__": str(value)}
+    elif isinstance(value, datetime.datetime):
+        return {"__datetime__": value.isoformat()}
+    elif isinstance(value, datetime.date):
+        return {"__date__": value.isoformat()}
+    elif isinstance(value, bytes):  # e.g. HLL sketches of approximate monitors
+        return {"__bytes__": base64.b64encode(value).decode()}
+
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
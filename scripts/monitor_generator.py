@@ -0,0 +1,127 @@
+import json
+import logging
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional
+
+from manifest_loader import load_manifest
+from monitor_baselines import get_monitor_baseline_cache_dir
+
+# BigQuery types in catalog.json, parameterised types (e.g. NUMERIC(10, 2)) are matched on their base type
+NUMERIC_TYPES = {"INT64", "INTEGER", "NUMERIC", "BIGNUMERIC", "FLOAT64", "FLOAT"}
+# Types that cannot be used in `count(distinct ...)`
+NON_GROUPABLE_TYPES = {"ARRAY", "STRUCT", "RECORD", "JSON", "GEOGRAPHY"}
+
+
+def build_profiling_query(columns: Mapping[str, str]) -> str:
+    """
+    Build a monitor query that profiles every column of a table in a single scan.
+
+    The query returns the row count and, per column, the number of nulls and distinct values, plus the sum, min and
+    max of numeric columns. Nested columns (`parent.child`) are profiled as part of their parent.
+
+    Args:
+        columns (Mapping[str, str]): Column name to BigQuery data type, as in catalog.json.
+    """
+
+    metrics = ["'{{ env }}' as table_name", "count(*) as row_cnt"]
+    for name, data_type in columns.items():
+        if "." in name:
+            continue
+
+        base_type = data_type.upper().split("<")[0].split("(")[0].strip()
+        metrics.append(f"countif(`{name}` is null) as null_{name}")
+        if base_type not in NON_GROUPABLE_TYPES:
+            metrics.append(f"count(distinct `{name}`) as distinct_{name}")
+        if base_type in NUMERIC_TYPES:
+            metrics.extend(
+                [
+                    f"sum(`{name}`) as sum_{name}",
+                    f"min(`{name}`) as min_{name}",
+                    f"max(`{name}`) as max_{name}",
+                ]
+            )
+
+    return "select\n  " + ",\n  ".join(metrics) + "\nfrom {{ table_name }}\n"
+
+
+def generate_monitors(
+    monitors: List[Mapping],
+    manifest_path: str = "./target/manifest.json",
+    catalog_path: str = "./target/catalog.json",
+    cache_dir: Optional[str] = None,
+) -> List[Dict[str, str]]:
+    """
+    Generate a profiling monitor (see `build_profiling_query`) for every mart without a monitor in `monitors`.
+
+    Column types are read from catalog.json. Generated queries are stored per model with the model's checksum in
+    `cache_dir` (default `MONITOR_BASELINE_CACHE_DIR`/generated_monitors) and are reused while the checksum is
+    unchanged, e.g. when catalog.json does not exist. Marts that have neither are logged and skipped.
+
+    Args:
+        monitors (List[Mapping]): Hand-written monitors from mart_monitor_queries.yml, these override generated
+            monitors.
+        manifest_path (str): Path to manifest.json, marts are models with the `marts` tag.
+        catalog_path (str): Path to catalog.json.
+        cache_dir (str, optional): Directory of the generated queries.
+    """
+
+    cache_dir = Path(
+        cache_dir or get_monitor_baseline_cache_dir() / "generated_monitors"
+    )
+    try:
+        with Path(catalog_path).open() as f:
+            catalog_nodes = json.load(f)["nodes"]
+    except FileNotFoundError:
+        logging.info(
+            f"{catalog_path} does not exist, using cached generated monitors..."
+        )
+        catalog_nodes = {}
+
+    monitored_models = {x["model_name"] for x in monitors}
+    generated_monitors = []
+    for unique_id, node in load_manifest(manifest_path)["nodes"].items():
+        if (
+            node["resource_type"] != "model"
+            or "marts" not in node["tags"]
+            or node["name"] in monitored_models
+        ):
+            continue
+
+        checksum = node["checksum"]["checksum"]
+        cache_path = cache_dir / f"{node['name']}.json"
+        if unique_id in catalog_nodes:
+            query = build_profiling_query(
+                {
+                    v["name"]: v["type"]
+                    for v in sorted(
+                        catalog_nodes[unique_id]["columns"].values(),
+                        key=lambda x: x["index"],
+                    )
+                }
+            )
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            with cache_path.open("w") as f:
+                json.dump({"checksum": checksum, "query": query}, f)
+        else:
+            try:
+                with cache_path.open() as f:
+                    cached = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                cached = {}
+            if cached.get("checksum") != checksum:
+                logging.info(
+                    f"{node['name']}: No column types in catalog.json, not generating a monitor..."
+                )
+                continue
+            query = cached["query"]
+
+        logging.info(f"{node['name']}: Generated monitor...")
+        generated_monitors.append(
+            {
+                "monitor_name": f"{node['name']} generated monitor",
+                "model_name": node["name"],
+                "query": query,
+            }
+        )
+
+    return generated_monitors
@@ -0,0 +1,297 @@
+import datetime
+import hashlib
+import logging
+import os
+import uuid
+from decimal import Decimal
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Diff of every metric between an environment and CICD over the latest `max_runs` CICD results, paired with the latest
+# environment result recorded at or before each CICD result
+METRIC_TOLERANCES_QUERY = """
+WITH history AS (
+    SELECT * FROM read_parquet($history_files, union_by_name = true)
+    WHERE query_hash = $query_hash
+),
+
+cicd AS (
+    SELECT recorded_at, metric, value FROM history
+    WHERE
+        table_name = 'cicd'
+        AND recorded_at IN (
+            SELECT DISTINCT recorded_at FROM history
+            WHERE table_name = 'cicd'
+            ORDER BY recorded_at DESC
+            LIMIT $max_runs
+        )
+),
+
+envs AS (
+    SELECT recorded_at, table_name, metric, value FROM history WHERE table_name != 'cicd'
+),
+
+diffs AS (
+    SELECT
+        cicd.metric,
+        ((envs.value / cicd.value) - 1) * 100 AS diff_pct
+    FROM cicd
+    CROSS JOIN (SELECT DISTINCT table_name FROM envs) AS env_names
+    ASOF JOIN envs
+        ON envs.table_name = env_names.table_name
+        AND envs.metric = cicd.metric
+        AND cicd.recorded_at >= envs.recorded_at
+    WHERE cicd.value != 0
+)
+
+SELECT metric, 2 * STDDEV_SAMP(diff_pct) AS tolerance
+FROM diffs
+GROUP BY metric
+HAVING COUNT(diff_pct) >= $min_runs
+"""
+
+
+class MonitorHistoryStore:
+    """
+    History of monitor results, stored as Parquet files and queried with DuckDB.
+
+    Every result queried from BigQuery is appended as one row per metric, identified by the hash of the monitor's
+    query template. Each value is stored exactly (with its type, so integers and NUMERICs keep their precision) and
+    as a float, the float is only used to compute tolerances. The history is used to reuse stg and prd results that are recent enough (`get_baseline`) and to
+    derive the threshold of each metric from how much it has historically differed from CICD (`metric_tolerances`).
+    The history is stored on local disk in `MONITOR_HISTORY_DIR` (default `~/.cache/beyond-basics/monitor_history`),
+    persist this directory between CI jobs. `compact` removes results older than `retention` and merges the small
+    files written by each append.
+
+    Args:
+        history_dir (str, optional): Directory of the history, defaults to `MONITOR_HISTORY_DIR`.
+        retention (datetime.timedelta): Results older than this are removed when the history is compacted.
+    """
+
+    def __init__(
+        self,
+        history_dir: Optional[str] = None,
+        retention: datetime.timedelta = datetime.timedelta(days=90),
+    ) -> None:
+        self.history_dir = Path(
+            history_dir
+            or os.getenv(
+                "MONITOR_HISTORY_DIR",
+                Path.home() / ".cache/beyond-basics/monitor_history",
+            )
+        )
+        self.retention = retention
+        self._connection = duckdb.connect(database=":memory:")
+
+    def append(
+        self,
+        query_template: str,
+        model_name: str,
+        rows: List[dict],
+        recorded_at: Optional[datetime.datetime] = None,
+    ) -> None:
+        """Append the rows returned by a monitor query, each file is written once so monitors can append concurrently"""
+
+        recorded_at = recorded_at or datetime.datetime.now(datetime.timezone.utc)
+        columns: Dict[str, list] = {
+            "recorded_at": [],
+            "query_hash": [],
+            "model_name": [],
+            "table_name": [],
+            "metric_index": [],
+            "metric": [],
+            "value": [],
+            "exact_value": [],
+            "value_type": [],
+        }
+        for row in rows:
+            metrics = [k for k in row.keys() if k != "table_name"]
+            for metric_index, metric in enumerate(metrics):
+                columns["recorded_at"].append(recorded_at)
+                columns["query_hash"].append(_hash_query(query_template))
+                columns["model_name"].append(model_name)
+                columns["table_name"].append(row["table_name"])
+                columns["metric_index"].append(metric_index)
+                columns["metric"].append(metric)
+                columns["value"].append(
+                    float(row[metric]) if row[metric] is not None else None
+                )
+                exact_value, value_type = _encode_value(row[metric])
+                columns["exact_value"].append(exact_value)
+                columns["value_type"].append(value_type)
+
+        if not columns["metric"]:
+            return
+
+        self.history_dir.mkdir(parents=True, exist_ok=True)
+        path = self._new_path(recorded_at)
+        pq.write_table(
+            pa.table(
+                {
+                    **columns,
+                    "recorded_at": pa.array(
+                        columns["recorded_at"], type=pa.timestamp("us", tz="UTC")
+                    ),
+                    "metric_index": pa.array(columns["metric_index"], type=pa.int32()),
+                    "value": pa.array(columns["value"], type=pa.float64()),
+                    "exact_value": pa.array(columns["exact_value"], type=pa.string()),
+                    "value_type": pa.array(columns["value_type"], type=pa.string()),
+                }
+            ),
+            path.with_suffix(".tmp"),
+        )
+        path.with_suffix(".tmp").replace(path.with_suffix(".parquet"))
+
+    def get_baseline(
+        self, query_template: str, table_name: str, max_age: datetime.timedelta
+    ) -> Optional[List[dict]]:
+        """Return the latest result of an environment if recorded less than `max_age` ago, `None` otherwise"""
+
+        rows = self._execute(
+            """
+            SELECT metric, value, exact_value, value_type
+            FROM read_parquet($history_files, union_by_name = true)
+            WHERE
+                query_hash = $query_hash
+                AND table_name = $table_name
+                AND recorded_at = (
+                    SELECT MAX(recorded_at)
+                    FROM read_parquet($history_files, union_by_name = true)
+                    WHERE query_hash = $query_hash AND table_name = $table_name
+                )
+                AND recorded_at >= $min_recorded_at
+            ORDER BY metric_index
+            """,
+            {
+                "query_hash": _hash_query(query_template),
+                "table_name": table_name,
+                "min_recorded_at": datetime.datetime.now(datetime.timezone.utc)
+                - max_age,
+            },
+        )
+        if not rows:
+            return None
+
+        return [
+            {
+                "table_name": table_name,
+                **{
+                    metric: _decode_value(value, exact_value, value_type)
+                    for metric, value, exact_value, value_type in rows
+                },
+            }
+        ]
+
+    def metric_tolerances(
+        self,
+        query_template: str,
+        min_runs: int = 5,
+        max_runs: int = 30,
+        max_tolerance: float = 5.0,
+    ) -> Dict[str, float]:
+        """
+        Return the tolerance (in percent) of each metric, two standard deviations of its difference from CICD over
+        the latest `max_runs` CICD results. Metrics with fewer than `min_runs` results are left out, tolerances are
+        capped at `max_tolerance`.
+        """
+
+        rows = self._execute(
+            METRIC_TOLERANCES_QUERY,
+            {
+                "query_hash": _hash_query(query_template),
+                "min_runs": min_runs,
+                "max_runs": max_runs,
+            },
+        )
+
+        return {
+            metric: round(min(tolerance, max_tolerance), 1)
+            for metric, tolerance in rows
+            if tolerance is not None
+        }
+
+    def compact(self, max_files: int = 50) -> None:
+        """
+        Remove results older than `retention` and merge the history into a single file, once it has more than
+        `max_files` files. Files appended while compacting are kept as is.
+        """
+
+        history_files = sorted(self.history_dir.glob("*.parquet"))
+        if len(history_files) <= max_files:
+            return
+
+        logging.info(f"Compacting {len(history_files)} monitor history files...")
+        now = datetime.datetime.now(datetime.timezone.utc)
+        path = self._new_path(now)
+        cursor = self._connection.cursor()
+        try:
+            history = cursor.read_parquet(
+                [str(x) for x in history_files], union_by_name=True
+            )
+            history.filter(
+                f"recorded_at >= '{(now - self.retention).isoformat()}'::TIMESTAMPTZ"
+            ).order("recorded_at").write_parquet(str(path.with_suffix(".tmp")))
+        except duckdb.Error as e:  # An unreadable history should never fail the monitor
+            logging.info(f"{e=}")
+            return
+        finally:
+            cursor.close()
+
+        path.with_suffix(".tmp").replace(path.with_suffix(".parquet"))
+        for history_file in history_files:
+            history_file.unlink(missing_ok=True)
+
+    def _new_path(self, recorded_at: datetime.datetime) -> Path:
+        return self.history_dir / f"{recorded_at:%Y%m%d%H%M%S}-{uuid.uuid4().hex}"
+
+    def _execute(self, query: str, parameters: dict) -> list:
+        history_files = sorted(str(x) for x in self.history_dir.glob("*.parquet"))
+        if not history_files:
+            return []
+
+        cursor = self._connection.cursor()
+        try:
+            return cursor.execute(
+                query, {"history_files": history_files, **parameters}
+            ).fetchall()
+        except duckdb.Error as e:  # An unreadable history should never fail the monitor
+            logging.info(f"{e=}")
+            return []
+        finally:
+            cursor.close()
+
+
+def _hash_query(query_template: str) -> str:
+    return hashlib.sha256(query_template.encode()).hexdigest()
+
+
+def _encode_value(value: Any) -> Tuple[Optional[str], Optional[str]]:
+    """Return a metric value as an exact string and its type, e.g. ("9007199254740993", "int")"""
+
+    if value is None:
+        return None, None
+    if isinstance(value, Decimal):
+        return str(value), "decimal"
+    if isinstance(value, int):
+        return str(int(value)), "int"
+
+    return repr(float(value)), "float"
+
+
+def _decode_value(
+    value: Optional[float], exact_value: Optional[str], value_type: Optional[str]
+) -> Any:
+    """Return the value of `_encode_value`, results recorded before exact values were stored are floats"""
+
+    if exact_value is None:
+        return value
+    if value_type == "decimal":
+        return Decimal(exact_value)
+    if value_type == "int":
+        return int(exact_value)
+
+    return float(exact_value)
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional
+
+
+class MonitorCancelledError(Exception):
+    pass
+
+
+class MonitorOutcome(NamedTuple):
+    """The result of running a single monitor, `status` is one of "ok", "failed" or "timed_out"."""
+
+    monitor_name: str
+    status: str
+    duration: float
+    error: Optional[str] = None
+
+
+async def schedule_monitors(
+    monitors: List[Mapping],
+    run: Callable[[Mapping, threading.Event], None],
+    max_concurrency: int = 8,
+    project_concurrency: Optional[Mapping[str, int]] = None,
+    projects_for: Optional[Callable[[Mapping], Iterable[str]]] = None,
+    timeout: Optional[float] = 600,
+    on_outcome: Optional[Callable[[MonitorOutcome], None]] = None,
+) -> List[MonitorOutcome]:
+    """
+    Run monitors in worker threads and return their outcomes in the order they finished.
+
+    Each monitor waits for a slot in `max_concurrency` and in the semaphores of every GCP project it queries
+    (`projects_for`, limited by `project_concurrency`). A monitor that runs longer than `timeout` seconds, or that is
+    running when the scheduler is cancelled, has its `threading.Event` set; `run` is expected to check this event
+    and raise `MonitorCancelledError`. A timed out monitor keeps its slots until `run` returns. Exceptions raised by
+    `run` are recorded in the outcome, not raised.
+
+    Args:
+        monitors (List[Mapping]): Monitors from mart_monitor_queries.yml.
+        run (Callable): Function that runs a single monitor, called with the monitor and its cancellation event.
+        max_concurrency (int): Maximum number of monitors that run at once.
+        project_concurrency (Mapping[str, int], optional): Maximum number of monitors that run at once per project.
+        projects_for (Callable, optional): Returns the projects a monitor queries.
+        timeout (float, optional): Deadline in seconds for each monitor, `None` to wait indefinitely.
+        on_outcome (Callable, optional): Called with each outcome as soon as its monitor finishes.
+    """
+
+    loop = asyncio.get_running_loop()
+    # Concurrency is limited by the semaphores, a monitor keeps its slots until its thread has stopped
+    executor = ThreadPoolExecutor(max_workers=max(len(monitors), 1))
+    slots = asyncio.Semaphore(max_concurrency)
+    project_slots: Dict[str, asyncio.Semaphore] = {
+        k: asyncio.Semaphore(v) for k, v in (project_concurrency or {}).items()
+    }
+    outcomes: List[MonitorOutcome] = []
+
+    async def run_with_deadline(monitor: Mapping) -> None:
+        # Acquire project semaphores in a fixed order so monitors sharing projects cannot deadlock
+        semaphores = [slots] + [
+            project_slots[x]
+            for x in sorted(set(projects_for(monitor) if projects_for else []))
+            if x in project_slots
+        ]
+        acquired: List[asyncio.Semaphore] = []
+        cancelled = threading.Event()
+        start_time = time.monotonic()
+        try:
+            for semaphore in semaphores:
+                await semaphore.acquire()
+                acquired.append(semaphore)
+
+            # The deadline starts once the monitor has a slot
+            start_time = time.monotonic()
+            future = loop.run_in_executor(executor, run, monitor, cancelled)
+            await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+            outcome = MonitorOutcome(
+                monitor["monitor_name"], "ok", time.monotonic() - start_time
+            )
+        except asyncio.TimeoutError:
+            cancelled.set()
+            outcome = MonitorOutcome(
+                monitor["monitor_name"],
+                "timed_out",
+                time.monotonic() - start_time,
+                f"Exceeded deadline of {timeout} seconds",
+            )
+            # Keep the slots until the worker has stopped, otherwise more monitors run than the concurrency limits
+            await asyncio.wait([future])
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        except Exception as e:
+            outcome = MonitorOutcome(
+                monitor["monitor_name"],
+                "failed",
+                time.monotonic() - start_time,
+                f"{type(e).__name__}: {e}",
+            )
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+
+        logging.info(
+            f"{outcome.monitor_name}: {outcome.status} in {outcome.duration:.2f} seconds..."
+        )
+        outcomes.append(outcome)
+        if on_outcome is not None:
+            on_outcome(outcome)
+
+    try:
+        await asyncio.gather(*[run_with_deadline(x) for x in monitors])
+    finally:
+        # Threads of cancelled monitors stop when they next check their event
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    return outcomes
+
+
+def run_monitors(monitors: List[Mapping], **kwargs) -> List[MonitorOutcome]:
+    """Run `schedule_monitors` in a new event loop, see `schedule_monitors` for arguments"""
+
+    outcomes = asyncio.run(schedule_monitors(monitors, **kwargs))
+
+    summary = {
+        status: len([x for x in outcomes if x.status == status])
+        for status in ["ok", "failed", "timed_out"]
+    }
+    logging.info(f"Monitor outcomes: {summary}")
+    for outcome in outcomes:
+        if outcome.status != "ok":
+            logging.info(f"{outcome.monitor_name}: {outcome.error}")
+
+    return outcomes
@@ -1,8 +1,13 @@
 import argparse
+import datetime
+import json
 import logging
 import os
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
 
-from retry import retry
+from manifest_loader import ManifestIndex
+from manifest_state import load_manifest_state_comparison
+from retry.api import retry_call
 from utils import (
     ManifestInitRunError,
     call_github_api,
@@ -12,12 +17,247 @@ from utils import (
     set_logging_options,
 )
 
+# Models that call this macro only process the partitions between the `backfill_start_date` and `backfill_end_date`
+# vars when these are set
+BACKFILL_FILTER_MACRO = "macro.beyond_basics.backfill_partition_filter"
 
-@retry(tries=3, delay=5)
-def run_dbt_backfill(env: str) -> None:
+# Granularities whose partitions are never split by a chunk boundary, chunks are whole days
+BACKFILL_GRANULARITIES = {"hour", "day"}
+
+# Chunks are run without `--full-refresh`, with the default `on_schema_change` (ignore) new columns would never be
+# added to the table
+BACKFILL_ON_SCHEMA_CHANGE = {"append_new_columns", "sync_all_columns"}
+
+
+class BackfillChunk(NamedTuple):
+    """A range of partitions to backfill, `end_date` is exclusive"""
+
+    start_date: datetime.date
+    end_date: datetime.date
+    models: List[str]
+
+
+class BackfillPlan(NamedTuple):
+    """
+    The dbt runs of a backfill: `full_refresh_models` are fully refreshed before the `chunks` are backfilled and
+    `downstream_models`, the models downstream of partition-scoped models, are fully refreshed afterwards.
+    """
+
+    full_refresh_models: List[str]
+    chunks: List[BackfillChunk]
+    downstream_models: List[str]
+
+
+def supports_partition_backfill(node: Mapping) -> bool:
+    """
+    Return if a model can be backfilled per partition, i.e. it is an `insert_overwrite` incremental model with a
+    daily or hourly `partition_by` config that calls the `backfill_partition_filter` macro. The model must also set
+    `on_schema_change` to `append_new_columns` or `sync_all_columns` so column changes are applied to the table,
+    other models are fully refreshed.
+    """
+
+    config = node.get("config", {})
+    partition_by = config.get("partition_by") or {}
+    return (
+        config.get("materialized") == "incremental"
+        and config.get("incremental_strategy") == "insert_overwrite"
+        and partition_by.get("data_type", "date") in {"date", "timestamp", "datetime"}
+        and partition_by.get("granularity", "day") in BACKFILL_GRANULARITIES
+        and config.get("on_schema_change", "ignore") in BACKFILL_ON_SCHEMA_CHANGE
+        and BACKFILL_FILTER_MACRO in node.get("depends_on", {}).get("macros", [])
+    )
+
+
+def get_backfill_window(
+    node: Mapping,
+    start_date: Optional[datetime.date] = None,
+    end_date: Optional[datetime.date] = None,
+    lookback_days: Optional[int] = None,
+    today: Optional[datetime.date] = None,
+) -> Optional[Tuple[datetime.date, datetime.date]]:
+    """
+    Return the partitions of a model to backfill as a start date and an exclusive end date, `None` if there is no
+    window and the model needs to be fully refreshed.
+
+    Args:
+        node (Mapping): The model in manifest.json.
+        start_date (datetime.date, optional): First partition to backfill, takes precedence over lookback windows.
+        end_date (datetime.date, optional): Last partition to backfill, defaults to today.
+        lookback_days (int, optional): Number of days to backfill, the `backfill_lookback_days` meta of the model
+            takes precedence.
+        today (datetime.date, optional): Defaults to the current UTC date.
+    """
+
+    today = today or datetime.datetime.now(datetime.timezone.utc).date()
+    end_date = (end_date or today) + datetime.timedelta(days=1)
+    if start_date is None:
+        lookback_days = (
+            node.get("config", {})
+            .get("meta", {})
+            .get("backfill_lookback_days", lookback_days)
+        )
+        if lookback_days is None:
+            return None
+        start_date = today - datetime.timedelta(days=int(lookback_days))
+
+    assert start_date < end_date, f"{start_date=} must be before {end_date=}."
+    return start_date, end_date
+
+
+def build_partition_chunks(
+    windows: Mapping[str, Tuple[datetime.date, datetime.date]], chunk_days: int = 30
+) -> List[BackfillChunk]:
+    """
+    Split the backfill windows of models into chunks of at most `chunk_days` days.
+
+    Chunks are also split where a window starts or ends so every model in a chunk backfills the whole chunk. Within a
+    chunk dbt runs the models in DAG order.
+
+    Args:
+        windows (Mapping[str, Tuple[datetime.date, datetime.date]]): Model name to its backfill window, the end date
+            is exclusive.
+        chunk_days (int): The maximum number of days per dbt run.
+    """
+
+    assert chunk_days > 0, "chunk_days must be positive."
+    if not windows:
+        return []
+
+    start_date = min(x[0] for x in windows.values())
+    end_date = max(x[1] for x in windows.values())
+    boundaries = sorted(
+        {
+            start_date + datetime.timedelta(days=x)
+            for x in range(0, (end_date - start_date).days, chunk_days)
+        }
+        | {x for window in windows.values() for x in window}
+    )
+
+    chunks = []
+    for chunk_start, chunk_end in zip(boundaries, boundaries[1:]):
+        models = sorted(
+            k for k, (x, y) in windows.items() if x <= chunk_start and chunk_end <= y
+        )
+        if models:
+            chunks.append(BackfillChunk(chunk_start, chunk_end, models))
+
+    return chunks
+
+
+def plan_backfill(
+    manifest: Mapping,
+    index: ManifestIndex,
+    unique_ids: List[str],
+    start_date: Optional[datetime.date] = None,
+    end_date: Optional[datetime.date] = None,
+    lookback_days: Optional[int] = None,
+    chunk_days: int = 30,
+    today: Optional[datetime.date] = None,
+) -> BackfillPlan:
+    """
+    Plan the backfill of modified models and their downstream models.
+
+    Models that support partition backfills (see `supports_partition_backfill`) and have a window (see
+    `get_backfill_window`) are backfilled in chunks, all other models are fully refreshed. If a fully refreshed model
+    is both downstream and upstream of partition-scoped models no order of runs is correct and all models are fully
+    refreshed.
+
+    Args:
+        manifest (Mapping): The current manifest.json.
+        index (ManifestIndex): Index of `manifest`.
+        unique_ids (List[str]): The models selected by `state:modified+`.
+    """
+
+    windows: Dict[str, Tuple[datetime.date, datetime.date]] = {}
+    for unique_id in unique_ids:
+        node = manifest["nodes"][unique_id]
+        if supports_partition_backfill(node):
+            window = get_backfill_window(
+                node,
+                start_date=start_date,
+                end_date=end_date,
+                lookback_days=lookback_days,
+                today=today,
+            )
+            if window is not None:
+                windows[unique_id] = window
+
+    downstream_ids = (index.descendants(windows) & set(unique_ids)) - windows.keys()
+    if any(
+        index.descendants(index.children(x)) & windows.keys() for x in downstream_ids
+    ):
+        logging.info(
+            "Fully refreshed models are upstream of partition-scoped models, fully refreshing all models..."
+        )
+        windows, downstream_ids = {}, set()
+
+    def names(ids: Iterable[str]) -> List[str]:
+        return sorted(manifest["nodes"][x]["name"] for x in ids)
+
+    return BackfillPlan(
+        full_refresh_models=names(set(unique_ids) - windows.keys() - downstream_ids),
+        chunks=build_partition_chunks(
+            {manifest["nodes"][k]["name"]: v for k, v in windows.items()},
+            chunk_days=chunk_days,
+        ),
+        downstream_models=names(downstream_ids),
+    )
+
+
+def run_backfill_plan(
+    plan: BackfillPlan, env: str, tries: int = 3, delay: float = 5
+) -> None:
+    """
+    Run the dbt builds of a backfill plan, see `BackfillPlan`.
+
+    Each dbt build is retried on its own (up to `tries` times, `delay` seconds apart), so a failed chunk does not
+    run the full refresh and the chunks before it again.
+    """
+
+    def run(dbt_command: str) -> None:
+        retry_call(run_dbt_command, fargs=[dbt_command], tries=tries, delay=delay)
+
+    # Fully refresh modified nodes and their downstream dependencies, except partition-scoped models
+    partition_models = sorted({x for chunk in plan.chunks for x in chunk.models})
+    exclude = " ".join(partition_models + plan.downstream_models)
+    run(
+        f"dbt build --select state:modified+,package:beyond_basics --state ./.state --full-refresh --target {env}"
+        + (f" --exclude {exclude}" if exclude else "")
+    )
+
+    for chunk in plan.chunks:
+        logging.info(
+            f"Backfilling {chunk.start_date} to {chunk.end_date} for {chunk.models}..."
+        )
+        backfill_vars = json.dumps(
+            {
+                "backfill_start_date": chunk.start_date.isoformat(),
+                "backfill_end_date": chunk.end_date.isoformat(),
+            },
+            separators=(",", ":"),
+        )
+        run(
+            f"dbt build --select {' '.join(chunk.models)} --vars {backfill_vars} --target {env}"
+        )
+
+    if plan.downstream_models:
+        run(
+            f"dbt build --select {' '.join(plan.downstream_models)} --full-refresh --target {env}"
+        )
+
+
+def run_dbt_backfill(
+    env: str,
+    start_date: Optional[datetime.date] = None,
+    end_date: Optional[datetime.date] = None,
+    lookback_days: Optional[int] = None,
+    chunk_days: int = 30,
+) -> None:
     """
     Download the previous version of manifest.json from GCS and use dbt's "--state" flag identify modified nodes.
-    If there are modified nodes, fully refresh them and their downstream nodes.
+    If there are modified nodes, backfill them and their downstream nodes, see `plan_backfill`. Partition-scoped
+    models are run in chunks with the `backfill_start_date` and `backfill_end_date` vars, all other nodes are fully
+    refreshed. Each dbt build is retried on its own, see `run_backfill_plan`.
     """
 
     # Download previous manifest.json to ./.state directory
@@ -30,9 +270,13 @@ def run_dbt_backfill(env: str) -> None:
         env=env, destination_file_name="./target/manifest.json", version="latest"
     )
 
-    # List modified nodes
-    modified_nodes_raw = run_dbt_command(
-        f"dbt --quiet ls --select state:modified,package:beyond_basics --state ./.state --resource-type model --target {env}"
+    # List modified nodes, the latest manifest.json is the state of the merged commit so no dbt parse is needed
+    comparison = load_manifest_state_comparison(
+        previous_manifest_path="./.state/manifest.json",
+        current_manifest_path="./target/manifest.json",
+    )
+    modified_nodes_raw = comparison.select(
+        resource_types=["model"], package_name="beyond_basics"
     )
 
     if len(modified_nodes_raw) > 0:
@@ -54,10 +298,20 @@ def run_dbt_backfill(env: str) -> None:
             message=f"The [CD pipeline]({workflow_url}) has started the backfill process...",
         )
 
-        # Fully refresh modified nodes and their downstream dependencies
-        run_dbt_command(
-            f"dbt build --select state:modified+,package:beyond_basics --state ./.state --full-refresh --target {env}"
+        plan = plan_backfill(
+            manifest=comparison.current_manifest,
+            index=comparison.index,
+            unique_ids=comparison.select(
+                downstream=True, resource_types=["model"], package_name="beyond_basics"
+            ),
+            start_date=start_date,
+            end_date=end_date,
+            lookback_days=lookback_days,
+            chunk_days=chunk_days,
         )
+        logging.info(f"{plan=}")
+
+        run_backfill_plan(plan, env)
 
         send_github_pr_comment(
             pull_request_id=pull_request_id,
@@ -77,10 +331,35 @@ def main() -> None:
         help="The branch that has been merged into",
         required=True,
     )
+    parser.add_argument(
+        "--backfill-start-date",
+        help="First partition (YYYY-MM-DD) to backfill of partition-scoped models, takes precedence over lookback windows",
+        type=datetime.date.fromisoformat,
+    )
+    parser.add_argument(
+        "--backfill-end-date",
+        help="Last partition (YYYY-MM-DD) to backfill of partition-scoped models, defaults to today",
+        type=datetime.date.fromisoformat,
+    )
+    parser.add_argument(
+        "--backfill-lookback-days",
+        help="Number of days to backfill of partition-scoped models without a `backfill_lookback_days` meta",
+        type=int,
+    )
+    parser.add_argument(
+        "--backfill-chunk-days",
+        default=30,
+        help="Maximum number of days of partitions per dbt run",
+        type=int,
+    )
     args = parser.parse_args()
 
     target_branch = args.target_branch
     logging.info(f"{target_branch=}")
+    logging.info(f"{args.backfill_start_date=}")
+    logging.info(f"{args.backfill_end_date=}")
+    logging.info(f"{args.backfill_lookback_days=}")
+    logging.info(f"{args.backfill_chunk_days=}")
 
     try:
         download_manifest_json(
@@ -94,7 +373,13 @@ def main() -> None:
     if (
         "init_run" not in locals()
     ):  # i.e. on initial run no manifest.json to compare with so need to skip
-        run_dbt_backfill(target_branch)
+        run_dbt_backfill(
+            target_branch,
+            start_date=args.backfill_start_date,
+            end_date=args.backfill_end_date,
+            lookback_days=args.backfill_lookback_days,
+            chunk_days=args.backfill_chunk_days,
+        )
 
 
 if __name__ == "__main__":
@@ -4,7 +4,13 @@ import os
 from datetime import datetime
 
 from git import Repo
-from utils import call_github_api, set_logging_options, upload_to_gcs
+from utils import (
+    call_github_api,
+    get_gcp_auth_clients,
+    set_logging_options,
+    update_manifest_index,
+    upload_to_gcs,
+)
 
 
 def get_latest_commit_hash(target_branch: str) -> str:
@@ -30,10 +36,18 @@ def main() -> None:
         help="The branch that has been merged into",
         required=True,
     )
+    parser.add_argument(
+        "--compression",
+        choices=["gzip", "none"],
+        default="gzip",
+        help="Compression of the uploaded manifest.json, `download_manifest_json` reads both",
+    )
     args = parser.parse_args()
 
     target_branch = args.target_branch
     logging.info(f"{target_branch=}")
+    compression = None if args.compression == "none" else args.compression
+    logging.info(f"{compression=}")
 
     github_run_number = os.getenv("GITHUB_RUN_NUMBER", "local_run")
     logging.info(f"{github_run_number=}")
@@ -47,12 +61,24 @@ def main() -> None:
         logging.info(
             "Current branch is the HEAD of the target branch, proceeding to upload..."
         )
-        upload_to_gcs(
+        bucket_name = f"beyond-basics-dbt-manifests-{target_branch}"
+        blob_name = upload_to_gcs(
             env=target_branch,
-            bucket_name=f"beyond-basics-dbt-manifests-{target_branch}",
+            bucket_name=bucket_name,
             upload_directory=f"uploaded_at={datetime.utcnow()}/github_run_number={github_run_number}",
             file_to_upload="./target/manifest.json",
+            compression=compression,
         )
+
+        # Local runs do not have a build number, these are not added to the index (nor found by scanning the bucket)
+        if github_run_number.isdigit():
+            update_manifest_index(
+                bucket=get_gcp_auth_clients(target_branch)["storage"].bucket(
+                    bucket_name
+                ),
+                build_number=int(github_run_number),
+                blob_name=blob_name,
+            )
     else:
         logging.info(
             "Current branch is not at the the HEAD of the target branch, upload cancelled."
@@ -1,18 +1,154 @@
+import base64
+import gzip
+import hashlib
 import json
 import logging
 import os
 import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from pathlib import Path
-from typing import Any, List, Mapping, Optional, Union
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlparse
 
 import requests
-from dbt.cli.main import dbtRunner
+import yaml
+from dbt.cli.main import dbtRunner, dbtRunnerResult
+from google.api_core.exceptions import PreconditionFailed
 from google.cloud import bigquery, storage
 from google.oauth2 import service_account
+from requests.adapters import HTTPAdapter
 from retry import retry
 
 
+class DbtSession:
+    """
+    Parse a dbt project once and pass the manifest to later `dbtRunner` invocations.
+
+    A manifest is reused as long as the parse arguments (target, vars, etc.), the `DBT_*` environment variables and
+    the project files are unchanged, any change to these results in a re-parse.
+    """
+
+    parse_flags = {"--target", "-t", "--vars", "--profiles-dir", "--project-dir"}
+
+    def __init__(self, project_dir: str = ".") -> None:
+        self.project_dir = Path(project_dir)
+        self._manifests: Dict[Tuple, Any] = {}
+        self._lock = threading.RLock()
+
+    def _project_fingerprint(self) -> str:
+        """Hash of the path, size and modification time of every file dbt reads when parsing the project"""
+
+        with (self.project_dir / "dbt_project.yml").open() as f:
+            project_yml = yaml.safe_load(f)
+
+        paths = [
+            self.project_dir / x
+            for key in [
+                "analysis-paths",
+                "macro-paths",
+                "model-paths",
+                "seed-paths",
+                "snapshot-paths",
+                "test-paths",
+            ]
+            for x in project_yml.get(key, [])
+        ] + [self.project_dir / "dbt_packages"]
+        files = [
+            self.project_dir / x
+            for x in [
+                "dbt_project.yml",
+                "dependencies.yml",
+                "packages.yml",
+                "profiles.yml",
+            ]
+        ] + [f for path in paths if path.exists() for f in path.rglob("*")]
+
+        fingerprint = hashlib.sha256()
+        for f in sorted(files):
+            if f.is_file():
+                stat = f.stat()
+                fingerprint.update(f"{f}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        return fingerprint.hexdigest()
+
+    def get_manifest(self, parse_args: List[str]) -> Any:
+        """Return the parsed manifest for a set of parse arguments, parsing the project if required"""
+
+        key = (
+            tuple(parse_args),
+            tuple(
+                sorted((k, v) for k, v in os.environ.items() if k.startswith("DBT_"))
+            ),
+            self._project_fingerprint(),
+        )
+        with self._lock:
+            if key not in self._manifests:
+                start_time = time.monotonic()
+                res = dbtRunner().invoke(["--quiet", "parse"] + parse_args)
+                if res.exception or not res.success:
+                    raise RuntimeError("dbt parse did not complete successfully.")
+                logging.info(
+                    f"Parsed dbt project in {time.monotonic() - start_time:.2f} seconds..."
+                )
+                self._manifests = {key: res.result}
+
+            return self._manifests[key]
+
+    def get_parse_args(self, args: List[str]) -> List[str]:
+        """
+        Return the parse arguments of a dbt command, e.g. ["--target", "stg"] for ["ls", "--target=stg"]
+
+        Both `--flag value` and `--flag=value` are returned as `--flag value`, so these reuse the same manifest.
+        """
+
+        parse_args = []
+        for index, arg in enumerate(args):
+            flag, _, value = arg.partition("=")
+            if flag in self.parse_flags and value:
+                parse_args += [flag, value]
+            elif arg in self.parse_flags and index + 1 < len(args):
+                parse_args += [arg, args[index + 1]]
+
+        return parse_args
+
+    def invoke(self, args: List[str]) -> dbtRunnerResult:
+        """Invoke a dbt command using the cached manifest, e.g. ["ls", "--select", "tag:marts"]"""
+
+        with self._lock:
+            manifest = self.get_manifest(self.get_parse_args(args))
+            start_time = time.monotonic()
+            res = dbtRunner(manifest=manifest).invoke(args)
+            logging.info(
+                f"Invoked `dbt {' '.join(args)}` in {time.monotonic() - start_time:.2f} seconds..."
+            )
+
+        return res
+
+
+class GCPAuthClients(Mapping):
+    """Read-only mapping of GCP product name to authenticated client for an env, see `get_gcp_auth_client`"""
+
+    products = ("bigquery", "storage")
+
+    def __init__(self, env: str) -> None:
+        self.env = env
+
+    def __getitem__(self, product: str) -> Any:
+        if product not in self.products:
+            raise KeyError(product)
+        return get_gcp_auth_client(self.env, product)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.products)
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+
 class GitHubAPIRateLimitError(Exception):
     def __init__(self) -> None:
         pass
@@ -28,62 +164,231 @@ class GitHubAPIRateLimitError(Exception):
         return datetime.fromtimestamp(r["rate"]["reset"])
 
 
+class GitHubClient:
+    """
+    Client for the GitHub REST API.
+
+    A single `requests.Session` is shared by all calls so connections are kept alive and pooled across threads.
+    Responses to GET requests are cached by ETag and revalidated with `If-None-Match`, GitHub does not count
+    304 responses against the rate limit.
+    """
+
+    def __init__(
+        self,
+        base_url: str = "https://api.github.com",
+        token: Optional[str] = None,
+        pool_size: int = 16,
+    ) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(
+            {
+                "Accept": "application/vnd.github+json",
+                "Authorization": f"Bearer {token}",
+                "X-GitHub-Api-Version": "2022-11-28",
+            }
+        )
+        self._etag_cache: Dict[Tuple[str, str], Tuple[str, Any, Dict[str, str]]] = {}
+        self._lock = threading.Lock()
+
+    def request(
+        self,
+        method: str,
+        endpoint: str,
+        data: Optional[Mapping[str, Union[int, str]]] = None,
+        params: Optional[Mapping[str, Union[int, str]]] = None,
+    ) -> Any:
+        """Call an endpoint and return the decoded response body"""
+
+        return self.request_with_links(
+            method=method, endpoint=endpoint, data=data, params=params
+        )[0]
+
+    def request_with_links(
+        self,
+        method: str,
+        endpoint: str,
+        data: Optional[Mapping[str, Union[int, str]]] = None,
+        params: Optional[Mapping[str, Union[int, str]]] = None,
+    ) -> Tuple[Any, Dict[str, str]]:
+        """Call an endpoint and return the decoded response body and the URLs in the `Link` header, keyed by `rel`"""
+
+        method = method.upper()
+        url = f"{self.base_url}/{endpoint}"
+        cache_key = (url, json.dumps(params, sort_keys=True))
+        headers = {}
+        cached = None
+        if method == "GET":
+            with self._lock:
+                cached = self._etag_cache.get(cache_key)
+            if cached is not None:
+                headers["If-None-Match"] = cached[0]
+
+        logging.debug(f"Calling {url}...")
+        r = self.session.request(
+            method=method,
+            url=url,
+            headers=headers,
+            params=params,
+            data=json.dumps(data) if data is not None else None,
+        )
+
+        if r.status_code == 304:
+            logging.debug(f"{url} not modified, using cached response...")
+            return cached[1], cached[2]
+
+        if not r.ok:
+            # Error bodies are not always JSON, e.g. an HTML 502 from a proxy
+            try:
+                error = r.json()
+            except ValueError:
+                error = None
+            if isinstance(error, dict) and error.get("message", "").startswith(
+                "API rate limit exceeded"
+            ):
+                raise GitHubAPIRateLimitError
+            r.raise_for_status()
+
+        if r.status_code == 204:
+            return {"success": True}, {}
+
+        payload = r.json() if r.content else None
+
+        links = {k: v["url"] for k, v in r.links.items()}
+        if method == "GET" and r.headers.get("ETag"):
+            with self._lock:
+                self._etag_cache[cache_key] = (r.headers["ETag"], payload, links)
+
+        return payload, links
+
+
+class GitHubPRCommentIndex:
+    """
+    Comments left by the bot on a GitHub PR, retrieved once and looked up by identifier text.
+
+    Pages of comments are consumed as they arrive (see `iter_github_pr_comment_pages`), a lookup stops consuming
+    pages once it has found a matching comment. Comments are updated in place rather than deleted and re-posted,
+    duplicates are only deleted once every page has been retrieved as deleting shifts the contents of later pages.
+    """
+
+    def __init__(self, pull_request_id: int) -> None:
+        self.pull_request_id = pull_request_id
+        self._pages = iter_github_pr_comment_pages(pull_request_id)
+        self._all_pages_retrieved = False
+        self._num_pages_retrieved = 0
+        self._bot_comments: List[dict] = []
+        self._lock = threading.Lock()
+
+    def _comments_for(self, identifier_text: str, all_pages: bool) -> List[dict]:
+        """
+        Return the bot comments containing `identifier_text`, pages are consumed until one is found or, if
+        `all_pages`, until every page has been retrieved.
+        """
+
+        def matches() -> List[dict]:
+            return [
+                x for x in self._bot_comments if x["body"].find(identifier_text) >= 0
+            ]
+
+        with self._lock:
+            while not self._all_pages_retrieved and (all_pages or not matches()):
+                _, num_pages, comments = next(self._pages)
+                self._bot_comments.extend(
+                    x for x in comments if x["user"]["login"] == "github-actions[bot]"
+                )
+                self._num_pages_retrieved += 1
+                self._all_pages_retrieved = self._num_pages_retrieved == num_pages
+                if self._all_pages_retrieved:
+                    self._pages.close()
+                    logging.debug(
+                        f"Retrieved {len(self._bot_comments)} comments from bot..."
+                    )
+            return matches()
+
+    def _remove(self, comment_ids: List[int]) -> None:
+        with self._lock:
+            self._bot_comments = [
+                x for x in self._bot_comments if x["id"] not in comment_ids
+            ]
+
+    def delete(self, identifier_text: str) -> None:
+        """Delete all bot comments containing a specific text string"""
+
+        comments = self._comments_for(identifier_text, all_pages=True)
+        for comment in comments:
+            delete_github_pr_comment(comment["id"])
+        self._remove([x["id"] for x in comments])
+
+    def upsert(self, identifier_text: str, message: str) -> str:
+        """Update the latest bot comment containing a specific text string, or create one if none exists"""
+
+        comments = sorted(
+            self._comments_for(identifier_text, all_pages=False), key=lambda x: x["id"]
+        )
+        if len(comments) == 0:
+            comment = create_github_pr_comment(self.pull_request_id, message)
+        else:
+            duplicates = comments[:-1] if self._all_pages_retrieved else []
+            for duplicate in duplicates:
+                delete_github_pr_comment(duplicate["id"])
+            self._remove([x["id"] for x in duplicates])
+            comment = update_github_pr_comment(comments[-1]["id"], message)
+
+        self._remove([comment["id"]])
+        with self._lock:
+            self._bot_comments.append(comment)
+        return comment["html_url"]
+
+
 class ManifestInitRunError(Exception):
     pass
 
 
+MANIFEST_INDEX_BLOB_NAME = "manifest_index.json"
+MANIFEST_INDEX_MAX_ENTRIES = 10
+
+_dbt_session = DbtSession()
+_gcp_clients: Dict[Tuple[str, str], Any] = {}
+_gcp_clients_lock = threading.Lock()
+_gcp_credentials: Dict[str, Optional[service_account.Credentials]] = {}
+_github_client: Optional[GitHubClient] = None
+_github_client_lock = threading.Lock()
+
+
 def call_github_api(
     method: str,
     endpoint: str,
     data: Optional[Mapping[str, Union[int, str]]] = None,
     params: Optional[Mapping[str, Union[int, str]]] = None,
 ) -> Any:
-    url = f"https://api.github.com/{endpoint}"
-    logging.debug(f"Calling {url}...")
-    r = requests.request(
-        method=method.upper(),
-        url=url,
-        headers={
-            "Accept": "application/vnd.github+json",
-            "Authorization": f"Bearer {os.getenv('GITHUB_TOKEN')}",
-            "X-GitHub-Api-Version": "2022-11-28",
-        },
-        params=params,
-        data=json.dumps(data),
+    return get_github_client().request(
+        method=method, endpoint=endpoint, data=data, params=params
     )
 
-    r.raise_for_status()
 
-    if r.status_code == 204:
-        return {"success": True}
-    elif (
-        isinstance(r.json(), dict)
-        and r.json().get("message")
-        and r.json()["message"].startswith("API rate limit exceeded for user ID")
-    ):
-        raise GitHubAPIRateLimitError
-    else:
-        return r.json()
+def clear_gcp_auth_clients() -> None:
+    """Discard all cached GCP credentials and clients, e.g. between tests"""
 
+    with _gcp_clients_lock:
+        _gcp_clients.clear()
+        _gcp_credentials.clear()
 
-def delete_github_pr_bot_comments(
-    pull_request_id: int, env: str, identifier_text: str
-) -> None:
-    """Delete all comments on a PR from specified bot containing a specific text string"""
 
-    page = 1
-    comments_data = get_all_github_pr_comments(pull_request_id)
+def create_github_pr_comment(pull_request_id: int, message: str) -> dict:
+    """Create a comment on a GitHub PR and return the created comment."""
 
-    bot_comments = [
-        x
-        for x in comments_data
-        if x["body"].find(identifier_text) >= 0
-        and x["user"]["login"] == "github-actions[bot]"
-    ]
-    logging.debug(f"Retrieved {len(bot_comments)} comments from bot...")
+    response = call_github_api(
+        method="POST",
+        endpoint=f"repos/pgoslatara/dbt-beyond-the-basics/issues/{pull_request_id}/comments",
+        data={"body": message},
+    )
 
-    for comment in bot_comments:
-        delete_github_pr_comment(comment["id"])
+    logging.info(f"Comment URL: {response['html_url']}")
+
+    return response
 
 
 def delete_github_pr_comment(comment_id: int) -> None:
@@ -109,66 +414,189 @@ def download_manifest_json(
         "previous",
     }, "`version` must be 'latest' or 'previous'."
 
+    if version == "latest":
+        index = 0
+    elif version == "previous":
+        index = 1
+
     storage_client = get_gcp_auth_clients(env)["storage"]
-    blobs = storage_client.list_blobs(f"beyond-basics-dbt-manifests-{env}")
-    valid_blobs = []
-    for blob in blobs:
-        re_compile = re.compile(
-            r"uploaded_at=[0-9 -.:]*\/github_run_number=([0-9]*)\/manifest\.json"
-        ).match(blob.name)
-        if "group" in dir(re_compile):
-            valid_blobs.append({"blob": blob, "build_number": int(re_compile[1])})
+    bucket = storage_client.bucket(f"beyond-basics-dbt-manifests-{env}")
+
+    # The index is a small object maintained at upload time, only scan the bucket if it cannot answer the request
+    manifest_blob = None
+    manifests = read_manifest_index(bucket)
+    if manifests:
+        # Blob names start with the upload time, so a manifest uploaded after the newest indexed one (e.g. if
+        # updating the index failed after the upload) is listed from that blob's name onwards
+        newer_manifests = [
+            x
+            for x in list_manifest_blobs(bucket, start_offset=manifests[0]["blob_name"])
+            if x["build_number"] > manifests[0]["build_number"]
+        ]
+        if newer_manifests:
+            logging.info(
+                f"Manifest index is missing {len(newer_manifests)} newer manifests, adding these..."
+            )
+            manifests = newer_manifests + manifests
+    if manifests is None or len(manifests) <= index:
+        logging.info("Manifest index is not available, scanning bucket...")
+    else:
+        manifest_blob = bucket.get_blob(manifests[index]["blob_name"])
+        if manifest_blob is None:
+            logging.info(
+                f"{manifests[index]['blob_name']} in manifest index no longer exists, scanning bucket..."
+            )
+
+    if manifest_blob is None:
+        manifests = list_manifest_blobs(bucket)
+        logging.info(f"Found {len(manifests)} valid blobs...")
+        if len(manifests) == 0:
+            raise ManifestInitRunError
+        manifest_blob = bucket.get_blob(manifests[index]["blob_name"])
+
+    Path(destination_file_name[: destination_file_name.rfind("/")]).mkdir(
+        parents=True, exist_ok=True
+    )
+    cached_file_name = fetch_blob_to_cache(manifest_blob)
+    shutil.copyfile(cached_file_name, destination_file_name)
+    logging.info(
+        f"Downloaded {version} manifest from {manifest_blob.name} to {destination_file_name}"
+    )
+
 
-    logging.info(f"Found {len(valid_blobs)} valid blobs...")
+def fetch_blob_to_cache(blob: storage.Blob) -> str:
+    """
+    Return the path of a local copy of a GCS blob, only downloading the blob if it is not already cached.
+
+    Cached files are keyed by the blob's MD5 hash (or generation if GCS does not provide a hash) so a changed blob is
+    never served from the cache. The cache directory defaults to `~/.cache/beyond-basics/manifests`, set
+    `MANIFEST_CACHE_DIR` to change it, e.g. to a directory persisted between CI jobs. The least recently used files
+    are evicted once the directory exceeds `MANIFEST_CACHE_MAX_BYTES` (default 500 MB).
+    """
 
-    if len(valid_blobs) == 0:
-        raise ManifestInitRunError
+    cache_dir = Path(
+        os.getenv("MANIFEST_CACHE_DIR", Path.home() / ".cache/beyond-basics/manifests")
+    )
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    if blob.md5_hash:
+        cache_key = base64.b64decode(blob.md5_hash).hex()
     else:
-        build_numbers = sorted([x["build_number"] for x in valid_blobs], reverse=True)
-
-        if version == "latest":
-            index = 0
-        elif version == "previous":
-            index = 1
-
-        manifest_blob = [
-            x["blob"] for x in valid_blobs if x["build_number"] == build_numbers[index]
-        ][0]
-        Path(destination_file_name[: destination_file_name.rfind("/")]).mkdir(
-            parents=True, exist_ok=True
-        )
-        manifest_blob.download_to_filename(destination_file_name)
-        logging.info(
-            f"Downloaded {version} manifest from {manifest_blob.name} to {destination_file_name}"
-        )
+        cache_key = f"generation_{blob.generation}"
+    cached_file = cache_dir / cache_key
+
+    if cached_file.exists():
+        logging.info(f"Using cached copy of {blob.name} from {cached_file}...")
+        cached_file.touch()
+        return str(cached_file)
+
+    # Download to a temporary name first so a failed download never leaves a partial file under the cache key
+    logging.info(f"Downloading {blob.name} to cache...")
+    temp_file = cache_dir / f"{cache_key}.{os.getpid()}.{threading.get_ident()}.tmp"
+    compression = (blob.metadata or {}).get("compression")
+    if compression == "gzip":
+        # Decompress while streaming so the whole file is never held in memory
+        with blob.open("rb") as blob_reader, gzip.GzipFile(
+            fileobj=blob_reader
+        ) as f_in, temp_file.open("wb") as f_out:
+            shutil.copyfileobj(f_in, f_out, length=1024**2)
+    elif compression is None:
+        blob.download_to_filename(str(temp_file))
+    else:
+        raise ValueError(f"Unsupported compression for {blob.name}: {compression}")
+    temp_file.replace(cached_file)
+
+    max_bytes = int(os.getenv("MANIFEST_CACHE_MAX_BYTES", 500 * 1024**2))
+    cached_files = sorted(
+        [x for x in cache_dir.iterdir() if x.is_file() and x.suffix != ".tmp"],
+        key=lambda x: x.stat().st_mtime,
+        reverse=True,
+    )
+    total_bytes = 0
+    for f in cached_files:
+        total_bytes += f.stat().st_size
+        if total_bytes > max_bytes and f != cached_file:
+            logging.info(f"Evicting {f} from cache...")
+            f.unlink(missing_ok=True)
 
+    return str(cached_file)
 
-def get_all_github_pr_comments(pull_request_id: int) -> dict:
-    """Retrieve all comments from a GitHub PR"""
 
-    page_num = 1
-    pr_comments = []
+def get_all_github_pr_comments(pull_request_id: int) -> list:
+    """Retrieve all comments from a GitHub PR"""
 
-    while True:
-        logging.info(f"Retrieving comments on PR {pull_request_id}: page {page_num}...")
-        new_comments = call_github_api(
-            method="GET",
-            endpoint=f"repos/pgoslatara/dbt-beyond-the-basics/issues/{pull_request_id}/comments",
-            params={"page": page_num, "per_page": 100},
-        )
-        page_num += 1
-        if new_comments == []:
-            break
-        else:
-            pr_comments += new_comments
+    pages = {x: y for x, _, y in iter_github_pr_comment_pages(pull_request_id)}
+    pr_comments = [x for page_num in sorted(pages) for x in pages[page_num]]
 
     logging.debug(f"Retrieved {len(pr_comments)} comments...")
     return pr_comments
 
 
-def get_gcp_auth_clients(env: str) -> dict:
+def iter_github_pr_comment_pages(
+    pull_request_id: int, max_workers: int = 4
+) -> Iterator[Tuple[int, int, list]]:
+    """
+    Yield (page number, number of pages, comments) for every page of comments on a GitHub PR as each page arrives.
+
+    The first page is fetched on its own, its `Link: rel="last"` header gives the number of remaining pages. These
+    are then fetched concurrently with at most `max_workers` pages in flight, so pages are not yielded in order and
+    a consumer that stops early does not request every page.
+    """
+
+    endpoint = (
+        f"repos/pgoslatara/dbt-beyond-the-basics/issues/{pull_request_id}/comments"
+    )
+    client = get_github_client()
+
+    logging.info(f"Retrieving comments on PR {pull_request_id}: page 1...")
+    comments, links = client.request_with_links(
+        method="GET", endpoint=endpoint, params={"page": 1, "per_page": 100}
+    )
+    last_page = (
+        int(parse_qs(urlparse(links["last"]).query)["page"][0])
+        if "last" in links
+        else 1
+    )
+    yield 1, last_page, comments
+
+    if last_page == 1:
+        return
+
+    logging.info(
+        f"Retrieving comments on PR {pull_request_id}: pages 2 to {last_page}..."
+    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending: Dict[Any, int] = {}
+        next_page = 2
+        while pending or next_page <= last_page:
+            while next_page <= last_page and len(pending) < max_workers:
+                future = executor.submit(
+                    client.request,
+                    method="GET",
+                    endpoint=endpoint,
+                    params={"page": next_page, "per_page": 100},
+                )
+                pending[future] = next_page
+                next_page += 1
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), last_page, future.result()
+
+
+def get_dbt_manifest_json(target: str) -> dict:
+    """Return the manifest of the dbt project for a target, in the same format as manifest.json"""
+
+    manifest = _dbt_session.get_manifest(["--target", target])
+    return manifest.writable_manifest().to_dict(omit_none=False)
+
+
+def get_gcp_auth_client(env: str, product: str) -> Any:
     """
-    Return an authenticated client object for supported GCP products
+    Return an authenticated client object for a supported GCP product ("bigquery" or "storage")
+
+    Clients are created on first use and then shared by all callers (and threads) in the process, call
+    `clear_gcp_auth_clients` to discard them.
 
     Order of preference for authentication:
         1. Service account key file specific to an environment, e.g. service_account_stg.json
@@ -176,7 +604,40 @@ def get_gcp_auth_clients(env: str) -> dict:
         3. Local credentials, i.e. via gcloud CLI
     """
 
-    project_id = f"beyond-basics-{env}"
+    assert product in {
+        "bigquery",
+        "storage",
+    }, "`product` must be 'bigquery' or 'storage'."
+
+    if (env, product) in _gcp_clients:
+        return _gcp_clients[(env, product)]
+
+    with _gcp_clients_lock:
+        if (env, product) not in _gcp_clients:
+            if env not in _gcp_credentials:
+                _gcp_credentials[env] = _load_gcp_credentials(env)
+            credentials = _gcp_credentials[env]
+
+            logging.debug(f"Creating {product} client for {env}...")
+            if product == "bigquery":
+                _gcp_clients[(env, product)] = bigquery.Client(
+                    credentials=credentials,
+                    project=f"beyond-basics-{env}",
+                )
+            elif product == "storage":
+                _gcp_clients[(env, product)] = storage.Client(credentials=credentials)
+
+    return _gcp_clients[(env, product)]
+
+
+def get_gcp_auth_clients(env: str) -> Mapping[str, Any]:
+    """Return authenticated client objects for supported GCP products, each client is only created when first accessed"""
+
+    return GCPAuthClients(env)
+
+
+def _load_gcp_credentials(env: str) -> Optional[service_account.Credentials]:
+    """Load service account credentials for an env, `None` means the default credentials are used"""
 
     __location__ = os.path.realpath(
         os.path.join(os.getcwd(), os.path.dirname(__file__))
@@ -194,42 +655,70 @@ def get_gcp_auth_clients(env: str) -> dict:
             f"Service account key specific to an env file exists, using {service_account_key_env_path} for auth..."
         )
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = service_account_key_env_path
-        credentials = service_account.Credentials.from_service_account_file(
+        return service_account.Credentials.from_service_account_file(
             service_account_key_env_path,
             scopes=["https://www.googleapis.com/auth/cloud-platform"],
         )
-        client_bigquery = bigquery.Client(
-            credentials=credentials,
-            project=project_id,
-        )
-        client_storage = storage.Client(credentials=credentials)
     elif Path(service_account_key_path).exists():
         logging.debug(
             f"Service account key file exists, using {service_account_key_path} for auth..."
         )
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = service_account_key_path
-        credentials = service_account.Credentials.from_service_account_file(
+        return service_account.Credentials.from_service_account_file(
             service_account_key_path,
             scopes=["https://www.googleapis.com/auth/cloud-platform"],
         )
-        client_bigquery = bigquery.Client(
-            credentials=credentials,
-            project=project_id,
-        )
-        client_storage = storage.Client(credentials=credentials)
     else:
         logging.debug(
             f"Service account key file does not exist, using default credentials for auth..."
         )
-        client_bigquery = bigquery.Client(
-            project=project_id,
-        )
-        client_storage = storage.Client()
+        return None
+
+
+def get_github_client() -> GitHubClient:
+    """Return the process-wide GitHub client, creating it on first use"""
+
+    global _github_client
+    with _github_client_lock:
+        if _github_client is None:
+            _github_client = GitHubClient(
+                base_url=os.getenv("GITHUB_API_URL", "https://api.github.com"),
+                token=os.getenv("GITHUB_TOKEN"),
+            )
+    return _github_client
+
+
+def list_manifest_blobs(
+    bucket: storage.Bucket, start_offset: Optional[str] = None
+) -> List[Mapping[str, Any]]:
+    """
+    Scan a bucket for uploaded manifest.json files, returns the build number and blob name of each, newest first
+
+    Args:
+        start_offset (str, optional): Only scan blobs whose name is lexicographically equal to or after this name.
+    """
+
+    manifests = []
+    for blob in bucket.list_blobs(start_offset=start_offset):
+        re_compile = re.compile(
+            r"uploaded_at=[0-9 -.:]*\/github_run_number=([0-9]*)\/manifest\.json"
+        ).match(blob.name)
+        if "group" in dir(re_compile):
+            manifests.append(
+                {"build_number": int(re_compile[1]), "blob_name": blob.name}
+            )
+
+    return sorted(manifests, key=lambda x: x["build_number"], reverse=True)
+
+
+def read_manifest_index(bucket: storage.Bucket) -> Optional[List[Mapping[str, Any]]]:
+    """Read the manifest index of a bucket, returns `None` if the bucket does not have an index"""
 
-    return {
-        "bigquery": client_bigquery,
-        "storage": client_storage,
-    }
+    index_blob = bucket.get_blob(MANIFEST_INDEX_BLOB_NAME)
+    if index_blob is None:
+        return None
+
+    return json.loads(index_blob.download_as_bytes())["manifests"]
 
 
 def run_dbt_command(
@@ -237,11 +726,13 @@ def run_dbt_command(
 ) -> List:
     """Runs a dbt command.
 
+    The project is parsed once per target and the resulting manifest is reused by later commands, see `DbtSession`.
+
     Args:
         dbt_command (str): The dbt command to be run, e.g. "dbt parse"
     """
 
-    res = dbtRunner().invoke(dbt_command.split(" ")[1:])
+    res = _dbt_session.invoke(dbt_command.split(" ")[1:])
 
     if res.exception:
         raise RuntimeError("dbt command did not complete successfully.")
@@ -252,15 +743,7 @@ def run_dbt_command(
 def send_github_pr_comment(pull_request_id: int, message: str) -> str:
     """Create a comment on a GitHub PR."""
 
-    response = call_github_api(
-        method="POST",
-        endpoint=f"repos/pgoslatara/dbt-beyond-the-basics/issues/{pull_request_id}/comments",
-        data={"body": message},
-    )
-
-    logging.info(f"Comment URL: {response['html_url']}")
-
-    return response["html_url"]
+    return create_github_pr_comment(pull_request_id, message)["html_url"]
 
 
 def set_logging_options() -> None:
@@ -278,14 +761,100 @@ def set_logging_options() -> None:
     logger.setLevel(logging.INFO)
 
 
+def update_github_pr_comment(comment_id: int, message: str) -> dict:
+    """Update the body of an existing comment on a GitHub PR and return the updated comment."""
+
+    logging.info(f"Updating comment_id {comment_id}...")
+
+    response = call_github_api(
+        method="PATCH",
+        endpoint=f"repos/pgoslatara/dbt-beyond-the-basics/issues/comments/{comment_id}",
+        data={"body": message},
+    )
+
+    logging.info(f"Comment URL: {response['html_url']}")
+
+    return response
+
+
+@retry(PreconditionFailed, tries=5, delay=1)
+def update_manifest_index(
+    bucket: storage.Bucket, build_number: int, blob_name: str
+) -> None:
+    """
+    Add an uploaded manifest.json to the manifest index of a bucket.
+
+    The index lists the most recent builds, newest first, so `download_manifest_json` can resolve "latest" and
+    "previous" with one small read instead of listing the whole bucket. Writes are conditional on the generation
+    that was read so concurrent uploads cannot overwrite each other's entries.
+    """
+
+    index_blob = bucket.get_blob(MANIFEST_INDEX_BLOB_NAME)
+    if index_blob is None:
+        logging.info(
+            "Manifest index does not exist, creating it from existing blobs..."
+        )
+        index_blob = bucket.blob(MANIFEST_INDEX_BLOB_NAME)
+        generation = 0
+        manifests = list_manifest_blobs(bucket)
+    else:
+        generation = index_blob.generation
+        manifests = json.loads(index_blob.download_as_bytes())["manifests"]
+
+    manifests = [x for x in manifests if x["build_number"] != build_number]
+    manifests.append({"build_number": build_number, "blob_name": blob_name})
+    manifests = sorted(manifests, key=lambda x: x["build_number"], reverse=True)[
+        :MANIFEST_INDEX_MAX_ENTRIES
+    ]
+
+    logging.info(f"Updating manifest index in {bucket.name}...")
+    index_blob.upload_from_string(
+        json.dumps({"manifests": manifests}),
+        content_type="application/json",
+        if_generation_match=generation,
+    )
+
+
 @retry(tries=3, delay=5)
 def upload_to_gcs(
-    env: str, bucket_name: str, upload_directory: str, file_to_upload: str
-):
-    """Upload a file to a Google Cloud Storage bucket"""
+    env: str,
+    bucket_name: str,
+    upload_directory: str,
+    file_to_upload: str,
+    compression: Optional[str] = None,
+) -> str:
+    """
+    Upload a file to a Google Cloud Storage bucket, returns the name of the created blob
+
+    Args:
+        compression (str, optional): Set to "gzip" to compress the file before uploading, the blob keeps the name
+            of the file and the compression is recorded in the blob's metadata.
+    """
+
+    assert compression in {
+        None,
+        "gzip",
+    }, "`compression` must be None or 'gzip'."
 
     client = get_gcp_auth_clients(env)["storage"]
     bucket = client.bucket(bucket_name)
     blob = bucket.blob(f"{upload_directory}/{file_to_upload.split('/')[-1]}")
     logging.info(f"Uploading {file_to_upload} to {blob.name} in {blob.bucket.name}...")
-    blob.upload_from_filename(file_to_upload)
+    if compression == "gzip":
+        with tempfile.TemporaryDirectory() as temp_dir:
+            compressed_file = Path(temp_dir) / f"{Path(file_to_upload).name}.gz"
+            with Path(file_to_upload).open("rb") as f_in, gzip.open(
+                compressed_file, "wb"
+            ) as f_out:
+                shutil.copyfileobj(f_in, f_out, length=1024**2)
+            logging.info(
+                f"Compressed {file_to_upload} from {Path(file_to_upload).stat().st_size} to {compressed_file.stat().st_size} bytes..."
+            )
+            blob.metadata = {"compression": "gzip"}
+            blob.upload_from_filename(
+                str(compressed_file), content_type="application/gzip"
+            )
+    else:
+        blob.upload_from_filename(file_to_upload)
+
+    return blob.name
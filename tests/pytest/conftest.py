@@ -1,8 +1,10 @@
 import json
 from pathlib import Path
+from typing import Callable, Dict, Mapping, Union
 
 import pytest
 import yaml
+from manifest_loader import load_manifest
 
 
 @pytest.fixture(scope="module")
@@ -14,9 +16,7 @@ def catalog_json() -> dict:
 
 @pytest.fixture(scope="module")
 def manifest_json() -> dict:
-    with Path("./target/manifest.json").open() as f:
-        data = json.load(f)
-    return data
+    return load_manifest("./target/manifest.json")
 
 
 @pytest.fixture(scope="module")
@@ -38,3 +38,66 @@ def sources_json() -> dict:
     with Path("./target/sources.json").open() as f:
         data = json.load(f)
     return data
+
+
+class FakeQueryJob:
+    """Stand-in for `bigquery.QueryJob`, `result` returns the rows or raises them if they are an exception"""
+
+    def __init__(self, rows: Union[list, Exception]) -> None:
+        self.rows = rows
+
+    def result(self) -> list:
+        if isinstance(self.rows, Exception):
+            raise self.rows
+        return self.rows
+
+
+class FakeBigQueryClient:
+    """Stand-in for `bigquery.Client`, records every query and answers it with `respond(project, query)`"""
+
+    def __init__(
+        self, project: str, respond: Callable[[str, str], Union[list, Exception]]
+    ) -> None:
+        self.project = project
+        self.respond = respond
+        self.queries: list = []
+
+    def query(self, query: str, job_config=None) -> FakeQueryJob:
+        self.queries.append(query)
+        return FakeQueryJob(self.respond(self.project, query))
+
+
+class FakeManifestIndex:
+    """Stand-in for `ManifestIndex`, only `relations` is used by the mart monitor"""
+
+    def __init__(self, relations: Mapping[str, Mapping]) -> None:
+        self.relations = relations
+
+
+@pytest.fixture
+def fake_bigquery(monkeypatch) -> Callable[..., Dict[str, FakeBigQueryClient]]:
+    """
+    Patch mart_monitor_commenter to use a `FakeBigQueryClient` for stg and prd and a `FakeManifestIndex`, returns a
+    function of the model relations and the `respond` function of the clients that returns the clients by env.
+    """
+
+    import mart_monitor_commenter
+
+    def patch(
+        relations: Mapping[str, Mapping],
+        respond: Callable[[str, str], Union[list, Exception]],
+    ) -> Dict[str, FakeBigQueryClient]:
+        clients = {env: FakeBigQueryClient(env, respond) for env in ["stg", "prd"]}
+        monkeypatch.setattr(
+            mart_monitor_commenter,
+            "get_gcp_auth_clients",
+            lambda env: {"bigquery": clients[env]},
+        )
+        monkeypatch.setattr(
+            mart_monitor_commenter,
+            "get_manifest_index",
+            lambda path: FakeManifestIndex(relations),
+        )
+        return clients
+
+    return patch
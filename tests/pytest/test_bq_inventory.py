@@ -0,0 +1,225 @@
+import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+import pyarrow as pa
+import pytest
+from bq_inventory import (
+    INVENTORY_SCHEMA,
+    PlannedDeletion,
+    diff_inventories,
+    get_manifest_tables,
+    load_inventory,
+    plan_cleanup,
+    prune_inventory,
+    save_inventory,
+    take_inventory,
+)
+
+MODIFIED = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def build_inventory(rows: list) -> pa.Table:
+    return pa.Table.from_pylist(
+        [
+            {
+                "resource_type": resource_type,
+                "dataset_id": dataset_id,
+                "name": name,
+                "is_dbt": is_dbt,
+                "last_modified_time": MODIFIED,
+            }
+            for resource_type, dataset_id, name, is_dbt in rows
+        ],
+        schema=INVENTORY_SCHEMA,
+    )
+
+
+@pytest.mark.no_deps
+def test_plan_cleanup(tmp_path: Path) -> None:
+    """
+    A recorded inventory is planned without BigQuery, datasets emptied by deleting orphaned tables are also deleted.
+    """
+
+    inventory = build_inventory(
+        [
+            ("dataset", "cicd_1", None, False),
+            ("table", "cicd_1", "dim_customers", True),
+            ("dataset", "marts", None, False),
+            ("table", "marts", "dim_customers", True),
+            ("table", "marts", "dim_old_customers", True),
+            ("table", "marts", "manual_upload", False),
+            ("dataset", "old_marts", None, False),
+            ("table", "old_marts", "fct_old_orders", True),
+            ("dataset", "udfs", None, False),
+            ("routine", "udfs", "parse_json", False),
+            ("dataset", "unused", None, False),
+        ]
+    )
+
+    plan = plan_cleanup(
+        inventory,
+        dataset_pattern="cicd_",
+        manifest_tables={("marts", "dim_customers")},
+    )
+    assert plan == [
+        PlannedDeletion("dataset", "cicd_1", "cicd"),
+        PlannedDeletion("table", "marts.dim_old_customers", "orphaned"),
+        PlannedDeletion("table", "old_marts.fct_old_orders", "orphaned"),
+        PlannedDeletion("dataset", "old_marts", "empty"),
+        PlannedDeletion("dataset", "unused", "empty"),
+    ]
+
+    pruned = prune_inventory(inventory, plan)
+    save_inventory(pruned, str(tmp_path / "inventory.parquet"))
+    assert load_inventory(str(tmp_path / "inventory.parquet")).equals(pruned)
+    assert load_inventory(str(tmp_path / "missing.parquet")) is None
+    assert sorted(
+        (x["dataset_id"], x["name"]) for x in pruned.to_pylist() if x["name"]
+    ) == [
+        ("marts", "dim_customers"),
+        ("marts", "manual_upload"),
+        ("udfs", "parse_json"),
+    ]
+    assert plan_cleanup(pruned, "cicd_", {("marts", "dim_customers")}) == []
+
+
+@pytest.mark.no_deps
+def test_get_manifest_tables_includes_every_model() -> None:
+    """
+    Versioned models share a name, each version is a table that must not be deleted as orphaned.
+    """
+
+    manifest = {
+        "nodes": {
+            f"model.beyond_basics.dim_customers.v{x}": {
+                "name": "dim_customers",
+                "resource_type": "model",
+                "schema": "marts",
+                "alias": f"dim_customers_v{x}",
+            }
+            for x in [1, 2]
+        }
+    }
+    manifest["nodes"]["seed.beyond_basics.raw_customers"] = {
+        "name": "raw_customers",
+        "resource_type": "seed",
+        "schema": "seeds",
+        "alias": "raw_customers",
+    }
+
+    assert get_manifest_tables(manifest) == {
+        ("marts", "dim_customers_v1"),
+        ("marts", "dim_customers_v2"),
+    }
+
+
+@pytest.mark.no_deps
+def test_take_inventory_only_inspects_modified_datasets() -> None:
+    """
+    Tables and routines of datasets that have not been modified since the previous inventory are not read again,
+    creating or dropping a table marks its dataset as modified.
+    """
+
+    from google.api_core.exceptions import Forbidden
+
+    class FakeClient:
+        project = "stg"
+
+        def __init__(self) -> None:
+            self.inspected_datasets: list = []
+            self.schemata_fails = False
+            self.datasets = {"marts": MODIFIED, "udfs": MODIFIED}
+            self.tables = {"marts": ["table_in_marts"], "udfs": ["table_in_udfs"]}
+
+        def query(self, query: str, job_config=None) -> SimpleNamespace:
+            assert "`stg.region-us.INFORMATION_SCHEMA." in query
+            if "SCHEMATA" in query:
+                if self.schemata_fails:
+                    raise Forbidden("Access Denied")
+                rows = [
+                    {"schema_name": k, "last_modified_time": v}
+                    for k, v in self.datasets.items()
+                ]
+            elif "GROUP BY dataset_id" in query:
+                rows = [
+                    {
+                        "dataset_id": k,
+                        "num_resources": len(v),
+                        "last_modified_time": MODIFIED,
+                    }
+                    for k, v in self.tables.items()
+                    if v
+                ]
+            else:
+                datasets = job_config.query_parameters[0].values
+                self.inspected_datasets.append(datasets)
+                rows = [
+                    {
+                        "resource_type": "table",
+                        "dataset_id": x,
+                        "name": y,
+                        "is_dbt": True,
+                        "last_modified_time": MODIFIED,
+                    }
+                    for x in datasets
+                    for y in self.tables.get(x, [])
+                ]
+            return SimpleNamespace(result=lambda: rows)
+
+        def list_datasets(self) -> list:
+            return [SimpleNamespace(dataset_id=x, reference=x) for x in self.datasets]
+
+        def get_dataset(self, dataset: str) -> SimpleNamespace:
+            return SimpleNamespace(modified=self.datasets[dataset])
+
+        def list_tables(self, dataset: str) -> list:
+            self.inspected_datasets.append([dataset])
+            return [
+                SimpleNamespace(
+                    table_id=x, labels={"created_by": "dbt"}, created=MODIFIED
+                )
+                for x in self.tables.get(dataset.split(".")[1], [])
+            ]
+
+        def list_routines(self, dataset: str) -> list:
+            return []
+
+    def tables(inventory: pa.Table) -> list:
+        return sorted(
+            (x["dataset_id"], x["name"]) for x in inventory.to_pylist() if x["name"]
+        )
+
+    client = FakeClient()
+    first_inventory = take_inventory(client)
+    assert client.inspected_datasets == [["marts", "udfs"]]
+    assert first_inventory.num_rows == 4
+
+    client.datasets["marts"] = MODIFIED + datetime.timedelta(days=1)
+    client.datasets["new"] = MODIFIED
+    del client.datasets["udfs"]
+    second_inventory = take_inventory(client, previous=first_inventory)
+    assert client.inspected_datasets[1] == ["marts", "new"]
+    assert diff_inventories(first_inventory, second_inventory) == {
+        "added": ["new"],
+        "removed": ["udfs"],
+        "modified": ["marts"],
+    }
+
+    # Creating or dropping a table does not change the last modified time of its dataset
+    client.tables["new"] = ["orphaned_table"]
+    third_inventory = take_inventory(client, previous=second_inventory)
+    assert client.inspected_datasets[2] == ["new"]
+    assert ("new", "orphaned_table") in tables(third_inventory)
+
+    client.tables["new"] = []
+    fourth_inventory = take_inventory(client, previous=third_inventory)
+    assert client.inspected_datasets[3] == ["new"]
+    assert tables(fourth_inventory) == [("marts", "table_in_marts")]
+    take_inventory(client, previous=fourth_inventory)
+    assert len(client.inspected_datasets) == 4
+
+    client.schemata_fails = True
+    fifth_inventory = take_inventory(client, previous=fourth_inventory)
+    assert client.inspected_datasets[4:] == [["stg.marts"], ["stg.new"]]
+    assert tables(fifth_inventory) == [("marts", "table_in_marts")]
@@ -0,0 +1,91 @@
+from types import SimpleNamespace
+
+import pytest
+import utils
+
+
+class FakeDbtRunner:
+    """Stand-in for `dbtRunner`, records every invocation and the manifest it was created with"""
+
+    invocations: list = []
+
+    def __init__(self, manifest=None) -> None:
+        self.manifest = manifest
+
+    def invoke(self, args: list) -> SimpleNamespace:
+        self.invocations.append((self.manifest, args))
+        return SimpleNamespace(
+            exception=None,
+            success=True,
+            result=object() if args[1:2] == ["parse"] else None,
+        )
+
+
+@pytest.fixture
+def dbt_session(monkeypatch, tmp_path) -> utils.DbtSession:
+    (tmp_path / "dbt_project.yml").write_text('model-paths: ["models"]\n')
+    (tmp_path / "models").mkdir()
+    (tmp_path / "models" / "model_a.sql").write_text("select 1 as id")
+    FakeDbtRunner.invocations = []
+    monkeypatch.setattr(utils, "dbtRunner", FakeDbtRunner)
+    return utils.DbtSession(project_dir=str(tmp_path))
+
+
+def parses() -> list:
+    return [args for _, args in FakeDbtRunner.invocations if "parse" in args]
+
+
+@pytest.mark.no_deps
+def test_dbt_session_get_parse_args(dbt_session) -> None:
+    assert dbt_session.get_parse_args(
+        ["ls", "--select", "tag:marts", "--target", "stg"]
+    ) == ["--target", "stg"]
+    assert dbt_session.get_parse_args(["ls", "--target=stg", "-t", "prd"]) == [
+        "--target",
+        "stg",
+        "-t",
+        "prd",
+    ]
+    assert dbt_session.get_parse_args(
+        ["build", '--vars={"backfill_start_date": "2024-01-01"}']
+    ) == ["--vars", '{"backfill_start_date": "2024-01-01"}']
+    assert dbt_session.get_parse_args(["ls", "--select=tag:marts"]) == []
+
+
+@pytest.mark.no_deps
+def test_dbt_session_reuses_manifest(dbt_session) -> None:
+    """
+    `--flag value` and `--flag=value` reuse the same manifest, other commands do not parse the project again.
+    """
+
+    dbt_session.invoke(["ls", "--select", "tag:marts", "--target", "stg"])
+    dbt_session.invoke(["ls", "--target=stg", "--select=tag:staging"])
+    dbt_session.invoke(["compile", "--target", "stg"])
+
+    assert parses() == [["--quiet", "parse", "--target", "stg"]]
+    manifests = [m for m, args in FakeDbtRunner.invocations if "parse" not in args]
+    assert len(manifests) == 3
+    assert manifests[0] is not None and len({id(x) for x in manifests}) == 1
+
+
+@pytest.mark.no_deps
+def test_dbt_session_reparses_on_changes(dbt_session, monkeypatch, tmp_path) -> None:
+    """
+    The project is parsed again when the parse arguments, `DBT_*` environment variables or project files change.
+    """
+
+    dbt_session.invoke(["ls", "--target=stg"])
+    dbt_session.invoke(["ls", "--target=prd"])
+    assert parses() == [
+        ["--quiet", "parse", "--target", "stg"],
+        ["--quiet", "parse", "--target", "prd"],
+    ]
+
+    monkeypatch.setenv("DBT_PYTEST_FLAG", "1")
+    dbt_session.invoke(["ls", "--target", "prd"])
+    assert len(parses()) == 3
+
+    (tmp_path / "models" / "model_b.sql").write_text("select 2 as id")
+    dbt_session.invoke(["ls", "--target", "prd"])
+    dbt_session.invoke(["ls", "--target=prd"])
+    assert len(parses()) == 4
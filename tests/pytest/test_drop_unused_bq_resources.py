@@ -0,0 +1,78 @@
+import pytest
+
+
+@pytest.mark.no_deps
+def test_delete_resources_continues_after_failures() -> None:
+    """
+    Resources are deleted concurrently, quota errors are retried and a failed deletion does not stop the others.
+    """
+
+    from drop_unused_bq_resources import AdaptiveBackoff, delete_resources
+    from google.api_core.exceptions import BadRequest, Forbidden
+
+    datasets = [f"stg.cicd_{i}" for i in range(10)]
+    deleted = []
+    quota_errors = [2]
+
+    def delete(dataset_id: str) -> None:
+        if dataset_id == "stg.cicd_3":
+            raise BadRequest("Dataset is in use")
+        if dataset_id == "stg.cicd_5" and quota_errors[0] > 0:
+            quota_errors[0] -= 1
+            raise Forbidden(
+                "Exceeded rate limits", errors=[{"reason": "rateLimitExceeded"}]
+            )
+        deleted.append(dataset_id)
+
+    outcomes = delete_resources(datasets, delete=delete, dry_run=True)
+    assert {x.status for x in outcomes} == {"planned"}
+    assert deleted == []
+
+    outcomes = delete_resources(
+        datasets,
+        delete=delete,
+        backoff=AdaptiveBackoff(initial_delay=0.01, max_delay=0.02),
+    )
+    assert [x.resource for x in outcomes] == datasets
+    assert sorted(deleted) == sorted(x for x in datasets if x != "stg.cicd_3")
+    assert outcomes[3].status == "failed" and "BadRequest" in outcomes[3].error
+    assert outcomes[5].status == "deleted" and outcomes[5].attempts == 3
+
+
+@pytest.mark.no_deps
+def test_apply_cleanup_plan_deletes_tables_before_datasets() -> None:
+    """
+    Orphaned tables are deleted before datasets, only CICD datasets are deleted with their contents.
+    """
+
+    from bq_inventory import PlannedDeletion
+    from drop_unused_bq_resources import apply_cleanup_plan
+
+    class FakeClient:
+        project = "stg"
+
+        def __init__(self) -> None:
+            self.deleted: list = []
+
+        def delete_table(self, table_id: str, not_found_ok: bool) -> None:
+            self.deleted.append(("table", table_id))
+
+        def delete_dataset(
+            self, dataset_id: str, delete_contents: bool, not_found_ok: bool
+        ) -> None:
+            self.deleted.append(("dataset", dataset_id, delete_contents))
+
+    client = FakeClient()
+    plan = [
+        PlannedDeletion("dataset", "cicd_1", "cicd"),
+        PlannedDeletion("table", "old_marts.dim_old_customers", "orphaned"),
+        PlannedDeletion("dataset", "old_marts", "empty"),
+    ]
+
+    outcomes = apply_cleanup_plan(client, plan)
+    assert {x.status for x in outcomes} == {"deleted"}
+    assert client.deleted[0] == ("table", "stg.old_marts.dim_old_customers")
+    assert sorted(client.deleted[1:]) == [
+        ("dataset", "stg.cicd_1", True),
+        ("dataset", "stg.old_marts", False),
+    ]
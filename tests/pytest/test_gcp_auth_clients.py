@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+import pytest
+import utils
+
+
+class FakeGCPClient:
+    def __init__(self, credentials=None, project=None) -> None:
+        self.credentials = credentials
+        self.project = project
+
+
+@pytest.fixture
+def fake_gcp(monkeypatch):
+    loaded_credentials = []
+
+    def load_gcp_credentials(env: str) -> str:
+        loaded_credentials.append(env)
+        return f"credentials_{env}"
+
+    monkeypatch.setattr(utils, "_load_gcp_credentials", load_gcp_credentials)
+    monkeypatch.setattr(utils, "bigquery", SimpleNamespace(Client=FakeGCPClient))
+    monkeypatch.setattr(utils, "storage", SimpleNamespace(Client=FakeGCPClient))
+    utils.clear_gcp_auth_clients()
+    yield loaded_credentials
+    utils.clear_gcp_auth_clients()
+
+
+@pytest.mark.no_deps
+def test_gcp_auth_clients_are_lazy_and_cached(fake_gcp) -> None:
+    clients = utils.get_gcp_auth_clients("stg")
+    assert fake_gcp == [], "Credentials must not be loaded until a client is accessed"
+    assert list(clients) == ["bigquery", "storage"]
+    assert fake_gcp == []
+
+    bigquery_client = clients["bigquery"]
+    assert isinstance(bigquery_client, FakeGCPClient)
+    assert bigquery_client.project == "beyond-basics-stg"
+    assert bigquery_client.credentials == "credentials_stg"
+    assert fake_gcp == ["stg"]
+
+    # Each (env, product) pair is created once, credentials are shared by the products of an env
+    assert clients["bigquery"] is bigquery_client
+    assert utils.get_gcp_auth_client("stg", "bigquery") is bigquery_client
+    storage_client = clients["storage"]
+    assert storage_client is not bigquery_client
+    assert utils.get_gcp_auth_client("stg", "storage") is storage_client
+    assert fake_gcp == ["stg"]
+
+    prd_client = utils.get_gcp_auth_client("prd", "bigquery")
+    assert prd_client is not bigquery_client
+    assert prd_client.project == "beyond-basics-prd"
+    assert fake_gcp == ["stg", "prd"]
+
+    with pytest.raises(KeyError):
+        clients["pubsub"]
+
+
+@pytest.mark.no_deps
+def test_gcp_auth_clients_are_rebuilt_after_clear(fake_gcp) -> None:
+    bigquery_client = utils.get_gcp_auth_client("stg", "bigquery")
+
+    utils.clear_gcp_auth_clients()
+    rebuilt_client = utils.get_gcp_auth_client("stg", "bigquery")
+    assert rebuilt_client is not bigquery_client
+    assert fake_gcp == ["stg", "stg"]
+    assert utils.get_gcp_auth_client("stg", "bigquery") is rebuilt_client
@@ -0,0 +1,272 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+import utils
+from utils import GitHubClient
+
+
+class StubGitHubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests_seen: list = []
+
+    def do_GET(self) -> None:
+        self.requests_seen.append(
+            (self.client_address[1], self.headers.get("If-None-Match"))
+        )
+        if "/issues/2/comments" in self.path:
+            return self.send_comment_page()
+        if "/bad-gateway" in self.path:
+            body = b"<html><body>502 Bad Gateway</body></html>"
+            self.send_response(502)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.send_header("ETag", '"v1"')
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = json.dumps([{"id": 1, "body": "hello"}]).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_comment_page(self) -> None:
+        """Serve 250 comments, 100 per page, with a `Link` header like GitHub's"""
+
+        page = int(parse_qs(urlparse(self.path).query)["page"][0])
+        body = json.dumps(
+            [{"id": i} for i in range((page - 1) * 100, min(page * 100, 250))]
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header(
+            "Link",
+            f'<http://127.0.0.1/issues/2/comments?page={page + 1}&per_page=100>; rel="next", '
+            '<http://127.0.0.1/issues/2/comments?page=3&per_page=100>; rel="last"',
+        )
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_DELETE(self) -> None:
+        self.requests_seen.append((self.client_address[1], None))
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def stub_github_api():
+    StubGitHubHandler.requests_seen = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubGitHubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.no_deps
+def test_github_client_reuses_connection_and_etag(stub_github_api: str) -> None:
+    """
+    Repeated GET requests should be revalidated with the cached ETag and all calls should share one connection.
+    """
+
+    client = GitHubClient(base_url=stub_github_api, token="dummy")
+    endpoint = "repos/pgoslatara/dbt-beyond-the-basics/issues/1/comments"
+
+    first = client.request("GET", endpoint, params={"page": 1})
+    second = client.request("GET", endpoint, params={"page": 1})
+    deleted = client.request(
+        "DELETE", "repos/pgoslatara/dbt-beyond-the-basics/issues/comments/1"
+    )
+
+    assert first == second == [{"id": 1, "body": "hello"}]
+    assert deleted == {"success": True}
+
+    ports = {port for port, _ in StubGitHubHandler.requests_seen}
+    etags = [etag for _, etag in StubGitHubHandler.requests_seen]
+    assert len(ports) == 1, "Requests did not reuse a pooled connection."
+    assert etags == [None, '"v1"', None]
+
+
+@pytest.mark.no_deps
+def test_github_pr_comments_pagination(stub_github_api: str, monkeypatch) -> None:
+    """
+    All pages should be retrieved, using the `Link` header and without requesting an empty final page.
+    """
+
+    monkeypatch.setattr(utils, "_github_client", GitHubClient(base_url=stub_github_api))
+
+    comments = utils.get_all_github_pr_comments(2)
+
+    assert [x["id"] for x in comments] == list(range(250))
+    assert len(StubGitHubHandler.requests_seen) == 3
+
+
+@pytest.mark.no_deps
+def test_github_client_raises_http_error_for_non_json_body(
+    stub_github_api: str,
+) -> None:
+    """
+    A 5xx response with an HTML body should raise the HTTP error, not a JSON decoding error.
+    """
+
+    client = GitHubClient(base_url=stub_github_api, token="dummy")
+
+    with pytest.raises(requests.HTTPError, match="502"):
+        client.request("GET", "bad-gateway")
+
+
+class FakeGitHubClient:
+    """In-memory PR comments, implements the `GitHubClient` methods used by utils"""
+
+    def __init__(self, comments: list) -> None:
+        self.comments = {x["id"]: x for x in comments}
+        self.calls: list = []
+
+    def request(self, method: str, endpoint: str, data=None, params=None):
+        return self.request_with_links(method, endpoint, data, params)[0]
+
+    def request_with_links(self, method: str, endpoint: str, data=None, params=None):
+        self.calls.append((method, endpoint.split("/")[-1]))
+        if method == "GET":
+            return sorted(self.comments.values(), key=lambda x: x["id"]), {}
+        if method == "POST":
+            comment_id = max(self.comments, default=0) + 1
+            self.comments[comment_id] = {
+                "id": comment_id,
+                "body": data["body"],
+                "user": {"login": "github-actions[bot]"},
+                "html_url": f"https://github.com/comments/{comment_id}",
+            }
+            return self.comments[comment_id], {}
+
+        comment_id = int(endpoint.split("/")[-1])
+        if method == "PATCH":
+            self.comments[comment_id]["body"] = data["body"]
+            return self.comments[comment_id], {}
+        if method == "DELETE":
+            del self.comments[comment_id]
+            return {"success": True}, {}
+
+
+def build_comment(comment_id: int, body: str, login: str = "github-actions[bot]"):
+    return {
+        "id": comment_id,
+        "body": body,
+        "user": {"login": login},
+        "html_url": f"https://github.com/comments/{comment_id}",
+    }
+
+
+@pytest.mark.no_deps
+def test_github_pr_comment_index(monkeypatch) -> None:
+    """
+    Bot comments are updated in place, older duplicates are deleted and comments from other users are never touched.
+    """
+
+    client = FakeGitHubClient(
+        [
+            build_comment(1, "Monitor: dim_customers old"),
+            build_comment(2, "Monitor: dim_customers older duplicate"),
+            build_comment(3, "Monitor: dim_customers", login="octocat"),
+            build_comment(4, "Monitor: fct_orders"),
+        ]
+    )
+    monkeypatch.setattr(utils, "_github_client", client)
+
+    # Comments are only retrieved once they are looked up
+    pr_comments = utils.GitHubPRCommentIndex(pull_request_id=1)
+    assert client.calls == []
+
+    # The latest bot comment is updated, the older one is a duplicate
+    url = pr_comments.upsert("Monitor: dim_customers", "Monitor: dim_customers new")
+    assert url == "https://github.com/comments/2"
+    assert client.calls[0] == ("GET", "comments")
+    assert client.comments[2]["body"] == "Monitor: dim_customers new"
+    assert 1 not in client.comments
+    assert client.comments[3]["body"] == "Monitor: dim_customers"
+
+    # Updating again uses the index, not another GET
+    pr_comments.upsert("Monitor: dim_customers", "Monitor: dim_customers newer")
+    assert client.calls.count(("GET", "comments")) == 1
+    assert client.comments[2]["body"] == "Monitor: dim_customers newer"
+
+    # No existing comment, one is created
+    url = pr_comments.upsert("Monitor: fct_payments", "Monitor: fct_payments")
+    assert url == "https://github.com/comments/5"
+
+    pr_comments.delete("Monitor: fct_orders")
+    assert 4 not in client.comments
+    pr_comments.delete("Monitor: fct_orders")
+    assert client.calls.count(("DELETE", "4")) == 1
+    assert sorted(client.comments) == [2, 3, 5]
+
+
+class PagedFakeGitHubClient(FakeGitHubClient):
+    """`FakeGitHubClient` that returns `per_page` comments per page with a `Link: rel="last"` header"""
+
+    def __init__(self, comments: list, per_page: int) -> None:
+        super().__init__(comments)
+        self.per_page = per_page
+        self.pages: list = []
+
+    def request_with_links(self, method: str, endpoint: str, data=None, params=None):
+        if method != "GET":
+            return super().request_with_links(method, endpoint, data, params)
+
+        self.pages.append(params["page"])
+        comments = sorted(self.comments.values(), key=lambda x: x["id"])
+        last_page = -(-len(comments) // self.per_page)
+        start = (params["page"] - 1) * self.per_page
+        return comments[start : start + self.per_page], {
+            "last": f"https://api.github.com/comments?page={last_page}"
+        }
+
+
+@pytest.mark.no_deps
+def test_github_pr_comment_index_stops_at_first_match(monkeypatch) -> None:
+    """
+    A lookup consumes pages as they arrive and stops once it finds a matching comment, deleting needs every page.
+    """
+
+    client = PagedFakeGitHubClient(
+        [build_comment(1, "Monitor: dim_customers")]
+        + [build_comment(x, f"Other comment {x}") for x in range(2, 11)]
+        + [build_comment(11, "Monitor: fct_orders")],
+        per_page=2,
+    )
+    monkeypatch.setattr(utils, "_github_client", client)
+    iter_pages = utils.iter_github_pr_comment_pages
+    monkeypatch.setattr(
+        utils,
+        "iter_github_pr_comment_pages",
+        lambda pull_request_id: iter_pages(pull_request_id, max_workers=1),
+    )
+
+    pr_comments = utils.GitHubPRCommentIndex(pull_request_id=1)
+    pr_comments.upsert("Monitor: dim_customers", "Monitor: dim_customers new")
+    # Page 1 has the match, at most `max_workers` later pages were requested
+    assert client.pages == [1]
+    assert client.comments[1]["body"] == "Monitor: dim_customers new"
+
+    pr_comments.delete("Monitor: fct_orders")
+    assert sorted(client.pages) == [1, 2, 3, 4, 5, 6]
+    assert 11 not in client.comments
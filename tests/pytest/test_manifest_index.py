@@ -0,0 +1,223 @@
+import base64
+import gzip
+import hashlib
+import io
+from pathlib import Path
+
+import pytest
+import utils
+from google.api_core.exceptions import PreconditionFailed
+
+
+class FakeBlob:
+    def __init__(self, bucket: "FakeBucket", name: str) -> None:
+        self.bucket = bucket
+        self.name = name
+        self.metadata = bucket.metadata.get(name)
+
+    @property
+    def generation(self) -> int:
+        return self.bucket.objects[self.name][1]
+
+    @property
+    def md5_hash(self) -> str:
+        return base64.b64encode(
+            hashlib.md5(self.bucket.objects[self.name][0]).digest()
+        ).decode()
+
+    def download_as_bytes(self) -> bytes:
+        self.bucket.reads.append(self.name)
+        return self.bucket.objects[self.name][0]
+
+    def download_to_filename(self, filename: str) -> None:
+        Path(filename).write_bytes(self.download_as_bytes())
+
+    def open(self, mode: str) -> io.BytesIO:
+        assert mode == "rb"
+        self.bucket.streamed_reads.append(self.name)
+        return io.BytesIO(self.bucket.objects[self.name][0])
+
+    def upload_from_filename(self, filename: str, content_type=None) -> None:
+        current_generation = self.bucket.objects.get(self.name, (b"", 0))[1]
+        self.bucket.objects[self.name] = (
+            Path(filename).read_bytes(),
+            current_generation + 1,
+        )
+        self.bucket.metadata[self.name] = self.metadata
+
+    def upload_from_string(
+        self, data: str, content_type: str, if_generation_match: int
+    ) -> None:
+        current_generation = self.bucket.objects.get(self.name, (b"", 0))[1]
+        if current_generation != if_generation_match:
+            raise PreconditionFailed("Generation does not match.")
+        self.bucket.objects[self.name] = (data.encode(), current_generation + 1)
+
+
+class FakeBucket:
+    """In-memory stand-in for `google.cloud.storage.Bucket`"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.objects: dict = {}
+        self.metadata: dict = {}
+        self.reads: list = []
+        self.streamed_reads: list = []
+        self.num_listings = 0
+        self.offset_listings: list = []
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str):
+        return FakeBlob(self, name) if name in self.objects else None
+
+    def list_blobs(self, start_offset=None) -> list:
+        if start_offset is None:
+            self.num_listings += 1
+        else:
+            self.offset_listings.append(start_offset)
+        return [
+            FakeBlob(self, name)
+            for name in sorted(self.objects)
+            if start_offset is None or name >= start_offset
+        ]
+
+
+@pytest.mark.no_deps
+def test_manifest_index_resolves_without_listing(tmp_path: Path, monkeypatch) -> None:
+    """
+    Once the index exists, "latest" and "previous" should be resolved without listing the bucket.
+    """
+
+    bucket = FakeBucket("beyond-basics-dbt-manifests-stg")
+    for build_number in [8, 10, 9]:
+        blob_name = f"uploaded_at=2024-01-0{build_number - 7} 00:00:00/github_run_number={build_number}/manifest.json"
+        bucket.objects[blob_name] = (str(build_number).encode(), 1)
+
+    # The first update seeds the index from the existing blobs
+    utils.update_manifest_index(bucket, 11, "github_run_number=11/manifest.json")
+    bucket.objects["github_run_number=11/manifest.json"] = (b"11", 1)
+    assert bucket.num_listings == 1
+
+    class FakeStorageClient:
+        def bucket(self, name: str) -> FakeBucket:
+            return bucket
+
+    monkeypatch.setattr(
+        utils, "get_gcp_auth_clients", lambda env: {"storage": FakeStorageClient()}
+    )
+    monkeypatch.setenv("MANIFEST_CACHE_DIR", str(tmp_path / "cache"))
+    for version, expected in [("latest", "11"), ("previous", "10"), ("latest", "11")]:
+        destination = tmp_path / version / "manifest.json"
+        utils.download_manifest_json("stg", str(destination), version)
+        assert destination.read_text() == expected
+
+    assert bucket.num_listings == 1
+
+    # The repeated download of "latest" is served from the local cache
+    manifest_reads = [x for x in bucket.reads if x.endswith("/manifest.json")]
+    assert manifest_reads == [
+        "github_run_number=11/manifest.json",
+        "uploaded_at=2024-01-03 00:00:00/github_run_number=10/manifest.json",
+    ]
+
+    # A blob in the index that has since been deleted falls back to scanning the bucket
+    del bucket.objects["github_run_number=11/manifest.json"]
+    destination = tmp_path / "stale" / "manifest.json"
+    utils.download_manifest_json("stg", str(destination), "latest")
+    assert destination.read_text() == "10"
+    assert bucket.num_listings == 2
+
+
+@pytest.mark.no_deps
+def test_manifest_index_includes_uploads_missing_from_index(
+    tmp_path: Path, monkeypatch
+) -> None:
+    """
+    A manifest uploaded after the newest indexed one, e.g. as updating the index failed, is found without a full scan.
+    """
+
+    bucket = FakeBucket("beyond-basics-dbt-manifests-stg")
+
+    class FakeStorageClient:
+        def bucket(self, name: str) -> FakeBucket:
+            return bucket
+
+    monkeypatch.setattr(
+        utils, "get_gcp_auth_clients", lambda env: {"storage": FakeStorageClient()}
+    )
+    monkeypatch.setenv("MANIFEST_CACHE_DIR", str(tmp_path / "cache"))
+
+    def blob_name(build_number: int) -> str:
+        return f"uploaded_at=2024-01-{build_number:02} 00:00:00/github_run_number={build_number}/manifest.json"
+
+    for build_number in [10, 11]:
+        bucket.objects[blob_name(build_number)] = (str(build_number).encode(), 1)
+        utils.update_manifest_index(bucket, build_number, blob_name(build_number))
+    bucket.num_listings = 0
+
+    # Uploaded, but the index was not updated
+    bucket.objects[blob_name(12)] = (b"12", 1)
+    for version, expected in [("latest", "12"), ("previous", "11")]:
+        destination = tmp_path / version / "manifest.json"
+        utils.download_manifest_json("stg", str(destination), version)
+        assert destination.read_text() == expected
+
+    assert bucket.num_listings == 0
+    assert bucket.offset_listings == [blob_name(11), blob_name(11)]
+
+    # Once the index is updated it is used as is
+    utils.update_manifest_index(bucket, 12, blob_name(12))
+    destination = tmp_path / "indexed" / "manifest.json"
+    utils.download_manifest_json("stg", str(destination), "latest")
+    assert destination.read_text() == "12"
+    assert bucket.num_listings == 0
+
+
+@pytest.mark.no_deps
+def test_upload_and_fetch_compressed_manifests(tmp_path: Path, monkeypatch) -> None:
+    """
+    Gzip compressed blobs are decompressed while streaming, blobs uploaded before compression are read as they are.
+    """
+
+    bucket = FakeBucket("beyond-basics-dbt-manifests-stg")
+
+    class FakeStorageClient:
+        def bucket(self, name: str) -> FakeBucket:
+            return bucket
+
+    monkeypatch.setattr(
+        utils, "get_gcp_auth_clients", lambda env: {"storage": FakeStorageClient()}
+    )
+    monkeypatch.setenv("MANIFEST_CACHE_DIR", str(tmp_path / "cache"))
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text('{"nodes": {}}' * 1000)
+
+    compressed_blob_name = utils.upload_to_gcs(
+        "stg", bucket.name, "github_run_number=2", str(manifest), compression="gzip"
+    )
+    assert compressed_blob_name == "github_run_number=2/manifest.json"
+    assert bucket.metadata[compressed_blob_name] == {"compression": "gzip"}
+    assert len(bucket.objects[compressed_blob_name][0]) < manifest.stat().st_size
+    assert (
+        gzip.decompress(bucket.objects[compressed_blob_name][0]).decode()
+        == manifest.read_text()
+    )
+
+    uncompressed_blob_name = utils.upload_to_gcs(
+        "stg", bucket.name, "github_run_number=1", str(manifest)
+    )
+    assert bucket.metadata[uncompressed_blob_name] is None
+
+    for blob_name in [compressed_blob_name, uncompressed_blob_name]:
+        cached_file = utils.fetch_blob_to_cache(bucket.get_blob(blob_name))
+        assert Path(cached_file).read_text() == manifest.read_text()
+    assert bucket.streamed_reads == [compressed_blob_name]
+    assert bucket.reads == [uncompressed_blob_name]
+
+    # Blobs with another compression are not read
+    bucket.objects["github_run_number=3/manifest.json"] = (b"{}", 1)
+    bucket.metadata["github_run_number=3/manifest.json"] = {"compression": "zstd"}
+    with pytest.raises(ValueError, match="zstd"):
+        utils.fetch_blob_to_cache(bucket.get_blob("github_run_number=3/manifest.json"))
@@ -0,0 +1,41 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+from manifest_loader import build_synthetic_manifest, get_manifest_index, load_manifest
+
+
+@pytest.mark.no_deps
+def test_manifest_loader_index_and_cache(tmp_path: Path) -> None:
+    path = tmp_path / "manifest.json"
+    manifest = build_synthetic_manifest(100)
+    with path.open("w") as f:
+        json.dump(manifest, f)
+
+    index = get_manifest_index(str(path))
+    assert load_manifest(str(path)) is load_manifest(str(path))
+    assert get_manifest_index(str(path)) is index
+
+    assert len(index.resource_types["model"]) == 100
+    assert len(index.tags["tag_0"]) == 10
+    assert index.relations["model_1"]["schema"] == "marts_1"
+    for unique_id in manifest["nodes"]:
+        assert index.children(unique_id) == manifest["child_map"][unique_id]
+        assert index.parents(unique_id) == manifest["parent_map"][unique_id]
+    assert index.descendants(["model.beyond_basics.model_0"]) == {
+        "model.beyond_basics.model_0",
+        *manifest["child_map"]["model.beyond_basics.model_0"],
+    } | set().union(
+        *(
+            index.descendants([x])
+            for x in manifest["child_map"]["model.beyond_basics.model_0"]
+        )
+    )
+
+    # A rewritten file is reloaded
+    manifest["nodes"]["model.beyond_basics.model_1"]["schema"] = "marts_new"
+    with path.open("w") as f:
+        json.dump(manifest, f)
+    os.utime(path, ns=(0, 0))
+    assert get_manifest_index(str(path)).relations["model_1"]["schema"] == "marts_new"
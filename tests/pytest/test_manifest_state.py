@@ -0,0 +1,101 @@
+import copy
+import json
+from pathlib import Path
+
+import pytest
+from dbt.cli.main import dbtRunner
+from manifest_state import ManifestStateComparison
+
+
+def dbt_ls(args: list, target_path: Path) -> list:
+    res = dbtRunner().invoke(
+        ["--quiet", "ls"]
+        + args
+        + [
+            "--output",
+            "json",
+            "--output-keys",
+            "unique_id",
+            "--target-path",
+            str(target_path),
+            "--log-path",
+            str(target_path.parent / "logs"),
+        ]
+    )
+    assert res.success, f"dbt ls {args} did not complete successfully."
+    return sorted(json.loads(x)["unique_id"] for x in res.result)
+
+
+@pytest.mark.manifest_json
+def test_manifest_state_comparison_matches_dbt_ls(tmp_path: Path, monkeypatch) -> None:
+    """
+    `ManifestStateComparison` must select the same nodes as dbt's own `state:modified` selector.
+
+    The previous manifest is the current project with a set of known modifications applied.
+    """
+
+    monkeypatch.setenv("DBT_PROFILES_DIR", ".")
+    monkeypatch.setenv("DBT_DATASET", "pytest")
+    # Anonymous usage stats write .user.yml to the profiles directory, i.e. the repo
+    monkeypatch.setenv("DBT_SEND_ANONYMOUS_USAGE_STATS", "false")
+
+    target_path = tmp_path / "target"
+    dbt_ls(["--select", "tag:marts"], target_path)
+    with (target_path / "manifest.json").open() as f:
+        current_manifest = json.load(f)
+
+    previous_manifest = copy.deepcopy(current_manifest)
+    nodes = previous_manifest["nodes"]
+    # Body change
+    nodes["model.beyond_basics.stg_jaffle_shop__customers"]["raw_code"] += "\n-- edit"
+    # Config change
+    nodes["model.beyond_basics.int_orders"]["unrendered_config"][
+        "materialized"
+    ] = "table"
+    # Tags are not compared by dbt
+    nodes["model.beyond_basics.int_customers"]["unrendered_config"]["tags"] = ["old"]
+    # New model
+    del nodes["model.beyond_basics.dim_customers"]
+    # Seed contents change
+    nodes["seed.beyond_basics.seed_stripe__payments"]["checksum"]["checksum"] = "0"
+    # Upstream macro change
+    previous_manifest["macros"]["macro.beyond_basics.cents_to_dollars"][
+        "macro_sql"
+    ] += " "
+    # Exposure change
+    exposure = next(iter(previous_manifest["exposures"].values()))
+    exposure["owner"] = {"email": "someone@else.com", "name": "Someone Else"}
+
+    state_path = tmp_path / "state"
+    state_path.mkdir()
+    with (state_path / "manifest.json").open("w") as f:
+        json.dump(previous_manifest, f)
+
+    comparison = ManifestStateComparison(previous_manifest, current_manifest)
+    state_args = ["--state", str(state_path)]
+
+    assert comparison.select(resource_types=["model"]) == dbt_ls(
+        ["--select", "state:modified", "--resource-type", "model"] + state_args,
+        target_path,
+    )
+    assert comparison.select(
+        downstream=True, exclude_modified=True, resource_types=["model"]
+    ) == dbt_ls(
+        [
+            "--select",
+            "state:modified+",
+            "--exclude",
+            "state:modified",
+            "--resource-type",
+            "model",
+        ]
+        + state_args,
+        target_path,
+    )
+    assert comparison.select(downstream=True, resource_types=["exposure"]) == dbt_ls(
+        ["--select", "state:modified+", "--resource-type", "exposure"] + state_args,
+        target_path,
+    )
+    assert comparison.select(downstream=True) == dbt_ls(
+        ["--select", "state:modified+"] + state_args, target_path
+    )
@@ -4,15 +4,161 @@ import pytest
 @pytest.mark.no_deps
 def test_mart_monitor_keys(mart_monitor_queries_yml: dict) -> None:
     """
-    Monitors must contains the following keys: monitor_name, model_name, query
+    Monitors must contains the following keys: monitor_name, model_name, query. Optionally followed by:
+    max_bytes_processed, partition_lookback_days, approximate
     """
 
     for monitor in mart_monitor_queries_yml["query_data"]:
-        assert list(monitor.keys()) == [
+        assert list(monitor.keys())[:3] == [
             "monitor_name",
             "model_name",
             "query",
         ], f"Monitor {monitor['monitor_name']} must contains the follwoing keys: monitor_name, model_name, query."
+        assert set(list(monitor.keys())[3:]) <= {
+            "max_bytes_processed",
+            "partition_lookback_days",
+            "approximate",
+        }, f"Monitor {monitor['monitor_name']} can only contain the following optional keys: max_bytes_processed, partition_lookback_days, approximate."
+        assert isinstance(
+            monitor.get("max_bytes_processed", 0), int
+        ), f"`max_bytes_processed` of monitor {monitor['monitor_name']} must be an integer."
+        assert isinstance(
+            monitor.get("partition_lookback_days", 0), int
+        ), f"`partition_lookback_days` of monitor {monitor['monitor_name']} must be an integer."
+        assert isinstance(
+            monitor.get("approximate", False), bool
+        ), f"`approximate` of monitor {monitor['monitor_name']} must be a boolean."
+
+
+@pytest.mark.no_deps
+def test_apply_byte_budgets() -> None:
+    """
+    Monitors over their own budget, or that would exceed the run budget, are skipped.
+    """
+
+    from mart_monitor_commenter import apply_byte_budgets
+
+    monitors = [
+        {"monitor_name": "small"},
+        {"monitor_name": "override", "max_bytes_processed": 10},
+        {"monitor_name": "large"},
+        {"monitor_name": "last"},
+    ]
+    estimates = {
+        "small": {"cicd": 1, "stg": 10, "prd": 10},
+        "override": {"cicd": 1, "stg": 10, "prd": 10},
+        "large": {"cicd": 1, "stg": 100, "prd": 100},
+        "last": {"cicd": 1, "stg": 30, "prd": 30},
+    }
+
+    monitors_to_run, skipped_monitors = apply_byte_budgets(
+        monitors, estimates, max_bytes_per_monitor=100, max_bytes_per_run=70
+    )
+
+    assert [x["monitor_name"] for x in monitors_to_run] == ["small"]
+    assert skipped_monitors == {
+        "override": "estimated 21 B exceeds the monitor budget of 10 B",
+        "large": "estimated 201 B exceeds the monitor budget of 100 B",
+        "last": "estimated 61 B would exceed the run budget of 70 B",
+    }
+
+
+@pytest.mark.no_deps
+def test_estimate_monitor_bytes_only_estimates_queries_that_run(
+    fake_bigquery, monkeypatch, tmp_path
+) -> None:
+    """
+    Partitioned monitors are estimated on their lookback partitions, cached stg and prd baselines are not estimated.
+    """
+
+    import datetime
+
+    import mart_monitor_commenter
+    from monitor_baselines import MonitorBaselineCache
+
+    class FakeHistory:
+        def get_baseline(self, query_template, table_name, max_age):
+            if "from_history" in query_template and table_name == "prd":
+                return [{"table_name": "prd", "row_cnt": 1}]
+            return None
+
+    dry_runs: list = []
+
+    def dry_run_query(client, query: str) -> int:
+        dry_runs.append((client.project, query))
+        return 10
+
+    monkeypatch.setattr(mart_monitor_commenter, "dry_run_query", dry_run_query)
+    fake_bigquery(
+        relations={
+            "fct_bitcoin_blocks": {
+                "schema": "marts",
+                "partition_by": {
+                    "data_type": "timestamp",
+                    "field": "created_at",
+                    "granularity": "day",
+                },
+            },
+            "dim_wallets": {"schema": "marts", "partition_by": None},
+        },
+        respond=lambda project, query: [],
+    )
+    query = (
+        "select '{{ env }}' as table_name, count(*) as row_cnt from {{ table_name }}"
+    )
+    monitors = [
+        {
+            "monitor_name": "partitioned",
+            "model_name": "fct_bitcoin_blocks",
+            "query": query,
+            "partition_lookback_days": 2,
+        },
+        {"monitor_name": "from_cache", "model_name": "dim_wallets", "query": query},
+        {
+            "monitor_name": "from_history",
+            "model_name": "dim_wallets",
+            "query": query + " -- from_history",
+        },
+    ]
+    baseline_cache = MonitorBaselineCache(
+        cache_dir=str(tmp_path),
+        metadata_provider=lambda env, table_id: datetime.datetime(2024, 1, 1),
+    )
+    for env in ["stg", "prd"]:
+        rendered_query = mart_monitor_commenter.render_monitor_query(
+            query_template=query,
+            env=env,
+            project=env,
+            cicd_dataset="pytest_dataset",
+            model_name="dim_wallets",
+        )
+        baseline_cache.set(
+            baseline_cache.key(
+                env=mart_monitor_commenter.MONITOR_SERVICE_ACCOUNTS[env],
+                query=rendered_query,
+                table_id=f"{env}.marts.dim_wallets",
+            ),
+            [{"table_name": env, "row_cnt": 1}],
+        )
+
+    estimates = mart_monitor_commenter.estimate_monitor_bytes(
+        monitors=monitors,
+        cicd_dataset="pytest_dataset",
+        baseline_cache=baseline_cache,
+        history=FakeHistory(),
+        max_baseline_age=datetime.timedelta(hours=24),
+    )
+
+    assert estimates == {
+        "partitioned": {"cicd": 10, "stg": 10, "prd": 10},
+        "from_cache": {"cicd": 10, "stg": 0, "prd": 0},
+        "from_history": {"cicd": 10, "stg": 10, "prd": 0},
+    }
+    partitioned_queries = [x for x in dry_runs if "partition_id" in x[1]]
+    assert len(partitioned_queries) == 3
+    for _, partitioned_query in partitioned_queries:
+        assert partitioned_query.count("created_at >= timestamp(") == 3
+    assert len(dry_runs) == 6
 
 
 @pytest.mark.no_deps
@@ -27,3 +173,468 @@ def test_mart_monitor_query_has_table_name(
         assert (
             monitor["query"].find("'{{ env }}' as table_name,") > 0
         ), f"Query for `{monitor['monitor_name']}` must contain `'{{ env }}' as table_name,`."
+
+
+@pytest.mark.no_deps
+def test_fetch_batched_results_isolates_monitor_errors(fake_bigquery) -> None:
+    """
+    Batched monitors run as one job per environment, a failing monitor only drops its own row for that environment.
+    """
+
+    import mart_monitor_commenter
+
+    monitors = [
+        {
+            "monitor_name": f"monitor_{i}",
+            "model_name": f"model_{i}",
+            "query": "select '{{ env }}' as table_name, 1 as row_cnt from {{ table_name }}",
+        }
+        for i in range(2)
+    ]
+
+    def respond(project: str, script: str) -> list:
+        env = "cicd" if "pytest_dataset" in script else project
+        return [
+            {
+                "monitor_index": 0,
+                "result": f'{{"table_name": "{env}", "row_cnt": "9007199254740993"}}',
+                "error": None,
+            },
+            {
+                "monitor_index": 1,
+                "result": (
+                    None if env == "prd" else f'{{"table_name": "{env}", "row_cnt": 1}}'
+                ),
+                "error": "Unrecognized name: row_cnt" if env == "prd" else None,
+            },
+        ]
+
+    clients = fake_bigquery(
+        relations={f"model_{i}": {"schema": "marts"} for i in range(2)},
+        respond=respond,
+    )
+
+    results, cicd_errors = mart_monitor_commenter.fetch_batched_results_from_bigquery(
+        monitors=monitors, cicd_dataset="pytest_dataset"
+    )
+
+    assert len(clients["stg"].queries) == 2  # cicd and stg
+    assert len(clients["prd"].queries) == 1
+    assert cicd_errors == {}
+    assert [x["table_name"] for x in results["monitor_0"]] == ["cicd", "stg", "prd"]
+    assert results["monitor_0"][0]["row_cnt"] == 9007199254740993
+    assert [x["table_name"] for x in results["monitor_1"]] == ["cicd", "stg"]
+
+
+@pytest.mark.no_deps
+def test_run_query_retries_only_transient_errors(fake_bigquery) -> None:
+    """
+    Transient errors are retried for the failing environment only, invalid queries are not retried.
+    """
+
+    from google.api_core.exceptions import BadRequest, ServiceUnavailable
+    from mart_monitor_commenter import run_query
+
+    errors = [ServiceUnavailable("Try again")]
+
+    def respond(project: str, query: str):
+        return errors.pop(0) if errors else [{"table_name": "prd", "row_cnt": 1}]
+
+    client = fake_bigquery(relations={}, respond=respond)["prd"]
+    assert run_query(client=client, query="select 1", env="prd", delay=0) == [
+        {"table_name": "prd", "row_cnt": 1}
+    ]
+    assert len(client.queries) == 2
+
+    errors.append(BadRequest("Unrecognized name: row_cnt"))
+    with pytest.raises(BadRequest):
+        run_query(client=client, query="select 1", env="prd", delay=0)
+    assert len(client.queries) == 3
+
+
+@pytest.mark.no_deps
+def test_run_query_stops_once_cancelled() -> None:
+    """
+    A cancelled monitor cancels its BigQuery job and does not submit it again.
+    """
+
+    import concurrent.futures
+    import threading
+
+    from google.api_core.exceptions import ServiceUnavailable
+    from mart_monitor_commenter import run_query
+    from monitor_scheduler import MonitorCancelledError
+
+    class SlowQueryJob:
+        def __init__(self) -> None:
+            self.cancelled = False
+
+        def result(self, timeout=None) -> list:
+            raise concurrent.futures.TimeoutError()
+
+        def cancel(self) -> None:
+            self.cancelled = True
+
+    class FakeClient:
+        def __init__(self, job_factory) -> None:
+            self.jobs: list = []
+            self.queries = 0
+            self.job_factory = job_factory
+
+        def query(self, query: str):
+            self.queries += 1
+            self.jobs.append(self.job_factory())
+            return self.jobs[-1]
+
+    cancelled = threading.Event()
+    cancelled.set()
+    client = FakeClient(SlowQueryJob)
+    with pytest.raises(MonitorCancelledError):
+        run_query(
+            client=client, query="select 1", env="prd", cancelled=cancelled, delay=0
+        )
+    assert client.queries == 1
+    assert [x.cancelled for x in client.jobs] == [True]
+
+    def failing_job():
+        raise ServiceUnavailable("Try again")
+
+    client = FakeClient(failing_job)
+    with pytest.raises(ServiceUnavailable):
+        run_query(
+            client=client, query="select 1", env="prd", cancelled=cancelled, delay=0
+        )
+    assert client.queries == 1
+
+
+@pytest.mark.no_deps
+def test_format_results_matches_per_metric_implementation() -> None:
+    """
+    The vectorized `format_results` returns the same comment data as the previous per metric implementation.
+    """
+
+    from benchmark_format_results import build_results, format_results_per_metric
+    from mart_monitor_commenter import format_results
+
+    results = build_results(200)
+    assert format_results(results) == format_results_per_metric(results)
+
+    # NULL and zero CICD values
+    results = [
+        {"table_name": "cicd", "row_cnt": 0, "sum_value": None, "avg_value": 1.5},
+        {"table_name": "stg", "row_cnt": 5, "sum_value": 3, "avg_value": 1.25},
+        {"table_name": "prd", "row_cnt": 0, "sum_value": None, "avg_value": 1.5},
+    ]
+    assert format_results(results) == format_results_per_metric(results)
+
+    # Integers above 2^53 are not rounded
+    data = format_results(
+        [
+            {"table_name": "cicd", "row_cnt": 9007199254740993},
+            {"table_name": "prd", "row_cnt": 9007199254740992},
+        ]
+    )
+    assert data["diff_row_cnt_pct"] == [
+        "row_cnt",
+        "9007199254740993",
+        "🟢 9007199254740992 (0.0%)",
+    ]
+
+
+@pytest.mark.no_deps
+def test_approximate_monitors_widen_thresholds() -> None:
+    """
+    Approximate monitors compute distinct counts with HLL sketches, differences within the sketch error are green.
+    """
+
+    from mart_monitor_commenter import (
+        APPROXIMATE_METRIC_TOLERANCES,
+        build_approximate_monitor_query,
+        format_results,
+    )
+
+    query, tolerances = build_approximate_monitor_query(
+        """select
+  count(*) as row_cnt,
+  COUNT(DISTINCT coalesce(first_name, last_name)) as distinct_name,
+  approx_quantiles(amount, 100)[offset(50)] as median_amount,
+from {{ table_name }}"""
+    )
+    assert "count(distinct" not in query.lower()
+    assert (
+        "hll_count.extract(hll_count.init(coalesce(first_name, last_name))) as distinct_name"
+        in query
+    )
+    assert tolerances == {
+        "distinct_name": APPROXIMATE_METRIC_TOLERANCES["hll_count"],
+        "median_amount": APPROXIMATE_METRIC_TOLERANCES["approx_quantiles"],
+    }
+
+    query, _ = build_approximate_monitor_query(
+        "select count(distinct id) as distinct_id from t", keep_sketches=True
+    )
+    assert query == (
+        "select hll_count.extract(hll_count.init(id)) as distinct_id, "
+        "hll_count.init(id) as distinct_id__hll_sketch from t"
+    )
+
+    results = [
+        {"table_name": "cicd", "row_cnt": 1000, "distinct_name": 1000},
+        {"table_name": "prd", "row_cnt": 1010, "distinct_name": 1010},
+    ]
+    assert format_results(results, tolerances)["diff_distinct_name_pct"][2] == (
+        "🟢 1010 (1.0%)"
+    )
+    assert format_results(results, tolerances)["diff_row_cnt_pct"][2] == (
+        "🔴 1010 (1.0%)"
+    )
+
+
+@pytest.mark.no_deps
+def test_roll_up_partitions_merges_hll_sketches() -> None:
+    """
+    Distinct counts of approximate partitioned monitors are rolled up by merging their sketches, not summed.
+    """
+
+    from mart_monitor_commenter import roll_up_partitions
+
+    rows = [
+        {
+            "table_name": "prd",
+            "row_cnt": 10,
+            "distinct_id": 5,
+            "distinct_id__hll_sketch": b"a",
+        },
+        {
+            "table_name": "prd",
+            "row_cnt": 20,
+            "distinct_id": 6,
+            "distinct_id__hll_sketch": b"b",
+        },
+    ]
+    merged_sketches = []
+
+    def merge_sketches(sketches: dict) -> dict:
+        merged_sketches.append(sketches)
+        return {"distinct_id": 8}
+
+    assert roll_up_partitions(
+        rows, additive_metrics={"row_cnt"}, merge_sketches=merge_sketches
+    ) == [{"table_name": "prd", "row_cnt": 30, "distinct_id": 8}]
+    assert merged_sketches == [{"distinct_id": [b"a", b"b"]}]
+    with pytest.raises(ValueError, match="merge_sketches"):
+        roll_up_partitions(rows, additive_metrics={"row_cnt"})
+
+
+@pytest.mark.no_deps
+def test_roll_up_partitions_only_sums_additive_metrics() -> None:
+    """
+    Only counts and sums are summed across partitions, other metrics cannot be rolled up and the monitor is run on
+    the full table instead.
+    """
+
+    from mart_monitor_commenter import (
+        apply_partition_roll_up_check,
+        get_additive_metrics,
+        roll_up_partitions,
+    )
+
+    query = """select
+    '{{ env }}' as table_name,
+    count(*) as row_cnt,
+    count(distinct id) as distinct_id,
+    countif(fee > 0) as fee_cnt,
+    sum(coalesce(fee, 0)) as sum_fee,
+    min(fee) as min_fee,
+    avg(fee) as avg_fee,
+    sum(fee) / count(*) as fee_ratio,
+    concat('a, ', 'from') as text
+from {{ table_name }}"""
+    assert get_additive_metrics(query) == {"row_cnt", "fee_cnt", "sum_fee"}
+
+    rows = [
+        {"table_name": "prd", "row_cnt": 10, "min_fee": 1},
+        {"table_name": "prd", "row_cnt": 20, "min_fee": 2},
+    ]
+    assert roll_up_partitions(
+        [{k: v for k, v in x.items() if k != "min_fee"} for x in rows],
+        additive_metrics={"row_cnt"},
+    ) == [{"table_name": "prd", "row_cnt": 30}]
+    with pytest.raises(ValueError, match="min_fee"):
+        roll_up_partitions(rows, additive_metrics={"row_cnt"})
+
+    monitors = [
+        {"monitor_name": "a", "query": query, "partition_lookback_days": 7},
+        {
+            "monitor_name": "b",
+            "query": "select '{{ env }}' as table_name, count(*) as row_cnt, sum(fee) as sum_fee from {{ table_name }}",
+            "partition_lookback_days": 7,
+        },
+    ]
+    assert [
+        "partition_lookback_days" in x for x in apply_partition_roll_up_check(monitors)
+    ] == [False, True]
+
+
+@pytest.mark.no_deps
+def test_approximate_partitioned_monitors_can_be_rolled_up(
+    mart_monitor_queries_yml: dict,
+) -> None:
+    """
+    Exact distinct counts cannot be rolled up across partitions, approximate ones can.
+    """
+
+    from mart_monitor_commenter import (
+        apply_approximate_mode,
+        apply_partition_roll_up_check,
+    )
+
+    example_monitor = {
+        "monitor_name": "fct_bitcoin_blocks approximate monitor",
+        "model_name": "fct_bitcoin_blocks",
+        "query": """select
+  '{{ env }}' as table_name,
+  count(*) as row_cnt,
+  count(distinct block_hash) as distinct_block_hash,
+  sum(size) as sum_size
+from {{ table_name }}""",
+        "partition_lookback_days": 7,
+    }
+    exact_monitors = apply_partition_roll_up_check([example_monitor])
+    assert "partition_lookback_days" not in exact_monitors[0]
+
+    monitors, _ = apply_approximate_mode(
+        [{**example_monitor, "approximate": True}]
+        + mart_monitor_queries_yml["query_data"]
+    )
+    for monitor, checked_monitor in zip(
+        monitors, apply_partition_roll_up_check(monitors)
+    ):
+        assert ("partition_lookback_days" in monitor) == (
+            "partition_lookback_days" in checked_monitor
+        ), f"Monitor {monitor['monitor_name']} has `partition_lookback_days` but its metrics cannot be rolled up across partitions."
+
+
+@pytest.mark.manifest_json
+def test_partitioned_monitors_are_on_day_partitioned_models(
+    manifest_json: dict, mart_monitor_queries_yml: dict
+) -> None:
+    """
+    Monitors with `partition_lookback_days` must be on models partitioned by day.
+    """
+
+    for monitor in mart_monitor_queries_yml["query_data"]:
+        if "partition_lookback_days" in monitor:
+            partition_by = manifest_json["nodes"][
+                f"model.beyond_basics.{monitor['model_name']}"
+            ]["config"]["partition_by"]
+            assert (
+                partition_by is not None
+                and partition_by.get("granularity", "day") == "day"
+            ), f"Monitor {monitor['monitor_name']} has `partition_lookback_days` but {monitor['model_name']} is not partitioned by day."
+
+
+@pytest.mark.no_deps
+def test_fetch_partitioned_results_only_queries_modified_partitions(
+    fake_bigquery, tmp_path
+) -> None:
+    """
+    stg and prd partitions are queried again only when modified, the comment shows which partition differs.
+    """
+
+    import datetime
+    import re
+
+    import mart_monitor_commenter
+    from monitor_baselines import PartitionAggregateStore
+
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    partition_ids = [
+        (today - datetime.timedelta(days=x)).strftime("%Y%m%d")
+        for x in range(2, -1, -1)
+    ]
+
+    queried_partitions: dict = {"stg": [], "prd": []}
+
+    def respond(project: str, query: str) -> list:
+        rows = []
+        for partition_id, env in re.findall(
+            r"select '(\d+)' as partition_id, t\.\* from \(\nselect '(\w+)'", query
+        ):
+            assert f"created_at >= timestamp('{partition_id[:4]}-" in query
+            queried_partitions[project].append((env, partition_id))
+            rows.append(
+                {
+                    "partition_id": partition_id,
+                    "table_name": env,
+                    "row_cnt": (
+                        11 if env == "prd" and partition_id == partition_ids[1] else 10
+                    ),
+                }
+            )
+        return rows
+
+    last_modified_times = {
+        env: {x: datetime.datetime(2024, 1, 1) for x in partition_ids}
+        for env in ["stg", "prd"]
+    }
+    fake_bigquery(
+        relations={
+            "fct_bitcoin_blocks": {
+                "schema": "marts",
+                "partition_by": {
+                    "data_type": "timestamp",
+                    "field": "created_at",
+                    "granularity": "day",
+                },
+            }
+        },
+        respond=respond,
+    )
+    monitor = {
+        "monitor_name": "fct_bitcoin_blocks monitor",
+        "model_name": "fct_bitcoin_blocks",
+        "query": "select '{{ env }}' as table_name, count(*) as row_cnt from {{ table_name }}",
+        "partition_lookback_days": 2,
+    }
+
+    def fetch() -> tuple:
+        return mart_monitor_commenter.fetch_partitioned_results_from_bigquery(
+            monitor=monitor,
+            cicd_dataset="pytest_dataset",
+            partition_store=PartitionAggregateStore(cache_dir=str(tmp_path)),
+            partitions_provider=lambda env, table_id: last_modified_times[env],
+        )
+
+    results, partition_results = fetch()
+    assert results == [
+        {"table_name": "cicd", "row_cnt": 30},
+        {"table_name": "stg", "row_cnt": 30},
+        {"table_name": "prd", "row_cnt": 31},
+    ]
+    assert len(queried_partitions["stg"]) == 6  # cicd and stg
+    assert len(queried_partitions["prd"]) == 3
+
+    markdown = mart_monitor_commenter.transform_partition_diffs_to_markdown(
+        partition_results
+    )
+    assert partition_ids[1] in markdown
+    assert partition_ids[0] not in markdown and partition_ids[2] not in markdown
+
+    last_modified_times["prd"][partition_ids[2]] = datetime.datetime(2024, 1, 2)
+    assert fetch()[0] == results
+    assert queried_partitions["stg"][6:] == [("cicd", x) for x in partition_ids]
+    assert queried_partitions["prd"][3:] == [("prd", partition_ids[2])]
+
+    # Filters on the current date change the oldest and newest partitions without them being modified
+    monitor["query"] = (
+        "select '{{ env }}' as table_name, count(*) as row_cnt from {{ table_name }} "
+        "where created_at >= timestamp_sub(current_timestamp(), interval 2 day)"
+    )
+    fetch()
+    del queried_partitions["prd"][:]
+    assert fetch()[0] == results
+    assert queried_partitions["prd"] == [
+        ("prd", partition_ids[0]),
+        ("prd", partition_ids[2]),
+    ]
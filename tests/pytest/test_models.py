@@ -95,8 +95,13 @@ def test_model_marts_correct_locations() -> None:
 
 
 @pytest.mark.manifest_json
-def test_models_marts_must_have_monitors(manifest_json: dict) -> None:
-    """As marts are exposed to external users we should have at least one monitor on them in `mart_monitor_queries.yml`."""
+def test_models_marts_must_have_monitors(manifest_json: dict, tmp_path: Path) -> None:
+    """
+    As marts are exposed to external users we should have at least one monitor on them, either in
+    `mart_monitor_queries.yml` or generated from catalog.json by `monitor_generator.py`.
+    """
+
+    from monitor_generator import generate_monitors
 
     mart_models = [
         k.split(".")[-1]
@@ -109,12 +114,18 @@ def test_models_marts_must_have_monitors(manifest_json: dict) -> None:
     ) as f:
         query_data = yaml.safe_load(f)
 
-    models_with_monitors = [x["model_name"] for x in query_data["query_data"]]
+    generated_monitors = generate_monitors(
+        query_data["query_data"], cache_dir=str(tmp_path)
+    )
+    assert {x["model_name"] for x in generated_monitors} <= set(mart_models)
+    models_with_monitors = [
+        x["model_name"] for x in query_data["query_data"] + generated_monitors
+    ]
 
     for mart in mart_models:
         assert (
             mart in models_with_monitors
-        ), f"{mart} does not have an associated monitor in `mart_monitor_queries.yml`."
+        ), f"{mart} does not have an associated monitor in `mart_monitor_queries.yml` and no monitor was generated for it, generating a monitor requires catalog.json."
 
 
 @pytest.mark.no_deps
@@ -0,0 +1,129 @@
+import datetime
+import decimal
+from pathlib import Path
+
+import pytest
+from monitor_baselines import MonitorBaselineCache
+
+
+@pytest.mark.no_deps
+def test_monitor_baseline_cache_only_queries_cicd_on_repeated_runs(
+    fake_bigquery, tmp_path: Path
+) -> None:
+    """
+    stg and prd results are reused until the queried table is modified.
+    """
+
+    import mart_monitor_commenter
+
+    def respond(project: str, query: str) -> list:
+        return [
+            {
+                "table_name": query.split("'")[1],
+                "row_cnt": 10,
+                "sum_value": decimal.Decimal("1.5"),
+            }
+        ]
+
+    last_modified_times = {
+        "stg.marts.dim_customers": datetime.datetime(2024, 1, 1),
+        "prd.marts.dim_customers": datetime.datetime(2024, 1, 1),
+    }
+    metadata_requests = []
+
+    def fake_metadata_provider(env: str, table_id: str) -> datetime.datetime:
+        metadata_requests.append((env, table_id))
+        return last_modified_times[table_id]
+
+    clients = fake_bigquery(
+        relations={"dim_customers": {"schema": "marts"}}, respond=respond
+    )
+    baseline_cache = MonitorBaselineCache(
+        cache_dir=str(tmp_path), metadata_provider=fake_metadata_provider
+    )
+
+    def queried_envs(env: str) -> list:
+        return [x.split("'")[1] for x in clients[env].queries]
+
+    def fetch() -> list:
+        return mart_monitor_commenter.fetch_results_from_bigquery(
+            query_template="select '{{ env }}' as table_name, count(*) as row_cnt from {{ table_name }}",
+            cicd_dataset="pytest_dataset",
+            model_name="dim_customers",
+            baseline_cache=baseline_cache,
+        )
+
+    first_results = fetch()
+    assert queried_envs("stg") == ["cicd", "stg"]
+    assert queried_envs("prd") == ["prd"]
+
+    # Cached rows keep the types returned by BigQuery
+    assert fetch() == first_results
+    assert queried_envs("stg") == ["cicd", "stg", "cicd"]
+    assert queried_envs("prd") == ["prd"]
+    assert ("stg", "stg.marts.dim_customers") in metadata_requests
+
+    last_modified_times["prd.marts.dim_customers"] = datetime.datetime(2024, 1, 2)
+    fetch()
+    assert queried_envs("stg") == ["cicd", "stg", "cicd", "cicd"]
+    assert queried_envs("prd") == ["prd", "prd"]
+
+
+@pytest.mark.no_deps
+def test_monitor_baseline_cache_is_pruned_when_written(tmp_path: Path) -> None:
+    """
+    Results not read for `max_age` are expired and the least recently used results are evicted above `max_bytes`.
+    """
+
+    import os
+
+    baseline_cache = MonitorBaselineCache(
+        cache_dir=str(tmp_path),
+        max_age=datetime.timedelta(days=14),
+        max_bytes=150,
+    )
+    now = datetime.datetime.now().timestamp()
+    for i, age_days in enumerate([20, 3, 2, 1]):
+        baseline_cache.set(f"key_{i}", [{"table_name": "prd", "row_cnt": i}])
+        os.utime(tmp_path / f"key_{i}.json", (now, now - age_days * 86400))
+
+    # Reading key_1 makes key_2 the least recently used
+    assert baseline_cache.get("key_1") == [{"table_name": "prd", "row_cnt": 1}]
+    baseline_cache.set("key_4", [{"table_name": "prd", "row_cnt": 4}] * 2)
+
+    assert sorted(x.stem for x in tmp_path.iterdir()) == ["key_1", "key_3", "key_4"]
+    assert baseline_cache.get("key_0") is None
+
+
+@pytest.mark.no_deps
+def test_monitor_baseline_cache_concurrent_writes(tmp_path: Path, monkeypatch) -> None:
+    """
+    Concurrent monitors write through their own temporary files, files deleted by another process are skipped.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    from monitor_baselines import prune_cache_dir
+
+    baseline_cache = MonitorBaselineCache(cache_dir=str(tmp_path))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(
+            executor.map(
+                lambda i: baseline_cache.set(
+                    "key", [{"table_name": "prd", "row_cnt": i}]
+                ),
+                range(200),
+            )
+        )
+
+    assert [x.name for x in tmp_path.iterdir()] == ["key.json"]
+    assert baseline_cache.get("key")[0]["row_cnt"] in range(200)
+
+    # A file that is deleted between listing the directory and reading its size
+    iterdir = Path.iterdir
+    monkeypatch.setattr(
+        Path, "iterdir", lambda self: [*iterdir(self), self / "deleted.json"]
+    )
+    monkeypatch.setattr(Path, "is_file", lambda self: True)
+    prune_cache_dir(tmp_path, max_age=datetime.timedelta(days=1), max_bytes=1)
+    assert list(iterdir(tmp_path)) == []
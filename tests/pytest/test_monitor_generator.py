@@ -0,0 +1,110 @@
+import json
+from pathlib import Path
+
+import pytest
+from monitor_generator import build_profiling_query, generate_monitors
+
+
+@pytest.mark.no_deps
+def test_build_profiling_query() -> None:
+    """
+    Generated queries profile every column in one scan, numeric aggregates are only computed on numeric columns.
+    """
+
+    query = build_profiling_query(
+        {
+            "customer_id": "INT64",
+            "first_name": "STRING",
+            "customer_lifetime_value": "NUMERIC(10, 2)",
+            "order_ids": "ARRAY<INT64>",
+            "address": "STRUCT<city STRING>",
+            "address.city": "STRING",
+        }
+    )
+
+    assert query.count("from {{ table_name }}") == 1
+    assert "count(*) as row_cnt" in query
+    assert "countif(`customer_id` is null) as null_customer_id" in query
+    assert "count(distinct `first_name`) as distinct_first_name" in query
+    assert "sum(`first_name`)" not in query
+    assert "max(`customer_lifetime_value`) as max_customer_lifetime_value" in query
+    assert "distinct `order_ids`" not in query and "distinct `address`" not in query
+    assert "address.city" not in query
+
+
+@pytest.mark.no_deps
+def test_generate_monitors_reuses_queries_of_unchanged_models(tmp_path: Path) -> None:
+    """
+    Only marts without a hand-written monitor get a generated monitor, the query is reused while the checksum is
+    unchanged.
+    """
+
+    def write_manifest(checksum: str) -> str:
+        path = tmp_path / f"manifest_{checksum}.json"
+        path.write_text(
+            json.dumps(
+                {
+                    "nodes": {
+                        f"model.beyond_basics.{x}": {
+                            "name": x,
+                            "resource_type": "model",
+                            "database": "stg",
+                            "schema": "marts",
+                            "alias": x,
+                            "relation_name": f"`stg`.`marts`.`{x}`",
+                            "tags": ["marts"],
+                            "checksum": {"name": "sha256", "checksum": checksum},
+                        }
+                        for x in ["dim_customers", "fct_orders"]
+                    }
+                }
+            )
+        )
+        return str(path)
+
+    catalog_path = tmp_path / "catalog.json"
+    catalog_path.write_text(
+        json.dumps(
+            {
+                "nodes": {
+                    "model.beyond_basics.fct_orders": {
+                        "columns": {
+                            "amount": {"name": "amount", "type": "FLOAT64", "index": 2},
+                            "order_id": {
+                                "name": "order_id",
+                                "type": "STRING",
+                                "index": 1,
+                            },
+                        }
+                    }
+                }
+            }
+        )
+    )
+    hand_written = [
+        {"monitor_name": "dim_customers monitor", "model_name": "dim_customers"}
+    ]
+    cache_dir = str(tmp_path / "cache")
+
+    monitors = generate_monitors(
+        hand_written, write_manifest("a"), str(catalog_path), cache_dir
+    )
+    assert [x["model_name"] for x in monitors] == ["fct_orders"]
+    assert monitors[0]["monitor_name"] == "fct_orders generated monitor"
+    assert monitors[0]["query"].index("null_order_id") < monitors[0]["query"].index(
+        "null_amount"
+    )
+
+    missing_catalog_path = str(tmp_path / "missing.json")
+    assert (
+        generate_monitors(
+            hand_written, write_manifest("a"), missing_catalog_path, cache_dir
+        )
+        == monitors
+    )
+    assert (
+        generate_monitors(
+            hand_written, write_manifest("b"), missing_catalog_path, cache_dir
+        )
+        == []
+    )
@@ -0,0 +1,181 @@
+import datetime
+from decimal import Decimal
+from pathlib import Path
+
+import pytest
+from monitor_history import MonitorHistoryStore
+
+
+@pytest.mark.no_deps
+def test_monitor_history_reuses_recent_baselines(fake_bigquery, tmp_path: Path) -> None:
+    """
+    stg and prd results recorded less than `max_baseline_age` ago are used instead of querying BigQuery.
+    """
+
+    import mart_monitor_commenter
+
+    def respond(project: str, query: str) -> list:
+        return [{"table_name": query.split("'")[1], "row_cnt": 10, "sum_value": 1.5}]
+
+    clients = fake_bigquery(
+        relations={"dim_customers": {"schema": "marts"}}, respond=respond
+    )
+    history = MonitorHistoryStore(history_dir=str(tmp_path))
+
+    def queried_envs(env: str) -> list:
+        return [x.split("'")[1] for x in clients[env].queries]
+
+    def fetch(max_baseline_age: datetime.timedelta) -> list:
+        return mart_monitor_commenter.fetch_results_from_bigquery(
+            query_template="select '{{ env }}' as table_name, count(*) as row_cnt, sum(value) as sum_value from {{ table_name }}",
+            cicd_dataset="pytest_dataset",
+            model_name="dim_customers",
+            history=history,
+            max_baseline_age=max_baseline_age,
+        )
+
+    first_results = fetch(datetime.timedelta(hours=1))
+    assert queried_envs("stg") == ["cicd", "stg"]
+    assert queried_envs("prd") == ["prd"]
+
+    assert fetch(datetime.timedelta(hours=1)) == first_results
+    assert queried_envs("stg") == ["cicd", "stg", "cicd"]
+    assert queried_envs("prd") == ["prd"]
+
+    fetch(datetime.timedelta(0))
+    assert queried_envs("prd") == ["prd", "prd"]
+
+
+@pytest.mark.no_deps
+def test_monitor_history_baselines_keep_exact_values(tmp_path: Path) -> None:
+    """
+    Baselines are returned with the type and precision they were recorded with, large integers and NUMERICs included.
+    """
+
+    history = MonitorHistoryStore(history_dir=str(tmp_path))
+    query_template = "select '{{ env }}' as table_name, count(*) as row_cnt, sum(value) as sum_value, avg(value) as avg_value, max(value) as max_value from {{ table_name }}"
+    row = {
+        "table_name": "prd",
+        "row_cnt": 9007199254740993,
+        "sum_value": Decimal("12345678901234567890.123456789"),
+        "avg_value": 1.5,
+        "max_value": None,
+    }
+    history.append(query_template, "dim_customers", [row])
+
+    baseline = history.get_baseline(query_template, "prd", datetime.timedelta(hours=1))
+    assert baseline == [row]
+    assert [type(x) for x in baseline[0].values()] == [
+        str,
+        int,
+        Decimal,
+        float,
+        type(None),
+    ]
+    assert history._execute(
+        "SELECT value FROM read_parquet($history_files) WHERE metric = 'row_cnt'", {}
+    ) == [(9007199254740992.0,)]
+
+
+@pytest.mark.no_deps
+def test_monitor_history_metric_tolerances(tmp_path: Path) -> None:
+    """
+    Metrics that historically differ from CICD get a wider threshold, metrics without enough history do not.
+    """
+
+    history = MonitorHistoryStore(history_dir=str(tmp_path))
+    query_template = (
+        "select '{{ env }}' as table_name, count(*) as row_cnt from {{ table_name }}"
+    )
+    now = datetime.datetime.now(datetime.timezone.utc)
+    assert history.metric_tolerances(query_template) == {}
+
+    for i, prd_row_cnt in enumerate([100, 101, 99, 102, 98, 100]):
+        recorded_at = now - datetime.timedelta(days=10 - i)
+        history.append(
+            query_template,
+            "dim_customers",
+            [{"table_name": "prd", "row_cnt": prd_row_cnt, "sum_value": 5}],
+            recorded_at=recorded_at - datetime.timedelta(hours=1),
+        )
+        history.append(
+            query_template,
+            "dim_customers",
+            [{"table_name": "cicd", "row_cnt": 100, "sum_value": 5}],
+            recorded_at=recorded_at,
+        )
+
+    tolerances = history.metric_tolerances(query_template)
+    assert tolerances["row_cnt"] == pytest.approx(2.8, abs=0.1)
+    assert tolerances["sum_value"] == 0.0
+    assert history.metric_tolerances(query_template, min_runs=7) == {}
+    assert history.metric_tolerances(query_template, max_tolerance=1.0) == {
+        "row_cnt": 1.0,
+        "sum_value": 0.0,
+    }
+
+
+@pytest.mark.no_deps
+def test_monitor_history_tolerances_use_recent_runs(tmp_path: Path) -> None:
+    """
+    Tolerances are computed over the latest runs, old differences from CICD no longer widen the threshold.
+    """
+
+    history = MonitorHistoryStore(history_dir=str(tmp_path))
+    query_template = (
+        "select '{{ env }}' as table_name, count(*) as row_cnt from {{ table_name }}"
+    )
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for i, prd_row_cnt in enumerate([90, 110, 90, 110, 100, 100, 100, 100, 100]):
+        recorded_at = now - datetime.timedelta(days=10 - i)
+        history.append(
+            query_template,
+            "dim_customers",
+            [{"table_name": "prd", "row_cnt": prd_row_cnt}],
+            recorded_at=recorded_at - datetime.timedelta(hours=1),
+        )
+        history.append(
+            query_template,
+            "dim_customers",
+            [{"table_name": "cicd", "row_cnt": 100}],
+            recorded_at=recorded_at,
+        )
+
+    assert history.metric_tolerances(query_template, max_tolerance=100) == {
+        "row_cnt": pytest.approx(14.1, abs=0.1)
+    }
+    assert history.metric_tolerances(query_template, max_runs=5) == {"row_cnt": 0.0}
+
+
+@pytest.mark.no_deps
+def test_monitor_history_compact(tmp_path: Path) -> None:
+    """
+    Compacting merges the history into one file and removes results older than the retention.
+    """
+
+    history = MonitorHistoryStore(
+        history_dir=str(tmp_path), retention=datetime.timedelta(days=30)
+    )
+    query_template = (
+        "select '{{ env }}' as table_name, count(*) as row_cnt from {{ table_name }}"
+    )
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for days in [60, 3, 2, 1]:
+        history.append(
+            query_template,
+            "dim_customers",
+            [{"table_name": "prd", "row_cnt": days}],
+            recorded_at=now - datetime.timedelta(days=days),
+        )
+
+    history.compact(max_files=4)
+    assert len(list(tmp_path.glob("*.parquet"))) == 4
+
+    history.compact(max_files=3)
+    assert len(list(tmp_path.glob("*.parquet"))) == 1
+    assert history.get_baseline(query_template, "prd", datetime.timedelta(days=7)) == [
+        {"table_name": "prd", "row_cnt": 1}
+    ]
+    assert history._execute(
+        "SELECT value FROM read_parquet($history_files) ORDER BY recorded_at", {}
+    ) == [(3.0,), (2.0,), (1.0,)]
@@ -0,0 +1,114 @@
+import threading
+import time
+
+import pytest
+from monitor_scheduler import MonitorCancelledError, run_monitors
+
+
+@pytest.mark.no_deps
+def test_run_monitors_outcomes() -> None:
+    """
+    Each monitor gets an outcome as soon as it finishes, a slow monitor is cancelled at its deadline.
+    """
+
+    monitors = [{"monitor_name": x} for x in ["slow", "fails", "ok"]]
+    finished = []
+    cancelled_events = {}
+
+    def run(monitor: dict, cancelled: threading.Event) -> None:
+        cancelled_events[monitor["monitor_name"]] = cancelled
+        if monitor["monitor_name"] == "slow":
+            while not cancelled.is_set():
+                time.sleep(0.01)
+            raise MonitorCancelledError()
+        elif monitor["monitor_name"] == "fails":
+            raise ValueError("Invalid query")
+
+    outcomes = run_monitors(
+        monitors, run=run, timeout=0.5, on_outcome=lambda x: finished.append(x)
+    )
+
+    assert outcomes == finished
+    assert [(x.monitor_name, x.status) for x in outcomes] == [
+        ("fails", "failed"),
+        ("ok", "ok"),
+        ("slow", "timed_out"),
+    ]
+    assert outcomes[0].error == "ValueError: Invalid query"
+    assert outcomes[2].duration >= 0.5
+    assert cancelled_events["slow"].is_set()
+    assert not cancelled_events["ok"].is_set()
+
+
+@pytest.mark.no_deps
+def test_run_monitors_project_concurrency() -> None:
+    """
+    No more monitors than `project_concurrency` query a project at once.
+    """
+
+    lock = threading.Lock()
+    running = {"stg": 0, "prd": 0}
+    max_running = {"stg": 0, "prd": 0}
+
+    def run(monitor: dict, cancelled: threading.Event) -> None:
+        with lock:
+            running[monitor["project"]] += 1
+            max_running[monitor["project"]] = max(
+                max_running[monitor["project"]], running[monitor["project"]]
+            )
+        time.sleep(0.05)
+        with lock:
+            running[monitor["project"]] -= 1
+
+    outcomes = run_monitors(
+        [
+            {"monitor_name": f"monitor_{i}", "project": ["stg", "prd"][i % 2]}
+            for i in range(12)
+        ],
+        run=run,
+        max_concurrency=8,
+        project_concurrency={"stg": 2, "prd": 3},
+        projects_for=lambda monitor: [monitor["project"]],
+    )
+
+    assert [x.status for x in outcomes] == ["ok"] * 12
+    assert max_running == {"stg": 2, "prd": 3}
+
+
+@pytest.mark.no_deps
+def test_run_monitors_keeps_slots_of_timed_out_monitors() -> None:
+    """
+    A timed out monitor keeps its slot until its thread stops, so the concurrency limit holds.
+    """
+
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def run(monitor: dict, cancelled: threading.Event) -> None:
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        try:
+            if monitor["monitor_name"] == "slow":
+                cancelled.wait()
+                # Stopping takes a while, e.g. cancelling a BigQuery job
+                time.sleep(0.2)
+                raise MonitorCancelledError()
+        finally:
+            with lock:
+                running[0] -= 1
+
+    outcomes = run_monitors(
+        [{"monitor_name": x} for x in ["slow", "ok_1", "ok_2"]],
+        run=run,
+        max_concurrency=1,
+        timeout=0.1,
+    )
+
+    assert [(x.monitor_name, x.status) for x in outcomes] == [
+        ("slow", "timed_out"),
+        ("ok_1", "ok"),
+        ("ok_2", "ok"),
+    ]
+    assert max_running == [1]
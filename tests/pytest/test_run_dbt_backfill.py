@@ -0,0 +1,208 @@
+import datetime
+
+import pytest
+
+TODAY = datetime.date(2024, 3, 31)
+
+
+def build_manifest(child_map: dict, partitioned: dict) -> dict:
+    """Models in `partitioned` are insert_overwrite models that call the backfill macro, values are their meta"""
+
+    nodes = {}
+    for unique_id in child_map:
+        name = unique_id.split(".")[-1]
+        if unique_id in partitioned:
+            config = {
+                "materialized": "incremental",
+                "incremental_strategy": "insert_overwrite",
+                "partition_by": {"data_type": "timestamp", "field": "created_at"},
+                "on_schema_change": "sync_all_columns",
+                "meta": partitioned[unique_id],
+            }
+            macros = ["macro.beyond_basics.backfill_partition_filter"]
+        else:
+            config, macros = {"materialized": "table"}, []
+        nodes[unique_id] = {
+            "name": name,
+            "resource_type": "model",
+            "database": "prd",
+            "schema": "marts",
+            "alias": name,
+            "relation_name": f"`prd`.`marts`.`{name}`",
+            "config": config,
+            "depends_on": {"macros": macros},
+        }
+
+    return {"nodes": nodes, "child_map": child_map}
+
+
+@pytest.mark.no_deps
+def test_build_partition_chunks() -> None:
+    """
+    Chunks are at most `chunk_days` long and split where a window starts so each model backfills whole chunks.
+    """
+
+    from run_dbt_backfill import BackfillChunk, build_partition_chunks
+
+    chunks = build_partition_chunks(
+        {
+            "stg_blocks": (datetime.date(2024, 1, 1), datetime.date(2024, 3, 1)),
+            "fct_blocks": (datetime.date(2024, 2, 15), datetime.date(2024, 3, 1)),
+        },
+        chunk_days=30,
+    )
+    assert chunks == [
+        BackfillChunk(
+            datetime.date(2024, 1, 1), datetime.date(2024, 1, 31), ["stg_blocks"]
+        ),
+        BackfillChunk(
+            datetime.date(2024, 1, 31), datetime.date(2024, 2, 15), ["stg_blocks"]
+        ),
+        BackfillChunk(
+            datetime.date(2024, 2, 15),
+            datetime.date(2024, 3, 1),
+            ["fct_blocks", "stg_blocks"],
+        ),
+    ]
+    assert build_partition_chunks({}) == []
+
+
+@pytest.mark.no_deps
+def test_plan_backfill() -> None:
+    """
+    Partitioned models with a window are backfilled in chunks, models downstream of these are fully refreshed
+    afterwards and models without a window are fully refreshed.
+    """
+
+    from manifest_loader import ManifestIndex
+    from run_dbt_backfill import (
+        BackfillPlan,
+        plan_backfill,
+        supports_partition_backfill,
+    )
+
+    manifest = build_manifest(
+        child_map={
+            "model.beyond_basics.stg_blocks": ["model.beyond_basics.fct_blocks"],
+            "model.beyond_basics.fct_blocks": ["model.beyond_basics.dim_days"],
+            "model.beyond_basics.dim_days": [],
+            "model.beyond_basics.stg_orders": [],
+        },
+        partitioned={
+            "model.beyond_basics.stg_blocks": {"backfill_lookback_days": 6},
+            "model.beyond_basics.fct_blocks": {},
+        },
+    )
+    index = ManifestIndex(manifest)
+    unique_ids = sorted(manifest["nodes"])
+
+    plan = plan_backfill(manifest, index, unique_ids, lookback_days=2, today=TODAY)
+    assert plan.full_refresh_models == ["stg_orders"]
+    assert plan.downstream_models == ["dim_days"]
+    assert [(x.start_date.day, x.end_date.day, x.models) for x in plan.chunks] == [
+        (25, 29, ["stg_blocks"]),
+        (29, 1, ["fct_blocks", "stg_blocks"]),
+    ]
+
+    plan = plan_backfill(
+        manifest,
+        index,
+        unique_ids,
+        start_date=datetime.date(2024, 3, 1),
+        end_date=datetime.date(2024, 3, 10),
+        chunk_days=7,
+        today=TODAY,
+    )
+    assert [(x.start_date.day, x.end_date.day) for x in plan.chunks] == [
+        (1, 8),
+        (8, 11),
+    ]
+
+    # Without `--backfill-lookback-days` fct_blocks has no window, it is fully refreshed after stg_blocks
+    plan = plan_backfill(manifest, index, unique_ids, today=TODAY)
+    assert plan.full_refresh_models == ["stg_orders"]
+    assert plan.downstream_models == ["dim_days", "fct_blocks"]
+    assert [x.models for x in plan.chunks] == [["stg_blocks"]]
+
+    # With the default `on_schema_change` new columns would not be added by a chunk, fct_blocks is fully refreshed
+    manifest["nodes"]["model.beyond_basics.fct_blocks"]["config"][
+        "on_schema_change"
+    ] = "ignore"
+    plan = plan_backfill(manifest, index, unique_ids, lookback_days=2, today=TODAY)
+    assert plan.full_refresh_models == ["stg_orders"]
+    assert plan.downstream_models == ["dim_days", "fct_blocks"]
+    assert [x.models for x in plan.chunks] == [["stg_blocks"]]
+    del manifest["nodes"]["model.beyond_basics.fct_blocks"]["config"][
+        "on_schema_change"
+    ]
+    assert not supports_partition_backfill(
+        manifest["nodes"]["model.beyond_basics.fct_blocks"]
+    )
+    manifest["nodes"]["model.beyond_basics.fct_blocks"]["config"][
+        "on_schema_change"
+    ] = "append_new_columns"
+
+    # dim_days would need to run between the chunks of stg_blocks and fct_blocks
+    manifest["child_map"] = {
+        "model.beyond_basics.stg_blocks": ["model.beyond_basics.dim_days"],
+        "model.beyond_basics.dim_days": ["model.beyond_basics.fct_blocks"],
+        "model.beyond_basics.fct_blocks": [],
+        "model.beyond_basics.stg_orders": [],
+    }
+    plan = plan_backfill(
+        manifest, ManifestIndex(manifest), unique_ids, lookback_days=2, today=TODAY
+    )
+    assert plan == BackfillPlan(
+        full_refresh_models=["dim_days", "fct_blocks", "stg_blocks", "stg_orders"],
+        chunks=[],
+        downstream_models=[],
+    )
+
+
+@pytest.mark.no_deps
+def test_run_backfill_plan_retries_each_chunk(monkeypatch) -> None:
+    """
+    A failed chunk is retried on its own, the full refresh and earlier chunks are not run again.
+    """
+
+    import run_dbt_backfill
+    from run_dbt_backfill import BackfillChunk, BackfillPlan, run_backfill_plan
+
+    commands = []
+    failures = [1]
+
+    def run_dbt_command(dbt_command: str) -> list:
+        commands.append(dbt_command)
+        if '"backfill_start_date":"2024-03-08"' in dbt_command and failures[0] > 0:
+            failures[0] -= 1
+            raise RuntimeError("dbt command did not complete successfully.")
+        return []
+
+    monkeypatch.setattr(run_dbt_backfill, "run_dbt_command", run_dbt_command)
+    plan = BackfillPlan(
+        full_refresh_models=["stg_orders"],
+        chunks=[
+            BackfillChunk(
+                datetime.date(2024, 3, 1), datetime.date(2024, 3, 8), ["stg_blocks"]
+            ),
+            BackfillChunk(
+                datetime.date(2024, 3, 8), datetime.date(2024, 3, 11), ["stg_blocks"]
+            ),
+        ],
+        downstream_models=["dim_days"],
+    )
+
+    run_backfill_plan(plan, "prd", delay=0)
+    assert [x.split(" --")[1] for x in commands] == [
+        "select state:modified+,package:beyond_basics",
+        "select stg_blocks",
+        "select stg_blocks",
+        "select stg_blocks",
+        "select dim_days",
+    ]
+    assert "--exclude stg_blocks dim_days" in commands[0]
+    assert commands[2] == commands[3]
+
+    failures[0] = 3
+    with pytest.raises(RuntimeError):
+        run_backfill_plan(plan, "prd", delay=0)